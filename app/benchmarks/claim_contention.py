@@ -0,0 +1,174 @@
+"""
+Labeling contention benchmark: how many images concurrent labelers
+label per second, and how many of them another labeler was shown too,
+with image claims and with the old random sampling.
+
+Every simulated labeler is a thread with its own database connection.
+Labelers are spread over --workers simulated web workers, each with its
+own in-process queue as in web/app.py: claims mode refills it with
+Image_claim_base.claim, random mode with get_random_unclassified. A
+labeler takes a name from its worker's queue, waits --think-ms and
+labels it with apply_labels.
+
+Needs PostgreSQL (FOR UPDATE SKIP LOCKED). Use a scratch database: the
+schema is created there with db_init/init_database.py and every run
+clears the labels of all images in it.
+
+    python benchmarks/claim_contention.py \\
+        --database-url postgresql://... --labelers 1,10,50,100
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from collections import Counter
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import sessionmaker
+
+from emulator import load_module
+from db_models.image_claim_base import Image_claim_base
+from db_models.image_table_base import Image_table_base
+
+
+class Worker:
+    """One web worker's queue of names to serve."""
+
+    def __init__(self, name, mode, batch, lease):
+        self.name = name
+        self.mode = mode
+        self.batch = batch
+        self.lease = lease
+        self.queue = []
+        self.lock = threading.Lock()
+        self.refills = 0
+
+    def next_name(self, session):
+        """Pop a name, refilling the queue from the database if empty."""
+        with self.lock:
+            if not self.queue:
+                self.refills += 1
+                if self.mode == 'claims':
+                    self.queue = Image_claim_base.claim(
+                        session, self.name, limit=self.batch,
+                        lease=self.lease)
+                else:
+                    self.queue = [row.file_name for row in
+                                  Image_table_base.get_random_unclassified(
+                                      session, limit=self.batch)]
+                    session.commit()
+            return self.queue.pop() if self.queue else None
+
+
+def reset(engine, images):
+    """Create the schema if needed, seed images and clear all labels."""
+    init_database = load_module('init_database', 'db_init/init_database.py')
+    init_database.create_images_table(engine)
+    failed = init_database.apply_schema_extensions(engine)
+    if failed:
+        raise RuntimeError(f"Schema extensions failed: {failed}")
+    with engine.begin() as conn:
+        conn.execute(text("""
+            INSERT INTO images (file_name)
+            SELECT 'bench-' || g || '.jpg' FROM generate_series(1, :n) g
+            ON CONFLICT (file_name) DO NOTHING
+        """), {'n': images})
+        conn.execute(text("UPDATE images SET is_masc_human = NULL, "
+                          "deleted_at = NULL"))
+        conn.execute(text("TRUNCATE image_claims"))
+
+
+def run(engine, labelers, args):
+    """Run labelers for args.seconds and report what they did."""
+    reset(engine, args.images)
+    Session = sessionmaker(bind=engine)
+    workers = [Worker(f"bench-worker-{index}", args.mode, args.batch,
+                      args.lease)
+               for index in range(min(args.workers, labelers))]
+    served = Counter()
+    served_lock = threading.Lock()
+    stop = time.perf_counter() + args.seconds
+    errors = []
+
+    def label_loop(index):
+        rng = random.Random(index)
+        worker = workers[index % len(workers)]
+        session = Session()
+        try:
+            while time.perf_counter() < stop:
+                name = worker.next_name(session)
+                if name is None:
+                    break
+                with served_lock:
+                    served[name] += 1
+                time.sleep(args.think_ms / 1000)
+                Image_table_base.apply_labels(
+                    session, [(name, rng.choice(('male', 'female')))])
+        except Exception as e:
+            errors.append(repr(e))
+        finally:
+            session.close()
+
+    threads = [threading.Thread(target=label_loop, args=(index,))
+               for index in range(labelers)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    labeled = sum(served.values())
+    return {
+        'labelers': labelers,
+        'workers': len(workers),
+        'labels': labeled,
+        'labels_per_second': round(labeled / elapsed, 1),
+        'distinct_images': len(served),
+        # Labels that overwrote another labeler's label of the same image
+        'duplicate_labels': labeled - len(served),
+        'refills': sum(worker.refills for worker in workers),
+        'errors': errors[:5],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--database-url', required=True,
+                        help="SQLAlchemy URL of a scratch PostgreSQL")
+    parser.add_argument('--labelers', default='1,10,50,100',
+                        help="Comma separated labeler counts to sweep")
+    parser.add_argument('--workers', type=int, default=4,
+                        help="Simulated web workers the labelers share")
+    parser.add_argument('--mode', choices=('claims', 'random'),
+                        default='claims')
+    parser.add_argument('--images', type=int, default=20000)
+    parser.add_argument('--seconds', type=float, default=20)
+    parser.add_argument('--think-ms', type=float, default=1000,
+                        help="Time a labeler looks at each image")
+    parser.add_argument('--batch', type=int, default=10,
+                        help="Names fetched per queue refill")
+    parser.add_argument('--lease', type=float, default=600)
+    parser.add_argument('--output', help="Write the report to this file")
+    args = parser.parse_args()
+
+    counts = [int(count) for count in args.labelers.split(',')]
+    engine = create_engine(args.database_url, pool_size=max(counts) + 5,
+                           max_overflow=0)
+    runs = [run(engine, labelers, args) for labelers in counts]
+    # Throughput per labeler relative to a single labeler: 1.0 is linear
+    base = runs[0]['labels_per_second'] / runs[0]['labelers']
+    for result in runs:
+        result['scaling_efficiency'] = round(
+            result['labels_per_second'] / result['labelers'] / base, 3) \
+            if base else None
+    report = {'mode': args.mode, 'think_ms': args.think_ms, 'runs': runs}
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w') as handle:
+            json.dump(report, handle, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,341 @@
+"""
+Local stand-ins for the AWS pieces of the ingest pipeline.
+
+LocalS3Access keeps objects in a directory and records an S3 event for
+every object created, like the bucket notifications in s3-triggers.tf.
+FakeQueue stands in for the SQS ingest queues: it batches those events
+the way a Lambda event source mapping does and honours the handlers'
+partial batch responses.
+local_database() gives a SQLite (or any SQLAlchemy URL) database with
+the images table. load_handlers() imports both Lambda modules in-process
+and points them at these fakes, so the real lambda_handler code runs
+unchanged. load_web_app() does the same for the Flask web app.
+"""
+import hashlib
+import importlib.util
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import uuid
+from collections import Counter, deque
+from urllib.parse import quote_plus
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.append(APP_DIR)
+
+from modules.s3_access import S3Access  # noqa: E402
+from db_models.image_table import Image_table  # noqa: E402
+from db_models.processing_ledger_base import \
+    Processing_ledger_base  # noqa: E402
+
+LOCAL_BUCKET = 'local-image-trainer'
+
+
+class LocalContext:
+    """Minimal Lambda context object."""
+
+    def __init__(self):
+        self.aws_request_id = str(uuid.uuid4())
+
+
+class LocalS3Access(S3Access):
+    """
+    Filesystem-backed S3Access.
+
+    Every object created is also appended to `events`, keyed by the
+    trigger prefix it falls under, as an S3 notification record. `calls`
+    counts the requests made per operation.
+    """
+
+    TRIGGER_PREFIXES = ('upload/', 'sources/')
+
+    def __init__(self, bucket_name=LOCAL_BUCKET, root=None):
+        self.bucket_name = bucket_name
+        self.root = root or tempfile.mkdtemp(prefix='local-s3-')
+        self.events = {prefix: [] for prefix in self.TRIGGER_PREFIXES}
+        self.metadata = {}
+        self.calls = Counter()
+
+    def _path(self, key):
+        return os.path.join(self.root, key)
+
+    def _created(self, key, data):
+        for prefix in self.TRIGGER_PREFIXES:
+            if key.startswith(prefix):
+                self.events[prefix].append(
+                    s3_record(self.bucket_name, key, data))
+
+    def list_sources(self):
+        folder = self._path('sources')
+        if not os.path.isdir(folder):
+            return []
+        return [f"sources/{name}" for name in sorted(os.listdir(folder))]
+
+    def rename_key(self, current_key, new_key):
+        # A server-side copy and a delete, as in S3Access
+        self.calls['copy_object'] += 1
+        data = self._read(current_key)
+        if data is None:
+            return False
+        self._write(new_key, data)
+        self._created(new_key, data)
+        return self.delete_object(current_key)
+
+    def put_object(self, key, file_object, metadata=None,
+                   content_type=None, cache_control=None):
+        self.calls['put_object'] += 1
+        if hasattr(file_object, 'read'):
+            data = file_object.read()
+        else:
+            data = bytes(file_object)
+        self._write(key, data)
+        self.metadata[key] = dict(metadata or {})
+        self._created(key, data)
+        return True
+
+    def _write(self, key, data):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as handle:
+            handle.write(data)
+
+    def get_object(self, key):
+        self.calls['get_object'] += 1
+        return self._read(key)
+
+    def _read(self, key):
+        try:
+            with open(self._path(key), 'rb') as handle:
+                return handle.read()
+        except FileNotFoundError:
+            return None
+
+    def object_exists(self, key):
+        self.calls['head_object'] += 1
+        return os.path.isfile(self._path(key))
+
+    def head_object(self, key):
+        self.calls['head_object'] += 1
+        if not os.path.isfile(self._path(key)):
+            return None
+        return dict(self.metadata.get(key, {}))
+
+    def delete_object(self, key):
+        self.calls['delete_object'] += 1
+        self.metadata.pop(key, None)
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+        return True
+
+    def drain_events(self, prefix):
+        """Take every pending event for a trigger prefix."""
+        records, self.events[prefix] = self.events[prefix], []
+        return records
+
+    def cleanup(self):
+        """Delete the backing directory."""
+        shutil.rmtree(self.root, ignore_errors=True)
+
+
+class FakeQueue:
+    """
+    In-memory SQS queue with a redrive policy.
+
+    send() enqueues S3 records one per message, as S3 does, and
+    send_body() any other body, such as a malformed one. receive()
+    takes up to batch_size messages as an SQS Lambda event, and
+    settle() applies the handler's response to them like an event
+    source mapping with ReportBatchItemFailures: messages listed in
+    batchItemFailures, or all of them when the handler raised, are
+    received again, and after max_receive_count receives they move to
+    dead_letters.
+    """
+
+    def __init__(self, name='local-ingest', max_receive_count=3):
+        self.arn = f"arn:aws:sqs:us-east-1:000000000000:{name}"
+        self.max_receive_count = max_receive_count
+        self.messages = deque()
+        self.in_flight = {}
+        self.dead_letters = []
+
+    def __len__(self):
+        return len(self.messages)
+
+    def send(self, records):
+        """Enqueue each S3 record as its own notification message."""
+        for record in records:
+            self.send_body(json.dumps(s3_event([record])))
+
+    def send_body(self, body):
+        """Enqueue a message with body as it is."""
+        self.messages.append({
+            'messageId': str(uuid.uuid4()),
+            'body': body,
+            'receive_count': 0
+        })
+
+    def receive(self, batch_size=10):
+        """Take up to batch_size messages as an SQS batch event."""
+        batch = []
+        while self.messages and len(batch) < batch_size:
+            message = self.messages.popleft()
+            message['receive_count'] += 1
+            self.in_flight[message['messageId']] = message
+            batch.append(message)
+        return {'Records': [{
+            'messageId': message['messageId'],
+            'receiptHandle': message['messageId'],
+            'body': message['body'],
+            'attributes': {
+                'ApproximateReceiveCount': str(message['receive_count'])},
+            'messageAttributes': {},
+            'eventSource': 'aws:sqs',
+            'eventSourceARN': self.arn,
+            'awsRegion': 'us-east-1'
+        } for message in batch]}
+
+    def settle(self, event, response=None):
+        """
+        Delete the messages of a batch that succeeded and return the rest.
+
+        Args:
+            event (dict): A batch from receive()
+            response (dict): The handler's response, None if it raised
+
+        Returns:
+            int: Messages that failed
+        """
+        ids = [record['messageId'] for record in event['Records']]
+        if response is None:
+            failed = set(ids)
+        else:
+            failed = {failure['itemIdentifier'] for failure in
+                      response.get('batchItemFailures', [])}
+        for message_id in ids:
+            message = self.in_flight.pop(message_id)
+            if message_id not in failed:
+                continue
+            if message['receive_count'] >= self.max_receive_count:
+                self.dead_letters.append(message)
+            else:
+                self.messages.append(message)
+        return len(failed)
+
+
+def s3_record(bucket_name, key, data):
+    """Build one S3 ObjectCreated notification record."""
+    return {
+        'eventSource': 'aws:s3',
+        'eventName': 'ObjectCreated:Put',
+        's3': {
+            'bucket': {'name': bucket_name},
+            'object': {
+                'key': quote_plus(key),
+                'size': len(data),
+                'eTag': hashlib.md5(data).hexdigest()
+            }
+        }
+    }
+
+
+def s3_event(records):
+    """Wrap records the way S3 delivers them to a Lambda."""
+    return {'Records': list(records)}
+
+
+def local_database(url='sqlite://'):
+    """
+    Create a session on a database holding the ingest tables.
+
+    With the default in-memory SQLite URL the tables are created here, and
+    the hash column is filled by an ORM hook in place of the Postgres
+    auto_hash_trigger. Any other URL is expected to be initialized
+    already (for example by running init_database against it).
+    """
+    engine = create_engine(url)
+    if engine.dialect.name == 'sqlite':
+        Image_table.__table__.create(engine, checkfirst=True)
+        Processing_ledger_base.__table__.create(engine, checkfirst=True)
+
+        @event.listens_for(Image_table, 'before_insert')
+        def fill_hash(mapper, connection, target):
+            target.hash = target.file_name.split('.')[0]
+
+    return sessionmaker(bind=engine)()
+
+
+def load_module(name, relative_path):
+    """Import a Lambda module from its file path."""
+    path = os.path.join(APP_DIR, relative_path)
+    sys.path.append(os.path.dirname(path))
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    # Flask finds its templates through the module's entry here
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def load_handlers(s3_access, session, log_level=logging.ERROR):
+    """
+    Import file_processor and make_numpy and wire them to local fakes.
+
+    Returns:
+        tuple: (file_processor module, make_numpy module)
+    """
+    os.environ['S3_BUCKET_NAME'] = s3_access.bucket_name
+
+    file_processor = load_module('file_processor',
+                                 'process/file_processor.py')
+    make_numpy = load_module('make_numpy', 'numpy-convert/make_numpy.py')
+
+    file_processor.s3_access = s3_access
+    file_processor.db_engine = session.get_bind()
+    file_processor.db_session = session
+    make_numpy.s3_access = s3_access
+    make_numpy.db_sessions = sessionmaker(bind=session.get_bind())
+
+    # Both modules set the root logger to INFO on import
+    logging.getLogger().setLevel(log_level)
+    return file_processor, make_numpy
+
+
+def load_web_app(database_url='sqlite://', log_level=logging.ERROR):
+    """
+    Import the Flask web app against a local database.
+
+    With the default in-memory SQLite URL the images, label_counters and
+    label_events tables are created here, and label compaction and image
+    claims, which need PostgreSQL, are turned off; any other URL is
+    expected to be initialized already.
+
+    Returns:
+        module: The imported app module
+    """
+    os.environ['DATABASE_URI'] = database_url
+    # app.py logs the length of DB_PASSWORD, so it must be set
+    os.environ.setdefault('DB_PASSWORD', '')
+    os.environ.setdefault('S3_BUCKET_NAME', LOCAL_BUCKET)
+    os.environ.setdefault('CLOUDFRONT_URL', 'https://cdn.local')
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    if database_url.startswith('sqlite'):
+        os.environ.setdefault('LABEL_COMPACT_INTERVAL', '0')
+        os.environ.setdefault('CLAIM_LEASE', '0')
+
+    # Makes the logging.basicConfig in app.py a no-op
+    logging.basicConfig(level=log_level)
+    web = load_module('web_app', 'web/app.py')
+    with web.app.app_context():
+        if web.db.engine.dialect.name == 'sqlite':
+            for model in (web.Image_table_base, web.Label_counter_base,
+                          web.Label_event_base):
+                model.__table__.create(web.db.engine, checkfirst=True)
+    return web
@@ -0,0 +1,140 @@
+"""
+Fused normalize benchmark: pipeline.normalize against the float64
+arithmetic it replaced, on uint8 image arrays.
+
+Every case first checks that both give the same array, bit for bit
+(dtype, shape and bytes), and the script exits with status 1 if any
+case differs. It then reports, per case:
+
+    min_ms          fastest of --repeat calls
+    traced_peak_mb  peak of the numpy allocations of one call, which is
+                    what the fused path is meant to cut
+
+Presets are the normalize and dtype steps of typical specs:
+
+    python benchmarks/normalize_kernels.py
+    python benchmarks/normalize_kernels.py --sizes 500 --repeat 50
+"""
+import argparse
+import itertools
+import json
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+import emulator  # noqa: F401 (puts the app folder on sys.path)
+from modules import pipeline
+
+# Name -> (normalize step, output dtype)
+PRESETS = {
+    'legacy': ({'op': 'normalize', 'scale': 255}, 'float64'),
+    'unit_float32': ({'op': 'normalize', 'scale': 255}, 'float32'),
+    'unit_float16': ({'op': 'normalize', 'scale': 255}, 'float16'),
+    'imagenet_float32': ({'op': 'normalize', 'scale': 255,
+                          'mean': [0.485, 0.456, 0.406],
+                          'std': [0.229, 0.224, 0.225]}, 'float32'),
+    'imagenet_float16': ({'op': 'normalize', 'scale': 255,
+                          'mean': [0.485, 0.456, 0.406],
+                          'std': [0.229, 0.224, 0.225]}, 'float16'),
+    'centered_float16': ({'op': 'normalize', 'scale': 255, 'mean': 0.5,
+                          'std': 0.25}, 'float16'),
+}
+DEFAULT_SIZES = (224, 500, 1024)
+CHANNELS = {'gray': 1, 'rgb': 3}
+
+
+def reference(array, step, dtype):
+    """The normalize and dtype steps as they ran before fusing."""
+    result = array / np.asarray(step['scale'], dtype=np.float64)
+    result -= np.asarray(step['mean'], dtype=np.float64)
+    result /= np.asarray(step['std'], dtype=np.float64)
+    return result.astype(dtype, copy=False)
+
+
+def fused(array, step, dtype):
+    return pipeline.normalize(array, step, dtype)
+
+
+def measure(function, array, step, dtype, repeat):
+    """Traced peak of one call, then the fastest of repeat calls."""
+    tracemalloc.start()
+    function(array, step, dtype)
+    traced_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function(array, step, dtype)
+        timings.append(time.perf_counter() - started)
+    return {'min_ms': round(min(timings) * 1000, 3),
+            'traced_peak_mb': round(traced_peak / 2 ** 20, 2)}
+
+
+def run_case(preset, size, channels, repeat, seed=0):
+    step, dtype = PRESETS[preset]
+    step = pipeline.normalize_step(step)
+    if channels == 1 and isinstance(step['mean'], list):
+        return None
+    shape = (size, size) if channels == 1 else (size, size, channels)
+    array = np.random.default_rng(seed).integers(0, 256, shape,
+                                                 dtype=np.uint8)
+
+    expected = reference(array, step, dtype)
+    actual = fused(array, step, dtype)
+    equal = actual.dtype == expected.dtype and \
+        actual.shape == expected.shape and \
+        actual.tobytes() == expected.tobytes()
+    return {'equal': equal,
+            'reference': measure(reference, array, step, dtype, repeat),
+            'fused': measure(fused, array, step, dtype, repeat)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--presets', nargs='+', choices=list(PRESETS),
+                        default=list(PRESETS))
+    parser.add_argument('--sizes', nargs='+', type=int,
+                        default=list(DEFAULT_SIZES),
+                        help="Sides of the square arrays")
+    parser.add_argument('--channels', nargs='+', choices=list(CHANNELS),
+                        default=list(CHANNELS))
+    parser.add_argument('--repeat', type=int, default=20,
+                        help="Timed calls per case")
+    parser.add_argument('--output', help="Write the report to this file")
+    args = parser.parse_args()
+
+    results = {}
+    for preset, size, channels in itertools.product(
+            args.presets, args.sizes, args.channels):
+        result = run_case(preset, size, CHANNELS[channels], args.repeat)
+        if result is None:
+            # Per-channel mean and std need a color image
+            continue
+        key = f"{preset}/{size}/{channels}"
+        results[key] = result
+        print(f"{key:<32} {'ok' if result['equal'] else 'DIFFERS':<8}"
+              f"{result['reference']['min_ms']:>8.2f} -> "
+              f"{result['fused']['min_ms']:>6.2f} ms "
+              f"{result['reference']['traced_peak_mb']:>8.2f} -> "
+              f"{result['fused']['traced_peak_mb']:>6.2f} MB",
+              file=sys.stderr)
+
+    report = {'numpy': np.__version__, 'repeat': args.repeat,
+              'results': results}
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w') as handle:
+            json.dump(report, handle, indent=2)
+    differs = [key for key, result in results.items() if not result['equal']]
+    if differs:
+        print(f"{len(differs)} cases differ from the reference: "
+              f"{', '.join(differs)}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,173 @@
+"""
+Parallel conversion benchmark: make_numpy images per second against
+CONVERT_WORKERS, with the thread and the process executor.
+
+A batch of synthetic sources (a mix of JPEG and PNG photos) is stored
+in a LocalS3Access bucket and handed to make_numpy.lambda_handler as one
+SQS batch event, the way the sources queue delivers it. Each run starts
+a fresh pool, converts the whole batch once to warm it up, then times
+--repeat more runs. Every run first deletes the outputs and clears the
+conversion cache, so it converts every image again. The outputs of
+every run are compared with the serial run's, byte for byte. A last,
+untimed run traces the allocations of this process
+(parent_traced_peak_mb): with the process executor the outputs are
+serialized into shared memory slots by the pool and uploaded from
+there, so only the upload's own reads show up.
+
+Speedup is relative to one worker, so it can only exceed 1 with
+several cores (see cpu_count in the report):
+
+    python benchmarks/parallel_convert.py
+    python benchmarks/parallel_convert.py --workers 1,2,4,6 --images 24
+"""
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import sys
+import time
+import tracemalloc
+
+from emulator import FakeQueue, LocalContext, LocalS3Access, \
+    load_module, s3_record
+from pipeline import DEFAULT_SHAPES, synthesize_image
+
+EXECUTORS = ('thread', 'process')
+OUTPUT_FOLDERS = ('numpys', 'display')
+
+
+def store_sources(s3_access, images, seed=0):
+    """Put synthetic images in sources/ and return their S3 records."""
+    records = []
+    for index in range(images):
+        width, height, image_format = \
+            DEFAULT_SHAPES[index % len(DEFAULT_SHAPES)]
+        data = synthesize_image(width, height, image_format, seed + index)
+        extension = 'jpg' if image_format == 'JPEG' else 'png'
+        key = f"sources/{hashlib.md5(data).hexdigest()}.{extension}"
+        s3_access.put_object(key, data)
+        records.append(s3_record(s3_access.bucket_name, key, data))
+    s3_access.drain_events('sources/')
+    return records
+
+
+def outputs(s3_access):
+    """Digest of every object the converter wrote."""
+    digests = {}
+    for folder in OUTPUT_FOLDERS:
+        root = os.path.join(s3_access.root, folder)
+        for directory, _, names in os.walk(root):
+            for name in names:
+                with open(os.path.join(directory, name), 'rb') as handle:
+                    digests[os.path.relpath(os.path.join(directory, name),
+                                            s3_access.root)] = \
+                        hashlib.md5(handle.read()).hexdigest()
+    return digests
+
+
+def run(make_numpy, s3_access, records, workers, executor, repeat):
+    """Time make_numpy over one SQS batch of records with a new pool."""
+    if make_numpy.convert_pool is not None:
+        make_numpy.convert_pool.shutdown()
+    make_numpy.CONVERT_WORKERS = workers
+    make_numpy.CONVERT_EXECUTOR = executor
+    make_numpy.convert_pool = None
+
+    def invoke():
+        for folder in OUTPUT_FOLDERS:
+            shutil.rmtree(os.path.join(s3_access.root, folder),
+                          ignore_errors=True)
+        make_numpy.conversion_cache.clear()
+        queue = FakeQueue()
+        queue.send(records)
+        batch = queue.receive(len(records))
+        response = make_numpy.lambda_handler(batch, LocalContext())
+        if response.get('batchItemFailures') or \
+                response.get('statusCode') != 200:
+            raise RuntimeError(f"Conversion failed: {response}")
+
+    # The first run also starts the pool, as a cold start would
+    invoke()
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        invoke()
+        timings.append(time.perf_counter() - started)
+    best = min(timings)
+
+    tracemalloc.start()
+    invoke()
+    traced_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {
+        'workers': workers,
+        'executor': executor,
+        'best_seconds': round(best, 3),
+        'images_per_second': round(len(records) / best, 2),
+        'parent_traced_peak_mb': round(traced_peak / 2 ** 20, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--images', type=int, default=12,
+                        help="Images in the batch")
+    parser.add_argument('--workers', default=None,
+                        help="Comma separated CONVERT_WORKERS values, "
+                             "1 up to the core count by default")
+    parser.add_argument('--executors', nargs='+', choices=EXECUTORS,
+                        default=list(EXECUTORS))
+    parser.add_argument('--repeat', type=int, default=3,
+                        help="Timed runs per setting")
+    parser.add_argument('--output', help="Write the report to this file")
+    args = parser.parse_args()
+
+    cpu_count = os.cpu_count() or 1
+    counts = [int(count) for count in args.workers.split(',')] \
+        if args.workers else sorted({1, 2, 4, cpu_count} - {0})
+
+    s3_access = LocalS3Access()
+    os.environ['S3_BUCKET_NAME'] = s3_access.bucket_name
+    try:
+        make_numpy = load_module('make_numpy',
+                                 'numpy-convert/make_numpy.py')
+        make_numpy.logger.setLevel('ERROR')
+        make_numpy.s3_access = s3_access
+        records = store_sources(s3_access, args.images)
+
+        runs = []
+        expected = None
+        for executor in args.executors:
+            for workers in counts:
+                result = run(make_numpy, s3_access, records, workers,
+                             executor, args.repeat)
+                written = outputs(s3_access)
+                if expected is None:
+                    expected = written
+                result['outputs_match'] = written == expected
+                runs.append(result)
+                print(f"{executor:<8} {workers:>3} workers "
+                      f"{result['images_per_second']:>8.2f} images/s",
+                      file=sys.stderr)
+        make_numpy.convert_pool.shutdown()
+
+        for result in runs:
+            base = next(other for other in runs
+                        if other['executor'] == result['executor'] and
+                        other['workers'] == counts[0])
+            result['speedup'] = round(
+                result['images_per_second'] / base['images_per_second'], 2)
+        report = {'cpu_count': cpu_count, 'images': args.images,
+                  'repeat': args.repeat, 'runs': runs}
+        print(json.dumps(report, indent=2))
+        if args.output:
+            with open(args.output, 'w') as handle:
+                json.dump(report, handle, indent=2)
+        return 0 if all(result['outputs_match'] for result in runs) else 1
+    finally:
+        s3_access.cleanup()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,231 @@
+"""
+End-to-end ingest benchmark: upload -> file_processor -> sources/ ->
+make_numpy -> numpys/, run locally.
+
+Synthesizes a set of images, drops them into a LocalS3Access upload/
+folder and feeds the resulting S3 events to the real lambda_handlers in
+batches. Each stage is timed per invocation. The report gives images
+per second, latency percentiles per stage and peak RSS. With
+--redeliver every event is then delivered a second time, as S3 may do,
+to measure what skipping already processed objects costs. With --sqs
+the events go through a FakeQueue per stage and reach the handlers as
+SQS batches of --event-batch messages, as with the ingest queues.
+--poison adds a malformed message to each queue, which must end up
+alone in the dead-letter queue while the rest of its batch succeeds.
+With --fused file_processor also converts each image (FUSED_CONVERT=1)
+and make_numpy only confirms its outputs are current. Each stage
+reports the S3 requests it made.
+
+    python benchmarks/pipeline.py --images 50 --event-batch 5
+    python benchmarks/pipeline.py --images 50 --event-batch 10 --sqs
+    python benchmarks/pipeline.py --images 20 --event-batch 10 --sqs \
+        --poison
+    python benchmarks/pipeline.py --images 50 --fused
+    python benchmarks/pipeline.py --database-url postgresql://...
+"""
+import argparse
+import json
+import os
+import resource
+import time
+from collections import Counter
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+from emulator import FakeQueue, LocalContext, LocalS3Access, \
+    load_handlers, local_database, s3_event
+
+# Body of the --poison message: neither JSON nor an S3 notification
+POISON_BODY = 'not an S3 notification'
+
+# (width, height, format) cycled through when synthesizing uploads
+DEFAULT_SHAPES = [
+    (640, 480, 'JPEG'),
+    (1920, 1080, 'JPEG'),
+    (1024, 1024, 'PNG'),
+    (3000, 4000, 'JPEG'),
+]
+
+
+def synthesize_image(width, height, image_format, seed):
+    """Encode a smooth random image, unique per seed."""
+    rng = np.random.default_rng(seed)
+    # Upsampling a tiny random grid gives photo-like compressibility
+    grid = rng.integers(0, 256, (6, 8, 3), dtype=np.uint8)
+    image = Image.fromarray(grid).resize((width, height),
+                                         Image.Resampling.BICUBIC)
+    buffer = BytesIO()
+    image.save(buffer, format=image_format)
+    return buffer.getvalue()
+
+
+def percentiles(samples):
+    """Summarize latencies in milliseconds."""
+    if not samples:
+        return {}
+    values = np.asarray(samples) * 1000.0
+    return {
+        'count': len(samples),
+        'p50_ms': round(float(np.percentile(values, 50)), 2),
+        'p90_ms': round(float(np.percentile(values, 90)), 2),
+        'p99_ms': round(float(np.percentile(values, 99)), 2),
+        'max_ms': round(float(values.max()), 2)
+    }
+
+
+def run_stage(handler, records, event_batch, poison=False):
+    """
+    Invoke handler over records in batches.
+
+    Returns:
+        tuple: (per-invocation seconds, total seconds, failed invocations,
+        dead letters, always 0 here)
+    """
+    latencies, failures = [], 0
+    started = time.perf_counter()
+    for start in range(0, len(records), event_batch):
+        batch = records[start:start + event_batch]
+        invoked = time.perf_counter()
+        result = handler(s3_event(batch), LocalContext())
+        latencies.append(time.perf_counter() - invoked)
+        if result.get('statusCode') != 200:
+            failures += 1
+    return latencies, time.perf_counter() - started, failures, 0
+
+
+def run_queue_stage(handler, records, event_batch, poison=False):
+    """
+    Deliver records through a FakeQueue in SQS batches until it drains.
+    With poison a malformed message is sent first, so it shares a batch
+    with good ones.
+
+    Returns:
+        tuple: (per-invocation seconds, total seconds, invocations that
+        failed some of their messages, messages moved to dead letters)
+    """
+    queue = FakeQueue()
+    if poison:
+        queue.send_body(POISON_BODY)
+    queue.send(records)
+    latencies, failures = [], 0
+    started = time.perf_counter()
+    while len(queue):
+        batch = queue.receive(event_batch)
+        invoked = time.perf_counter()
+        result = handler(batch, LocalContext())
+        latencies.append(time.perf_counter() - invoked)
+        if queue.settle(batch, result):
+            failures += 1
+    return latencies, time.perf_counter() - started, failures, \
+        len(queue.dead_letters)
+
+
+def stage_report(records, latencies, seconds, failures, dead_letters):
+    return {
+        'records': len(records),
+        'invocations': len(latencies),
+        'failed_invocations': failures,
+        'dead_letters': dead_letters,
+        'seconds': round(seconds, 3),
+        'images_per_second': round(len(records) / seconds, 2)
+        if seconds else 0,
+        'latency_per_invocation': percentiles(latencies)
+    }
+
+
+def run_pipeline(images, event_batch, database_url, seed=0,
+                 redeliver=False, sqs=False, fused=False, poison=False):
+    """Run every upload through both stages and build the report."""
+    run = run_queue_stage if sqs else run_stage
+    os.environ['FUSED_CONVERT'] = '1' if fused else '0'
+    s3_access = LocalS3Access()
+    session = local_database(database_url)
+    file_processor, make_numpy = load_handlers(s3_access, session)
+
+    try:
+        for index in range(images):
+            width, height, image_format = \
+                DEFAULT_SHAPES[index % len(DEFAULT_SHAPES)]
+            extension = 'jpg' if image_format == 'JPEG' else 'png'
+            s3_access.put_object(
+                f"upload/synthetic-{index}.{extension}",
+                synthesize_image(width, height, image_format, seed + index))
+
+        stages = {}
+        delivered = {}
+        total_seconds = 0.0
+        handlers = (
+            ('file_processor', 'upload/', file_processor.lambda_handler),
+            ('make_numpy', 'sources/', make_numpy.lambda_handler))
+        for name, prefix, handler in handlers:
+            records = delivered[name] = s3_access.drain_events(prefix)
+            calls = Counter(s3_access.calls)
+            latencies, seconds, failures, dead_letters = run(
+                handler, records, event_batch, poison)
+            total_seconds += seconds
+            stages[name] = stage_report(records, latencies, seconds,
+                                        failures, dead_letters)
+            stages[name]['s3_calls'] = dict(s3_access.calls - calls)
+
+        if redeliver:
+            for name, prefix, handler in handlers:
+                calls = Counter(s3_access.calls)
+                stages[f"{name}_redelivered"] = stage_report(
+                    delivered[name],
+                    *run(handler, delivered[name], event_batch))
+                stages[f"{name}_redelivered"]['s3_calls'] = \
+                    dict(s3_access.calls - calls)
+
+        return {
+            'images': images,
+            'event_batch': event_batch,
+            'delivery': 'sqs' if sqs else 's3',
+            'fused': fused,
+            'poison': poison,
+            'database': session.get_bind().dialect.name,
+            'sources_written': len(s3_access.list_sources()),
+            'end_to_end_images_per_second': round(images / total_seconds, 2)
+            if total_seconds else 0,
+            'stages': stages,
+            # ru_maxrss is reported in kilobytes on Linux
+            'peak_rss_mb': round(resource.getrusage(
+                resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+        }
+    finally:
+        s3_access.cleanup()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--images', type=int, default=40)
+    parser.add_argument('--event-batch', type=int, default=1,
+                        help="S3 records (or SQS messages with --sqs) per "
+                             "Lambda invocation")
+    parser.add_argument('--database-url', default='sqlite://',
+                        help="SQLAlchemy URL, in-memory SQLite by default")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--redeliver', action='store_true',
+                        help="Deliver every event a second time")
+    parser.add_argument('--sqs', action='store_true',
+                        help="Deliver events through a fake SQS queue")
+    parser.add_argument('--fused', action='store_true',
+                        help="Convert in file_processor (FUSED_CONVERT=1)")
+    parser.add_argument('--poison', action='store_true',
+                        help="With --sqs, add a malformed message to each "
+                             "queue")
+    parser.add_argument('--output', help="Write the report to this file")
+    args = parser.parse_args()
+
+    report = run_pipeline(args.images, args.event_batch, args.database_url,
+                          args.seed, args.redeliver, args.sqs, args.fused,
+                          args.poison)
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w') as handle:
+            json.dump(report, handle, indent=2)
+
+
+if __name__ == '__main__':
+    main()
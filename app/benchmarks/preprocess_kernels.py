@@ -0,0 +1,252 @@
+"""
+Micro-benchmarks for the make_numpy preprocessing kernels.
+
+Times resize_and_pad_image (on an already decoded image) and
+convert_to_numpy (bytes to flat array, decode included) across input
+sizes from thumbnails to 50 MP, JPEG / PNG / PNG with alpha, target
+sizes and grayscale on or off. Cases over MAX_IMAGE_PIXELS that can't
+be decoded at reduced scale are reported as rejected (set the variable
+to 0 to measure them anyway). Every case runs in a forked child so
+that its memory numbers are not hidden by earlier, larger cases:
+
+    traced_peak_mb  peak of allocations tracemalloc can see (numpy
+                    arrays and Python objects, not Pillow's buffers)
+    rss_growth_mb   peak RSS of the child above its RSS at fork, which
+                    does include Pillow's image memory
+
+Results can be saved as a baseline and later runs compared against it:
+
+    python benchmarks/preprocess_kernels.py --save baseline.json
+    python benchmarks/preprocess_kernels.py --compare baseline.json
+    python benchmarks/preprocess_kernels.py --sizes thumb 1mp --repeat 10
+"""
+import argparse
+import gc
+import itertools
+import json
+import logging
+import multiprocessing as mp
+import platform
+import resource
+import sys
+import time
+import tracemalloc
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+from emulator import load_module
+
+# Name -> (width, height)
+SIZES = {
+    'thumb': (160, 120),
+    '1mp': (1280, 800),
+    '12mp': (4000, 3000),
+    '50mp': (8660, 5774),
+}
+# Name -> (PIL format, mode)
+FORMATS = {
+    'jpeg': ('JPEG', 'RGB'),
+    'png': ('PNG', 'RGB'),
+    'png_alpha': ('PNG', 'RGBA'),
+}
+DEFAULT_TARGETS = (224, 500)
+KERNELS = ('resize_and_pad_image', 'convert_to_numpy')
+
+# Fraction a metric may grow over the baseline before it is flagged
+DEFAULT_THRESHOLD = 0.25
+
+# Set in the parent before forking, read by the case runner
+_state = {}
+
+
+def synthesize_image(size, format_name, seed=0):
+    """Encode a smooth random image with photo-like compressibility."""
+    width, height = SIZES[size]
+    image_format, mode = FORMATS[format_name]
+    rng = np.random.default_rng(seed)
+    grid = rng.integers(0, 256, (6, 8, len(mode)), dtype=np.uint8)
+    image = Image.fromarray(grid, mode).resize((width, height),
+                                               Image.Resampling.BICUBIC)
+    buffer = BytesIO()
+    image.save(buffer, format=image_format)
+    return buffer.getvalue()
+
+
+def case_key(kernel, size, format_name, target, grayscale):
+    return f"{kernel}/{size}/{format_name}/{target}/" \
+           f"{'gray' if grayscale else 'rgb'}"
+
+
+def _rss_kb():
+    """Current resident set size in kilobytes (Linux)."""
+    with open('/proc/self/status') as status:
+        for line in status:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    return 0
+
+
+def _run_case(kernel, size, format_name, target, grayscale, repeat):
+    """Measure one case. Runs in a forked child."""
+    make_numpy = _state['make_numpy']
+    data = _state['images'][(size, format_name)]
+
+    if kernel == 'resize_and_pad_image':
+        decoded = Image.open(BytesIO(data))
+        decoded.load()
+
+        def call():
+            return make_numpy.resize_and_pad_image(decoded, target)
+    else:
+        try:
+            make_numpy.pipeline.fit_budget(Image.open(BytesIO(data)),
+                                           max_pixels=make_numpy.
+                                           MAX_IMAGE_PIXELS)
+        except make_numpy.pipeline.ImageTooLargeError:
+            # Over the pixel budget, convert_to_numpy refuses to decode it
+            return {'rejected': True}
+
+        def call():
+            return make_numpy.convert_to_numpy(data, grayscale, target)
+
+    gc.collect()
+    rss_at_start = _rss_kb()
+
+    # One traced call for allocations, then untraced calls for time
+    tracemalloc.start()
+    if call() is None:
+        raise RuntimeError(f"{kernel} failed")
+    traced_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        call()
+        timings.append(time.perf_counter() - started)
+
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    timings = np.asarray(timings) * 1000.0
+    return {
+        'min_ms': round(float(timings.min()), 3),
+        'median_ms': round(float(np.median(timings)), 3),
+        'traced_peak_mb': round(traced_peak / 2 ** 20, 2),
+        'rss_growth_mb': round(max(peak_rss - rss_at_start, 0) / 1024, 2)
+    }
+
+
+def run_suite(sizes, formats, targets, grayscale_options, kernels, repeat):
+    """Run every combination, each in its own forked child."""
+    make_numpy = load_module('make_numpy', 'numpy-convert/make_numpy.py')
+    # make_numpy logs every call at INFO, which is not what we measure
+    logging.getLogger().setLevel(logging.WARNING)
+
+    _state['make_numpy'] = make_numpy
+    _state['images'] = {
+        (size, format_name): synthesize_image(size, format_name)
+        for size, format_name in itertools.product(sizes, formats)}
+
+    results = {}
+    context = mp.get_context('fork')
+    for kernel, size, format_name, target, grayscale in itertools.product(
+            kernels, sizes, formats, targets, grayscale_options):
+        # resize_and_pad_image always returns RGB
+        if kernel == 'resize_and_pad_image' and grayscale:
+            continue
+        key = case_key(kernel, size, format_name, target, grayscale)
+        with context.Pool(1) as pool:
+            results[key] = pool.apply(
+                _run_case,
+                (kernel, size, format_name, target, grayscale, repeat))
+        if results[key].get('rejected'):
+            print(f"{key:<52} rejected, over MAX_IMAGE_PIXELS",
+                  file=sys.stderr)
+            continue
+        print(f"{key:<52} {results[key]['min_ms']:>10.2f} ms "
+              f"{results[key]['rss_growth_mb']:>8.1f} MB", file=sys.stderr)
+    return results
+
+
+def compare(results, baseline, threshold):
+    """
+    Get the metrics that grew by more than threshold over the baseline.
+
+    Returns:
+        list: (case, metric, baseline value, current value) tuples
+    """
+    regressions = []
+    for key, current in results.items():
+        previous = baseline.get(key)
+        if previous is None or previous.get('rejected') or \
+                current.get('rejected'):
+            continue
+        # min_ms is the least noisy time on a shared machine
+        for metric in ('min_ms', 'traced_peak_mb', 'rss_growth_mb'):
+            # Ignore noise on values too small to matter
+            floor = 1.0 if metric == 'min_ms' else 0.5
+            if current[metric] > max(previous[metric], floor) * \
+                    (1 + threshold):
+                regressions.append((key, metric, previous[metric],
+                                    current[metric]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--sizes', nargs='+', choices=list(SIZES),
+                        default=list(SIZES))
+    parser.add_argument('--formats', nargs='+', choices=list(FORMATS),
+                        default=list(FORMATS))
+    parser.add_argument('--targets', nargs='+', type=int,
+                        default=list(DEFAULT_TARGETS),
+                        help="DEFAULT_TARGET_PIXELS values to sweep")
+    parser.add_argument('--grayscale', nargs='+', type=int, choices=(0, 1),
+                        default=[0, 1], help="TO_GRAYSCALE values to sweep")
+    parser.add_argument('--kernels', nargs='+', choices=KERNELS,
+                        default=list(KERNELS))
+    parser.add_argument('--repeat', type=int, default=5,
+                        help="Timed calls per case")
+    parser.add_argument('--save', help="Write results as a baseline file")
+    parser.add_argument('--compare', help="Baseline file to compare with")
+    parser.add_argument('--threshold', type=float,
+                        default=DEFAULT_THRESHOLD,
+                        help="Allowed growth over the baseline, as a "
+                             "fraction")
+    args = parser.parse_args()
+
+    results = run_suite(args.sizes, args.formats, args.targets,
+                        [bool(g) for g in args.grayscale], args.kernels,
+                        args.repeat)
+    report = {
+        'environment': {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'pillow': Image.__version__,
+            'machine': platform.machine(),
+        },
+        'repeat': args.repeat,
+        'results': results
+    }
+
+    if args.save:
+        with open(args.save, 'w') as handle:
+            json.dump(report, handle, indent=2, sort_keys=True)
+
+    if not args.compare:
+        print(json.dumps(report, indent=2))
+        return 0
+
+    with open(args.compare) as handle:
+        baseline = json.load(handle)
+    regressions = compare(results, baseline['results'], args.threshold)
+    for key, metric, previous, current in regressions:
+        print(f"REGRESSION {key} {metric}: {previous} -> {current}")
+    print(f"{len(results)} cases, {len(regressions)} regressions "
+          f"(threshold {args.threshold:.0%})")
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,105 @@
+"""
+Throughput benchmark for the trainer's streaming loader and SGD loop.
+
+Runs the real StreamingBatchLoader and train() against an in-memory
+store of synthetic vectors, so no S3 bucket or database is needed.
+Sweeps loader process counts and batch sizes and reports samples per
+second and per-epoch time for each combination.
+
+    python benchmarks/train_throughput.py --side 128 --samples 2048
+"""
+import argparse
+import json
+import os
+import sys
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'trainer'))
+
+from modules.classifier import LogisticModel  # noqa: E402
+from modules.vectors import numpy_key  # noqa: E402
+from loader import StreamingBatchLoader  # noqa: E402
+from train import train  # noqa: E402
+
+# Filled before the loader forks, so workers inherit it for free
+_VECTORS = {}
+
+
+class SyntheticStore:
+    """get_object over pre-generated vectors, shaped like numpys/."""
+
+    def __init__(self, *args):
+        pass
+
+    def get_object(self, key):
+        return _VECTORS.get(key)
+
+
+def build_corpus(samples, n_features, distinct, seed):
+    """Create labeled rows backed by `distinct` reusable vectors."""
+    rng = np.random.default_rng(seed)
+    pool = [rng.random(n_features).tobytes() for _ in range(distinct)]
+    rows = []
+    for index in range(samples):
+        image_hash = f"synthetic{index:08d}"
+        _VECTORS[numpy_key(image_hash)] = pool[index % distinct]
+        rows.append((index + 1, image_hash, float(index % 2)))
+    return rows
+
+
+def run_case(rows, n_features, batch_size, processes, threads, epochs):
+    """Train for a few epochs and return the last epoch's numbers."""
+    loader = StreamingBatchLoader(SyntheticStore, (), n_features,
+                                  batch_size, processes=processes,
+                                  threads=threads)
+    try:
+        history = train(loader, LogisticModel.zeros(n_features), rows, [],
+                        epochs=epochs, batch_size=batch_size)
+    finally:
+        loader.close()
+    last = history[-1]
+    return {
+        'processes': processes,
+        'batch_size': batch_size,
+        'samples_per_second': last['samples_per_second'],
+        'epoch_seconds': last['seconds'],
+        'loader_wait_seconds': last['loader_wait_seconds']
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--side', type=int, default=128,
+                        help="Image side, vectors are side*side*3 long")
+    parser.add_argument('--samples', type=int, default=2048)
+    parser.add_argument('--distinct', type=int, default=64,
+                        help="Distinct vectors to generate")
+    parser.add_argument('--processes', type=int, nargs='+',
+                        default=[1, 2, 4])
+    parser.add_argument('--batch-sizes', type=int, nargs='+',
+                        default=[32, 128])
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--epochs', type=int, default=2)
+    parser.add_argument('--output', help="Write results to this JSON file")
+    args = parser.parse_args()
+
+    n_features = args.side * args.side * 3
+    rows = build_corpus(args.samples, n_features, args.distinct, seed=0)
+
+    results = [run_case(rows, n_features, batch_size, processes,
+                        args.threads, args.epochs)
+               for batch_size in args.batch_sizes
+               for processes in args.processes]
+
+    report = {'n_features': n_features, 'samples': args.samples,
+              'results': results}
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w') as handle:
+            json.dump(report, handle, indent=2)
+
+
+if __name__ == '__main__':
+    main()
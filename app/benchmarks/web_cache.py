@@ -0,0 +1,264 @@
+"""
+HTTP caching benchmark for the web tier: requests that reach Flask,
+database statements and bytes sent, with and without caching, for the
+same simulated traffic.
+
+Traffic is replayed through the Flask test client on a simulated clock:
+ALB health checks, new visitors loading the labeling page and its static
+files, dashboards polling /api/stats, exporters paging /api/images and
+labels written through /api/labels (which clear the response cache).
+
+The proxy cache follows the rules in proxy/default.conf.tpl, so nginx is
+not needed: /health is kept 5 seconds and /static/ for the max-age Flask
+sends. Browsers keep static files for their max-age and, with caching
+on, revalidate JSON with If-None-Match. The uncached run replays the old
+setup: no proxy cache, no response cache, no ETags, and the 1 year
+expiry nginx used to add to every static file.
+
+    python benchmarks/web_cache.py --seconds 600 --dashboards 10
+    python benchmarks/web_cache.py --database-url postgresql://...
+"""
+import argparse
+import json
+import random
+import re
+
+from sqlalchemy import event
+
+from emulator import load_web_app
+
+STATIC_URL = re.compile(r'(?:src|href)="(/static/[^"]+)"')
+MAX_AGE = re.compile(r'max-age=(\d+)')
+# The old nginx config sent every static file with expires 1y
+OLD_STATIC_MAX_AGE = 365 * 24 * 3600
+
+# Proxy cache rules from default.conf.tpl: path prefix -> seconds kept
+# when the response has no max-age of its own
+PROXY_RULES = {'/health': 5, '/static/': 600}
+
+
+class Clock:
+    """Simulated time in seconds, for the response cache."""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def max_age(headers):
+    """Seconds a response may be reused, 0 for no-cache."""
+    cache_control = headers.get('Cache-Control', '')
+    if 'no-cache' in cache_control or 'no-store' in cache_control:
+        return 0
+    match = MAX_AGE.search(cache_control)
+    return int(match.group(1)) if match else 0
+
+
+class Proxy:
+    """The nginx layer: caches GETs the PROXY_RULES cover."""
+
+    def __init__(self, client, clock, stats, enabled):
+        self.client = client
+        self.clock = clock
+        self.stats = stats
+        self.enabled = enabled
+        self.cache = {}
+
+    def request(self, path, method='GET', headers=None, json_body=None):
+        """
+        Returns:
+            tuple: (status code, headers dict, body bytes)
+        """
+        self.stats['client_requests'] += 1
+        rule = next((ttl for prefix, ttl in PROXY_RULES.items()
+                     if path.startswith(prefix)), None)
+        cacheable = self.enabled and method == 'GET' and rule is not None
+        if cacheable:
+            entry = self.cache.get(path)
+            if entry is not None and entry[0] > self.clock():
+                self.stats['proxy_hits'] += 1
+                return self._sent(entry[1])
+
+        response = self.client.open(path, method=method,
+                                    headers=headers or {}, json=json_body)
+        self.stats['upstream_requests'] += 1
+        result = (response.status_code, dict(response.headers),
+                  response.get_data())
+        if cacheable and response.status_code == 200:
+            ttl = max_age(response.headers) or rule
+            self.cache[path] = (self.clock() + ttl, result)
+        return self._sent(result)
+
+    def _sent(self, result):
+        self.stats['bytes_sent'] += len(result[2])
+        if result[0] == 304:
+            self.stats['not_modified'] += 1
+        return result
+
+
+class Browser:
+    """One client with its own HTTP cache."""
+
+    def __init__(self, proxy, clock, use_etags, old_static_headers):
+        self.proxy = proxy
+        self.clock = clock
+        self.use_etags = use_etags
+        self.old_static_headers = old_static_headers
+        self.cache = {}
+
+    def get(self, path):
+        """GET path, from the browser cache while it is fresh."""
+        entry = self.cache.get(path)
+        if entry is not None and entry['expires'] > self.clock():
+            self.proxy.stats['browser_hits'] += 1
+            return entry['body']
+        headers = {}
+        if self.use_etags and entry is not None and entry['etag']:
+            headers['If-None-Match'] = entry['etag']
+
+        status, response_headers, body = self.proxy.request(path,
+                                                            headers=headers)
+        if status == 304:
+            entry['expires'] = self.clock() + max_age(response_headers)
+            return entry['body']
+        if status == 200:
+            ttl = OLD_STATIC_MAX_AGE if self.old_static_headers and \
+                path.startswith('/static/') else max_age(response_headers)
+            self.cache[path] = {'expires': self.clock() + ttl,
+                                'etag': response_headers.get('ETag'),
+                                'body': body}
+        return body
+
+
+def seed_database(web, rows):
+    """Fill an empty local database with unlabeled images."""
+    with web.app.app_context():
+        session = web.db.session
+        if session.query(web.Image_table_base).count() == 0:
+            session.add_all([
+                web.Image_table_base(file_name=f"{index:032x}.jpg",
+                                     hash=f"{index:032x}")
+                for index in range(rows)])
+            session.add(web.Label_counter_base(counter_name='total',
+                                               value=rows))
+            session.commit()
+        return [row[0] for row in
+                session.query(web.Image_table_base.file_name)]
+
+
+def run_traffic(web, file_names, cached, args):
+    """Replay args.seconds of traffic and count what each layer did."""
+    stats = dict.fromkeys(
+        ('client_requests', 'browser_hits', 'proxy_hits',
+         'upstream_requests', 'not_modified', 'bytes_sent',
+         'db_statements'), 0)
+    clock = Clock()
+    rng = random.Random(args.seed)
+    web.response_cache.ttl = args.response_cache_ttl if cached else 0
+    web.response_cache.clock = clock
+    web.response_cache.clear()
+    web.file_name_cache.clear()
+
+    with web.app.app_context():
+        engine = web.db.engine
+
+    def count_statement(*_):
+        stats['db_statements'] += 1
+    event.listen(engine, 'before_cursor_execute', count_statement)
+
+    proxy = Proxy(web.app.test_client(), clock, stats, enabled=cached)
+
+    def browser():
+        return Browser(proxy, clock, use_etags=cached,
+                       old_static_headers=not cached)
+
+    dashboards = [browser() for _ in range(args.dashboards)]
+    exporters = [browser() for _ in range(args.exporters)]
+    try:
+        for second in range(args.seconds):
+            clock.now = float(second)
+            for checker in range(args.health_checkers):
+                if (second + checker) % args.health_interval == 0:
+                    proxy.request('/health')
+
+            for _ in range(args.visitors_per_minute // 60 +
+                           (rng.random() < args.visitors_per_minute
+                            % 60 / 60)):
+                visitor = browser()
+                page = visitor.get('/').decode()
+                for static_path in STATIC_URL.findall(page):
+                    visitor.get(static_path.replace('&amp;', '&'))
+
+            if second % args.poll_interval == 0:
+                for dashboard in dashboards:
+                    dashboard.get('/api/stats')
+
+            if second % args.export_interval == 0:
+                for exporter in exporters:
+                    after_id = 0
+                    while after_id is not None:
+                        page = json.loads(exporter.get(
+                            f"/api/images?after_id={after_id}&limit=100"))
+                        after_id = page['next_after_id']
+
+            if rng.random() < args.labels_per_second:
+                proxy.request('/api/labels', method='POST', json_body={
+                    'labels': [{'file_name': rng.choice(file_names),
+                                'label': rng.choice(('male', 'female'))}]})
+    finally:
+        event.remove(engine, 'before_cursor_execute', count_statement)
+
+    stats['upstream_per_second'] = round(
+        stats['upstream_requests'] / args.seconds, 2)
+    stats['response_cache'] = web.response_cache.stats()
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--seconds', type=int, default=600,
+                        help="Simulated seconds of traffic")
+    parser.add_argument('--rows', type=int, default=2000,
+                        help="Images in the local database")
+    parser.add_argument('--health-checkers', type=int, default=3)
+    parser.add_argument('--health-interval', type=int, default=5)
+    parser.add_argument('--visitors-per-minute', type=int, default=6)
+    parser.add_argument('--dashboards', type=int, default=5)
+    parser.add_argument('--poll-interval', type=int, default=2)
+    parser.add_argument('--exporters', type=int, default=1)
+    parser.add_argument('--export-interval', type=int, default=60)
+    parser.add_argument('--labels-per-second', type=float, default=0.5)
+    parser.add_argument('--response-cache-ttl', type=float, default=5.0)
+    parser.add_argument('--database-url', default='sqlite://',
+                        help="SQLAlchemy URL, in-memory SQLite by default")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="Write the report to this file")
+    args = parser.parse_args()
+
+    web = load_web_app(args.database_url)
+    file_names = seed_database(web, args.rows)
+    uncached = run_traffic(web, file_names, False, args)
+    cached = run_traffic(web, file_names, True, args)
+    report = {
+        'seconds': args.seconds,
+        'uncached': uncached,
+        'cached': cached,
+        'upstream_reduction': round(
+            1 - cached['upstream_requests'] / uncached['upstream_requests'],
+            3),
+        'db_statement_reduction': round(
+            1 - cached['db_statements'] / uncached['db_statements'], 3)
+        if uncached['db_statements'] else 0,
+        'bytes_reduction': round(
+            1 - cached['bytes_sent'] / uncached['bytes_sent'], 3)
+    }
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w') as handle:
+            json.dump(report, handle, indent=2)
+
+
+if __name__ == '__main__':
+    main()
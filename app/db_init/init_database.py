@@ -73,6 +73,485 @@ def create_images_table(engine):
         return False
 
 
+def create_label_counters(engine):
+    """
+    Create the label_counters table and the trigger that maintains it.
+
+    Each images row maps to a set of counter names. After every statement
+    on images the triggers sum how its rows moved between sets and update
+    each changed counter once, so /api/stats reads a handful of rows
+    instead of running COUNT(*) over images, and a bulk write takes the
+    counter locks once, in counter_name order.
+    The counters are reseeded from a single scan while images is locked
+    against writes, so the seed and the trigger can not drift. Flagged
+    near-duplicates count as 'duplicate' only, so 'trashed' stays the
+    human trash label. Runs after create_phash_index, which adds
+    duplicate_of.
+    """
+    try:
+        with engine.connect() as conn:
+            conn.execute(text("""
+                CREATE TABLE IF NOT EXISTS label_counters (
+                    counter_name VARCHAR(32) PRIMARY KEY,
+                    value BIGINT NOT NULL DEFAULT 0
+                );
+            """))
+
+            # Map one row's state to the counters it contributes to
+            conn.execute(text("""
+                CREATE OR REPLACE FUNCTION label_counter_keys(
+                    row_deleted_at TIMESTAMP,
+                    row_is_masc_human BOOLEAN,
+                    row_is_masc_prediction BOOLEAN,
+                    row_duplicate_of INTEGER
+                )
+                RETURNS TEXT[] AS $$
+                BEGIN
+                    IF row_deleted_at IS NOT NULL THEN
+                        RETURN ARRAY['total', 'trashed'];
+                    END IF;
+                    IF row_duplicate_of IS NOT NULL THEN
+                        RETURN ARRAY['total', 'duplicate'];
+                    END IF;
+                    IF row_is_masc_human IS NULL THEN
+                        RETURN ARRAY['total', 'unclassified'];
+                    END IF;
+                    RETURN array_remove(ARRAY[
+                        'total',
+                        CASE WHEN row_is_masc_human
+                             THEN 'masculine' ELSE 'feminine' END,
+                        CASE WHEN row_is_masc_prediction IS NULL THEN NULL
+                             WHEN row_is_masc_prediction = row_is_masc_human
+                             THEN 'agree' ELSE 'disagree' END
+                    ], NULL);
+                END;
+                $$ LANGUAGE plpgsql IMMUTABLE;
+            """))
+
+            # Statement-level, so a bulk write sums its rows' moves and
+            # updates each counter once. INSERT has only new_rows, DELETE
+            # only old_rows.
+            conn.execute(text("""
+                CREATE OR REPLACE FUNCTION maintain_label_counters()
+                RETURNS TRIGGER AS $$
+                DECLARE
+                    keys TEXT[];
+                    deltas BIGINT[];
+                BEGIN
+                    IF TG_OP = 'INSERT' THEN
+                        SELECT array_agg(key), array_agg(n)
+                        INTO keys, deltas
+                        FROM (
+                            SELECT key, count(*) AS n
+                            FROM new_rows, unnest(label_counter_keys(
+                                new_rows.deleted_at, new_rows.is_masc_human,
+                                new_rows.is_masc_prediction,
+                                new_rows.duplicate_of)) AS key
+                            GROUP BY key
+                        ) AS changes;
+                    ELSIF TG_OP = 'DELETE' THEN
+                        SELECT array_agg(key), array_agg(n)
+                        INTO keys, deltas
+                        FROM (
+                            SELECT key, -count(*) AS n
+                            FROM old_rows, unnest(label_counter_keys(
+                                old_rows.deleted_at, old_rows.is_masc_human,
+                                old_rows.is_masc_prediction,
+                                old_rows.duplicate_of)) AS key
+                            GROUP BY key
+                        ) AS changes;
+                    ELSE
+                        SELECT array_agg(key), array_agg(n)
+                        INTO keys, deltas
+                        FROM (
+                            SELECT key, sum(delta) AS n
+                            FROM (
+                                SELECT key, -1 AS delta
+                                FROM old_rows, unnest(label_counter_keys(
+                                    old_rows.deleted_at,
+                                    old_rows.is_masc_human,
+                                    old_rows.is_masc_prediction,
+                                    old_rows.duplicate_of)) AS key
+                                UNION ALL
+                                SELECT key, 1 AS delta
+                                FROM new_rows, unnest(label_counter_keys(
+                                    new_rows.deleted_at,
+                                    new_rows.is_masc_human,
+                                    new_rows.is_masc_prediction,
+                                    new_rows.duplicate_of)) AS key
+                            ) AS moves
+                            GROUP BY key
+                            HAVING sum(delta) <> 0
+                        ) AS changes;
+                    END IF;
+                    IF keys IS NULL THEN
+                        RETURN NULL;
+                    END IF;
+
+                    -- Lock every counter in name order, not only the
+                    -- changed ones, so transactions that change counters
+                    -- over several statements still lock in one order
+                    -- and can not deadlock
+                    PERFORM 1 FROM label_counters
+                    ORDER BY counter_name FOR UPDATE;
+                    UPDATE label_counters SET value = value + changes.n
+                    FROM unnest(keys, deltas) AS changes (key, n)
+                    WHERE counter_name = changes.key;
+                    RETURN NULL;
+                END;
+                $$ LANGUAGE plpgsql;
+            """))
+
+            # Transition tables need one trigger per event and can not
+            # be limited to columns, so every UPDATE statement fires it
+            conn.execute(text("""
+                DROP TRIGGER IF EXISTS label_counters_trigger ON images;
+                DROP TRIGGER IF EXISTS label_counters_insert ON images;
+                CREATE TRIGGER label_counters_insert
+                    AFTER INSERT ON images
+                    REFERENCING NEW TABLE AS new_rows
+                    FOR EACH STATEMENT
+                    EXECUTE FUNCTION maintain_label_counters();
+                DROP TRIGGER IF EXISTS label_counters_update ON images;
+                CREATE TRIGGER label_counters_update
+                    AFTER UPDATE ON images
+                    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+                    FOR EACH STATEMENT
+                    EXECUTE FUNCTION maintain_label_counters();
+                DROP TRIGGER IF EXISTS label_counters_delete ON images;
+                CREATE TRIGGER label_counters_delete
+                    AFTER DELETE ON images
+                    REFERENCING OLD TABLE AS old_rows
+                    FOR EACH STATEMENT
+                    EXECUTE FUNCTION maintain_label_counters();
+            """))
+            # The signature before duplicate_of was counted
+            conn.execute(text("""
+                DROP FUNCTION IF EXISTS
+                    label_counter_keys(TIMESTAMP, BOOLEAN, BOOLEAN);
+            """))
+
+            refresh_label_counters(conn)
+            conn.commit()
+            logger.info("Label counters table and triggers created")
+            return True
+
+    except SQLAlchemyError as e:
+        logger.error(f"Error creating label counters: {e}")
+        return False
+
+
+def refresh_label_counters(conn):
+    """Recompute every label counter from images in the open transaction"""
+    # Block writers so no trigger update lands between scan and store
+    conn.execute(text("LOCK TABLE images IN SHARE ROW EXCLUSIVE MODE;"))
+    conn.execute(text("""
+        INSERT INTO label_counters (counter_name, value)
+        SELECT name, 0 FROM unnest(ARRAY['total', 'unclassified',
+            'masculine', 'feminine', 'trashed', 'duplicate', 'agree',
+            'disagree']) AS name
+        ON CONFLICT (counter_name) DO NOTHING;
+    """))
+    conn.execute(text("""
+        UPDATE label_counters SET value = COALESCE(counts.n, 0)
+        FROM label_counters AS c
+        LEFT JOIN (
+            SELECT key, count(*) AS n
+            FROM images, unnest(label_counter_keys(
+                deleted_at, is_masc_human, is_masc_prediction,
+                duplicate_of)) AS key
+            GROUP BY key
+        ) AS counts ON counts.key = c.counter_name
+        WHERE label_counters.counter_name = c.counter_name;
+    """))
+
+
+def add_prediction_tracking(engine):
+    """
+    Add the columns batch inference uses to find stale predictions.
+
+    A prediction is stale when prediction_model_version differs from the
+    version of the model being run, which includes never predicted rows.
+    """
+    try:
+        with engine.connect() as conn:
+            conn.execute(text("""
+                ALTER TABLE images
+                    ADD COLUMN IF NOT EXISTS
+                        prediction_model_version VARCHAR(64) NULL,
+                    ADD COLUMN IF NOT EXISTS
+                        predicted_at TIMESTAMP NULL;
+            """))
+            conn.commit()
+            logger.info("Prediction tracking columns added")
+            return True
+
+    except SQLAlchemyError as e:
+        logger.error(f"Error adding prediction tracking columns: {e}")
+        return False
+
+
+def create_uncertainty_queue(engine):
+    """
+    Add prediction_confidence and the index the labeling queue reads.
+
+    Confidence is |2p - 1| for the predicted probability p, so the most
+    uncertain rows sort first. The partial index only holds unlabeled,
+    untrashed rows with a prediction, and rows leave it as soon as they
+    are labeled, so taking the head of the queue is a short index scan.
+    """
+    try:
+        with engine.connect() as conn:
+            conn.execute(text("""
+                ALTER TABLE images
+                    ADD COLUMN IF NOT EXISTS prediction_confidence REAL NULL;
+            """))
+            conn.execute(text("""
+                CREATE INDEX IF NOT EXISTS images_uncertainty_queue_idx
+                    ON images (prediction_confidence)
+                    WHERE is_masc_human IS NULL
+                      AND deleted_at IS NULL
+                      AND prediction_confidence IS NOT NULL;
+            """))
+            conn.commit()
+            logger.info("Uncertainty queue column and index created")
+            return True
+
+    except SQLAlchemyError as e:
+        logger.error(f"Error creating uncertainty queue: {e}")
+        return False
+
+
+def create_phash_index(engine):
+    """
+    Add perceptual hash columns and the multi-index hashing indexes.
+
+    phash holds the signed 64-bit dHash of the image. One expression
+    index per 16-bit band lets near-duplicate lookup run as four index
+    probes rather than a scan. duplicate_of points a flagged
+    near-duplicate at the image it matched.
+    """
+    try:
+        with engine.connect() as conn:
+            conn.execute(text("""
+                ALTER TABLE images
+                    ADD COLUMN IF NOT EXISTS phash BIGINT NULL,
+                    ADD COLUMN IF NOT EXISTS duplicate_of INTEGER NULL
+                        REFERENCES images (id) ON DELETE SET NULL;
+            """))
+            for band in range(4):
+                conn.execute(text(f"""
+                    CREATE INDEX IF NOT EXISTS images_phash_band{band}_idx
+                        ON images (((phash >> {band * 16}) & 65535))
+                        WHERE phash IS NOT NULL;
+                """))
+            conn.commit()
+            logger.info("Perceptual hash columns and indexes created")
+            return True
+
+    except SQLAlchemyError as e:
+        logger.error(f"Error creating perceptual hash index: {e}")
+        return False
+
+
+def create_processing_ledger(engine):
+    """
+    Create the processing_ledger table.
+
+    One row per (stage, S3 key, ETag) the ingest handlers have finished
+    with, so a redelivered S3 event costs one primary key lookup.
+    """
+    try:
+        with engine.connect() as conn:
+            conn.execute(text("""
+                CREATE TABLE IF NOT EXISTS processing_ledger (
+                    stage VARCHAR(64) NOT NULL,
+                    object_key VARCHAR(1024) NOT NULL,
+                    etag VARCHAR(128) NOT NULL,
+                    pipeline_version VARCHAR(64) NULL,
+                    output_key VARCHAR(1024) NULL,
+                    status VARCHAR(64) NOT NULL,
+                    processed_at TIMESTAMP NOT NULL DEFAULT now(),
+                    PRIMARY KEY (stage, object_key, etag)
+                );
+            """))
+            conn.commit()
+            logger.info("Processing ledger table created")
+            return True
+
+    except SQLAlchemyError as e:
+        logger.error(f"Error creating processing ledger: {e}")
+        return False
+
+
+def create_hash_index(engine):
+    """
+    Index images.hash, so the upload API can check for an existing
+    copy of an image before it issues an upload URL.
+    """
+    try:
+        with engine.connect() as conn:
+            conn.execute(text("""
+                CREATE INDEX IF NOT EXISTS images_hash_idx
+                    ON images (hash);
+            """))
+            conn.commit()
+            logger.info("Hash index created")
+            return True
+
+    except SQLAlchemyError as e:
+        logger.error(f"Error creating hash index: {e}")
+        return False
+
+
+def create_label_events(engine):
+    """
+    Create the append-only label_events table and the
+    images.label_event_id and images.labeled_at columns compaction
+    tracks its progress in.
+
+    The web app appends one row per label; the compaction job folds
+    them into images.is_masc_human and images.deleted_at.
+    """
+    try:
+        with engine.connect() as conn:
+            conn.execute(text("""
+                CREATE TABLE IF NOT EXISTS label_events (
+                    id BIGSERIAL PRIMARY KEY,
+                    image_id INTEGER NOT NULL
+                        REFERENCES images (id) ON DELETE CASCADE,
+                    label VARCHAR(16) NOT NULL
+                        CHECK (label IN ('male', 'female', 'trash')),
+                    labeler VARCHAR(64) NULL,
+                    created_at TIMESTAMP NOT NULL DEFAULT now(),
+                    compacted_at TIMESTAMP NULL
+                );
+            """))
+            # History of one image, and inter-labeler agreement
+            conn.execute(text("""
+                CREATE INDEX IF NOT EXISTS label_events_image_idx
+                    ON label_events (image_id, id);
+            """))
+            # Small by design: only events compaction has not folded yet
+            conn.execute(text("""
+                CREATE INDEX IF NOT EXISTS label_events_pending_idx
+                    ON label_events (id) WHERE compacted_at IS NULL;
+            """))
+            conn.execute(text("""
+                ALTER TABLE images
+                    ADD COLUMN IF NOT EXISTS label_event_id BIGINT NULL,
+                    ADD COLUMN IF NOT EXISTS labeled_at TIMESTAMP NULL;
+            """))
+            conn.commit()
+            logger.info("Label events table created")
+            return True
+
+    except SQLAlchemyError as e:
+        logger.error(f"Error creating label events: {e}")
+        return False
+
+
+def create_image_claims(engine):
+    """
+    Create the image_claims table of labeling leases, and the random
+    sample_key column and partial index the claim query walks.
+
+    A web worker claims a batch of unlabeled images before serving them,
+    so no other worker serves the same images until the lease expires.
+    """
+    try:
+        with engine.connect() as conn:
+            conn.execute(text("""
+                CREATE TABLE IF NOT EXISTS image_claims (
+                    image_id INTEGER PRIMARY KEY
+                        REFERENCES images (id) ON DELETE CASCADE,
+                    worker VARCHAR(64) NOT NULL,
+                    claimed_at TIMESTAMP NOT NULL DEFAULT now(),
+                    expires_at TIMESTAMP NOT NULL
+                );
+            """))
+            # A uniform random key per image, drawn by the database for
+            # new rows and backfilled for existing ones. Random claims
+            # walk it instead of ids, so what labelers get follows
+            # neither upload order nor the runs already labeled.
+            conn.execute(text("""
+                ALTER TABLE images
+                    ADD COLUMN IF NOT EXISTS sample_key DOUBLE PRECISION;
+                ALTER TABLE images
+                    ALTER COLUMN sample_key SET DEFAULT random();
+                UPDATE images SET sample_key = random()
+                WHERE sample_key IS NULL;
+            """))
+            # Claimable rows in sample_key order, so a claim starting at a
+            # random key reads only the rows it hands out
+            conn.execute(text("""
+                DROP INDEX IF EXISTS images_unlabeled_idx;
+                CREATE INDEX IF NOT EXISTS images_unclaimed_sample_idx
+                    ON images (sample_key)
+                    WHERE is_masc_human IS NULL AND deleted_at IS NULL
+                      AND duplicate_of IS NULL;
+            """))
+            conn.commit()
+            logger.info("Image claims table created")
+            return True
+
+    except SQLAlchemyError as e:
+        logger.error(f"Error creating image claims: {e}")
+        return False
+
+
+def untrash_flagged_duplicates(engine):
+    """
+    Take near-duplicates flagged at ingest out of the trash.
+
+    Ingest used to flag a near-duplicate by trashing it, which counted it
+    as 'trashed' next to the human trash label. It is now flagged by
+    duplicate_of alone. Rows no label was ever applied to can only have
+    been trashed by ingest, so only those are restored.
+    """
+    try:
+        with engine.connect() as conn:
+            result = conn.execute(text("""
+                UPDATE images SET deleted_at = NULL
+                WHERE duplicate_of IS NOT NULL
+                  AND deleted_at IS NOT NULL
+                  AND label_event_id IS NULL
+                  AND labeled_at IS NULL;
+            """))
+            conn.commit()
+            logger.info(f"Restored {result.rowcount} flagged near-duplicates "
+                        f"from the trash")
+            return True
+
+    except SQLAlchemyError as e:
+        logger.error(f"Error restoring flagged near-duplicates: {e}")
+        return False
+
+
+# Schema added after the images table, applied in order on every run.
+# Each must be idempotent and return True on success.
+SCHEMA_EXTENSIONS = [
+    add_prediction_tracking,
+    create_uncertainty_queue,
+    create_phash_index,
+    create_label_counters,
+    create_processing_ledger,
+    create_hash_index,
+    create_label_events,
+    create_image_claims,
+    untrash_flagged_duplicates,
+]
+
+
+def apply_schema_extensions(engine):
+    """Apply every schema extension, returning the names that failed"""
+    failed = []
+    for extension in SCHEMA_EXTENSIONS:
+        if not extension(engine):
+            failed.append(extension.__name__)
+    return failed
+
+
 def verify_database_setup(engine):
     """Verify that the database setup is correct"""
     try:
@@ -150,11 +629,13 @@ def lambda_handler(event, context):
             logger.info("Images table already exists, verifying setup...")
             if verify_database_setup(engine):
                 logger.info("Database is already properly initialized")
+                failed = apply_schema_extensions(engine)
                 return {
-                    'statusCode': 200,
+                    'statusCode': 500 if failed else 200,
                     'body': json.dumps({
                         'message': 'Database already initialized',
-                        'action': 'verification_completed'
+                        'action': 'verification_completed',
+                        'failed_extensions': failed
                     })
                 }
             else:
@@ -166,11 +647,13 @@ def lambda_handler(event, context):
             # Verify the setup
             if verify_database_setup(engine):
                 logger.info("Database initialization completed successfully")
+                failed = apply_schema_extensions(engine)
                 return {
-                    'statusCode': 200,
+                    'statusCode': 500 if failed else 200,
                     'body': json.dumps({
                         'message': 'Database initialized successfully',
-                        'action': 'created_and_verified'
+                        'action': 'created_and_verified',
+                        'failed_extensions': failed
                     })
                 }
             else:
@@ -0,0 +1,158 @@
+"""
+Image claim model for the image_claims table.
+A web worker claims a batch of unlabeled images before it serves them.
+Until the lease expires no other worker can claim the same images, so
+two labelers are never shown the same image at the same time.
+"""
+
+import random
+
+from sqlalchemy import Column, Integer, String, TIMESTAMP, func, text
+
+from .image_table_base import Base, Image_table_base
+
+# Claims up to :limit unlabeled images nobody holds a lease on. Rows are
+# locked with SKIP LOCKED, so concurrent claims take disjoint rows
+# instead of waiting for each other, and the ON CONFLICT guard keeps a
+# row that another claim committed meanwhile from being taken twice.
+# {where} and {order} pick which unlabeled rows are claimed first.
+CLAIM_SQL = """
+    WITH candidates AS (
+        SELECT i.id FROM images i
+        WHERE i.is_masc_human IS NULL AND i.deleted_at IS NULL
+          AND i.duplicate_of IS NULL
+          AND {where}
+          AND NOT EXISTS (
+              SELECT 1 FROM image_claims c
+              WHERE c.image_id = i.id AND c.expires_at > now())
+        ORDER BY {order}
+        LIMIT :limit
+        FOR UPDATE OF i SKIP LOCKED
+    ), claimed AS (
+        INSERT INTO image_claims AS c (image_id, worker, expires_at)
+        SELECT id, :worker, now() + make_interval(secs => :lease)
+        FROM candidates
+        ON CONFLICT (image_id) DO UPDATE SET
+            worker = EXCLUDED.worker,
+            claimed_at = now(),
+            expires_at = EXCLUDED.expires_at
+        WHERE c.expires_at <= now()
+        RETURNING c.image_id
+    )
+    SELECT i.file_name FROM images i JOIN claimed ON claimed.image_id = i.id
+"""
+
+# Random mode walks images_unclaimed_sample_idx from a random sample_key,
+# so workers start in different places and read only the rows they claim.
+# sample_key is drawn uniformly when a row is inserted, so the rows after
+# any start form a random sample that does not follow upload order.
+CLAIM_FROM_SQL = text(CLAIM_SQL.format(
+    where="i.sample_key >= :start_key", order="i.sample_key"))
+# Uncertainty mode walks images_uncertainty_queue_idx from the least
+# confident prediction
+CLAIM_UNCERTAIN_SQL = text(CLAIM_SQL.format(
+    where="i.prediction_confidence IS NOT NULL",
+    order="i.prediction_confidence"))
+
+CLAIM_ORDERS = ('random', 'uncertainty')
+
+
+class Image_claim_base(Base):
+    """
+    Model for the 'image_claims' table.
+
+    Columns:
+    - image_id: INTEGER PRIMARY KEY, references images(id)
+    - worker: VARCHAR(64) id of the web worker holding the lease
+    - claimed_at: TIMESTAMP when the lease was taken
+    - expires_at: TIMESTAMP after which any worker may claim the image
+    """
+
+    __tablename__ = 'image_claims'
+    __table_args__ = {'extend_existing': True}
+
+    image_id = Column(Integer, primary_key=True)
+    worker = Column(String(64), nullable=False)
+    claimed_at = Column(TIMESTAMP, nullable=False,
+                        server_default=func.now())
+    expires_at = Column(TIMESTAMP, nullable=False)
+
+    def __repr__(self):
+        """String representation of the claim."""
+        return f'<Image_claim {self.image_id} by {self.worker} ' \
+               f'until {self.expires_at}>'
+
+    @classmethod
+    def claim(cls, session, worker, limit=10, lease=600,
+              order='random') -> list:
+        """
+        Claim up to limit unlabeled images for worker (PostgreSQL).
+
+        Args:
+            session: SQLAlchemy session
+            worker (str): Id of the claiming web worker
+            limit (int): Batch size
+            lease (float): Seconds before the claims expire
+            order (str): One of CLAIM_ORDERS. 'uncertainty' claims the
+                         least confident predictions first and falls back
+                         to random once none are left
+
+        Returns:
+            list: File names of the claimed images
+        """
+        if order not in CLAIM_ORDERS:
+            raise ValueError(f"Unknown claim order '{order}'")
+        params = {'worker': worker, 'lease': lease}
+
+        names = []
+        if order == 'uncertainty':
+            names = cls._claim(session, CLAIM_UNCERTAIN_SQL,
+                               dict(params, limit=limit))
+        if len(names) < limit:
+            # Start at a random sample_key and wrap around to the lowest
+            for start in (random.random(), 0.0):
+                names += cls._claim(session, CLAIM_FROM_SQL, dict(
+                    params, limit=limit - len(names), start_key=start))
+                if len(names) == limit:
+                    break
+        return names
+
+    @classmethod
+    def _claim(cls, session, statement, params) -> list:
+        names = [row[0] for row in session.execute(statement, params)]
+        session.commit()
+        return names
+
+    @classmethod
+    def release(cls, session, worker, file_names) -> int:
+        """
+        Give back claims worker holds but will not serve, so other
+        workers can take the images at once.
+
+        Returns:
+            int: Claims released
+        """
+        if not file_names:
+            return 0
+        image_ids = session.query(Image_table_base.id).filter(
+            Image_table_base.file_name.in_(list(file_names)))
+        released = session.query(cls).filter(
+            cls.worker == worker,
+            cls.image_id.in_(image_ids.scalar_subquery())
+        ).delete(synchronize_session=False)
+        session.commit()
+        return released
+
+    @classmethod
+    def purge_expired(cls, session) -> int:
+        """
+        Delete expired claims. Claims are reused once they expire, so
+        this only keeps the table small.
+
+        Returns:
+            int: Claims deleted
+        """
+        purged = session.query(cls).filter(
+            cls.expires_at <= func.now()).delete(synchronize_session=False)
+        session.commit()
+        return purged
@@ -5,7 +5,7 @@ without manual column declarations.
 """
 
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import func, TIMESTAMP
+from sqlalchemy import func, or_, TIMESTAMP
 
 # This will be initialized in the main app
 db = SQLAlchemy()
@@ -21,6 +21,9 @@ class Image_table(db.Model):
     - is_masc_human: BOOLEAN (nullable)
     - is_masc_prediction: BOOLEAN (nullable)
     - hash: VARCHAR(255) NOT NULL (auto-populated by database trigger)
+    - deleted_at: TIMESTAMP (nullable, set when trashed)
+    - phash: BIGINT (nullable, signed 64-bit perceptual hash)
+    - duplicate_of: INTEGER (nullable, id of the image this near-duplicates)
 
     Custom attributes:
     - randoms: List for temporary data (not stored in database)
@@ -36,6 +39,8 @@ class Image_table(db.Model):
     is_masc_prediction = db.Column(db.Boolean, nullable=True)
     hash = db.Column(db.String(255), nullable=False)
     deleted_at = db.Column(TIMESTAMP, nullable=True, default=None)
+    phash = db.Column(db.BigInteger, nullable=True)
+    duplicate_of = db.Column(db.Integer, nullable=True)
 
     def __init__(self, *args, **kwargs):
         """Initialize the Image model with an empty randoms list."""
@@ -83,3 +88,39 @@ class Image_table(db.Model):
             raise ValueError(f"Image with file_name '{file_name}' not found")
 
         db.session.commit()
+
+    @classmethod
+    def find_near_duplicate(cls, session, phash: int, max_distance: int):
+        """
+        Find a stored image whose perceptual hash is within max_distance
+        bits of phash.
+
+        Each 16-bit band is matched exactly through its expression index
+        (images_phash_band*_idx), then the full Hamming distance is checked
+        on the few candidates. Recall is complete for max_distance below
+        the number of bands.
+
+        Returns:
+            tuple: (Image_table, distance) of the closest match, or
+                   (None, None)
+        """
+        # Imported here so the web app does not need numpy and Pillow
+        from modules.perceptual_hash import bands, hamming_distance, \
+            BAND_BITS, BAND_MASK
+
+        band_matches = [
+            (cls.phash.op('>>')(band * BAND_BITS)).op('&')(BAND_MASK) == value
+            for band, value in enumerate(bands(phash))
+        ]
+        candidates = session.query(cls).filter(
+            cls.phash.isnot(None),
+            or_(*band_matches)
+        ).all()
+
+        best, best_distance = None, None
+        for candidate in candidates:
+            distance = hamming_distance(candidate.phash, phash)
+            if distance <= max_distance and (
+                    best is None or distance < best_distance):
+                best, best_distance = candidate, distance
+        return best, best_distance
@@ -4,13 +4,28 @@ This model automatically reflects the database schema
 without manual column declarations.
 """
 
-from sqlalchemy import Column, Integer, String, Boolean
+import random
+from datetime import datetime, timezone
+
+from sqlalchemy import Column, Integer, BigInteger, String, Boolean, Float
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import func, TIMESTAMP
+from sqlalchemy import func, text, TIMESTAMP
 
 # This will be initialized in the main app
 Base = declarative_base()
 
+# Columns that may be requested through field projection
+PROJECTABLE_FIELDS = ('id', 'file_name', 'is_masc_human',
+                      'is_masc_prediction', 'hash', 'deleted_at')
+
+# Labels accepted by apply_labels: is_masc_human values, or trash
+LABEL_VALUES = {'male': True, 'female': False}
+LABELS = tuple(LABEL_VALUES) + ('trash',)
+
+# Named row filters accepted by filtered_query
+IMAGE_FILTERS = ('all', 'classified', 'unclassified', 'trashed', 'mismatch',
+                 'duplicate')
+
 
 class Image_table_base(Base):
     """
@@ -22,6 +37,19 @@ class Image_table_base(Base):
     - is_masc_human: BOOLEAN (nullable)
     - is_masc_prediction: BOOLEAN (nullable)
     - hash: VARCHAR(255) NOT NULL (auto-populated by database trigger)
+    - deleted_at: TIMESTAMP (nullable, set when trashed)
+    - prediction_model_version: VARCHAR(64) (nullable, model that wrote
+      is_masc_prediction)
+    - predicted_at: TIMESTAMP (nullable)
+    - prediction_confidence: REAL (nullable, |2p - 1| of the prediction)
+    - phash: BIGINT (nullable, signed 64-bit perceptual hash)
+    - duplicate_of: INTEGER (nullable, id of the image this near-duplicates;
+      such rows are never sampled, labeled or predicted)
+    - label_event_id: BIGINT (nullable, newest label_events row folded
+      into is_masc_human / deleted_at)
+    - labeled_at: TIMESTAMP (nullable, when the label it holds was given)
+    - sample_key: DOUBLE PRECISION (DEFAULT random(); not mapped, only
+      read by the claim query in image_claim_base)
 
     Custom attributes:
     - randoms: List for temporary data (not stored in database)
@@ -37,6 +65,13 @@ class Image_table_base(Base):
     is_masc_prediction = Column(Boolean, nullable=True)
     hash = Column(String(255), nullable=False)
     deleted_at = Column(TIMESTAMP, nullable=True, default=None)
+    prediction_model_version = Column(String(64), nullable=True)
+    predicted_at = Column(TIMESTAMP, nullable=True, default=None)
+    prediction_confidence = Column(Float, nullable=True)
+    phash = Column(BigInteger, nullable=True)
+    duplicate_of = Column(Integer, nullable=True)
+    label_event_id = Column(BigInteger, nullable=True)
+    labeled_at = Column(TIMESTAMP, nullable=True)
 
     def __init__(self, *args, **kwargs):
         """Initialize the Image model with an empty randoms list."""
@@ -55,27 +90,212 @@ class Image_table_base(Base):
             'is_masc_human': self.is_masc_human,
             'is_masc_prediction': self.is_masc_prediction,
             'hash': self.hash,
-            'random_files': self.random_files
+            # Rows loaded by a query skip __init__
+            'random_files': getattr(self, 'random_files', [])
         }
 
     @classmethod
     def get_random_unclassified(cls, session, limit=10):
-        """Get random samples of images where is_masc_human IS NULL
-        and deleted_at IS NULL"""
+        """Get random samples of images where is_masc_human IS NULL,
+        deleted_at IS NULL and duplicate_of IS NULL"""
         return session.query(cls).filter(
             cls.is_masc_human.is_(None),
-            cls.deleted_at.is_(None)
+            cls.deleted_at.is_(None),
+            cls.duplicate_of.is_(None)
         ).order_by(func.random()).limit(limit).all()
 
     @classmethod
     def get_random_classified(cls, session, limit=10):
         """Get random image samples where is_masc_human is
-        NOT NULL and deleted_at IS NULL."""
+        NOT NULL, deleted_at IS NULL and duplicate_of IS NULL."""
         return session.query(cls).filter(
             cls.is_masc_human.isnot(None),
-            cls.deleted_at.is_(None)
+            cls.deleted_at.is_(None),
+            cls.duplicate_of.is_(None)
         ).order_by(func.random()).limit(limit).all()
 
+    @classmethod
+    def filtered_query(cls, session, status='all', fields=None):
+        """
+        Build a query over images restricted by a named filter.
+
+        Args:
+            session: SQLAlchemy session to query with
+            status (str): One of IMAGE_FILTERS. 'classified', 'unclassified'
+                          and 'mismatch' exclude trashed rows and flagged
+                          near-duplicates, which 'duplicate' selects.
+            fields (list): Column names to project. All columns if None.
+
+        Returns:
+            Query: Unordered query yielding column tuples
+        """
+        if status not in IMAGE_FILTERS:
+            raise ValueError(f"Unknown image filter '{status}'")
+
+        fields = fields or PROJECTABLE_FIELDS
+        unknown = [f for f in fields if f not in PROJECTABLE_FIELDS]
+        if unknown:
+            raise ValueError(f"Unknown fields: {', '.join(unknown)}")
+
+        query = session.query(*[getattr(cls, f) for f in fields])
+
+        if status == 'classified':
+            query = query.filter(cls.is_masc_human.isnot(None),
+                                 cls.deleted_at.is_(None),
+                                 cls.duplicate_of.is_(None))
+        elif status == 'unclassified':
+            query = query.filter(cls.is_masc_human.is_(None),
+                                 cls.deleted_at.is_(None),
+                                 cls.duplicate_of.is_(None))
+        elif status == 'trashed':
+            query = query.filter(cls.deleted_at.isnot(None))
+        elif status == 'mismatch':
+            query = query.filter(cls.is_masc_human.isnot(None),
+                                 cls.is_masc_prediction.isnot(None),
+                                 cls.is_masc_human != cls.is_masc_prediction,
+                                 cls.deleted_at.is_(None),
+                                 cls.duplicate_of.is_(None))
+        elif status == 'duplicate':
+            query = query.filter(cls.duplicate_of.isnot(None))
+        return query
+
+    @classmethod
+    def keyset_page(cls, session, after_id=0, limit=100, status='all',
+                    fields=None):
+        """
+        Get one page of images with id greater than after_id.
+
+        Seeks on the primary key index instead of using OFFSET, so every
+        page costs the same no matter how deep into the table it is.
+        The id column is always fetched since it is the page cursor.
+
+        Returns:
+            tuple: (list of row dicts, next after_id or None when done)
+        """
+        fields = list(fields or PROJECTABLE_FIELDS)
+        if 'id' not in fields:
+            fields.insert(0, 'id')
+
+        rows = cls.filtered_query(session, status, fields).filter(
+            cls.id > after_id
+        ).order_by(cls.id).limit(limit).all()
+
+        page = [row._asdict() for row in rows]
+        next_after_id = page[-1]['id'] if len(page) == limit else None
+        return page, next_after_id
+
+    @classmethod
+    def stream_rows(cls, session, after_id=0, status='all', fields=None,
+                    batch_size=1000):
+        """
+        Yield row dicts for every matching image in id order.
+
+        Uses yield_per so the driver fetches through a server-side cursor
+        in batches of batch_size rather than buffering the whole result.
+        The id column is always fetched, so a stream can be resumed.
+        """
+        fields = list(fields or PROJECTABLE_FIELDS)
+        if 'id' not in fields:
+            fields.insert(0, 'id')
+        query = cls.filtered_query(session, status, fields).filter(
+            cls.id > after_id
+        ).order_by(cls.id).execution_options(yield_per=batch_size)
+
+        for row in query:
+            yield row._asdict()
+
+    @classmethod
+    def get_stale_predictions(cls, session, model_version, after_id=0,
+                              limit=1000):
+        """
+        Get (id, hash) pairs of live images whose prediction was not made
+        by model_version, in id order starting after after_id. Flagged
+        near-duplicates are never labeled, so they are not predicted.
+        """
+        return session.query(cls.id, cls.hash).filter(
+            cls.id > after_id,
+            cls.deleted_at.is_(None),
+            cls.duplicate_of.is_(None),
+            cls.prediction_model_version.is_distinct_from(model_version)
+        ).order_by(cls.id).limit(limit).all()
+
+    @classmethod
+    def get_labeled(cls, session, after_id=0, limit=10000):
+        """
+        Get (id, hash, is_masc_human) for live, human labeled images,
+        in id order starting after after_id.
+        """
+        return session.query(cls.id, cls.hash, cls.is_masc_human).filter(
+            cls.id > after_id,
+            cls.is_masc_human.isnot(None),
+            cls.deleted_at.is_(None)
+        ).order_by(cls.id).limit(limit).all()
+
+    @classmethod
+    def bulk_update_predictions(cls, session, ids, predictions, confidences,
+                                model_version) -> None:
+        """
+        Write a batch of predictions in a single UPDATE statement.
+
+        Args:
+            session: SQLAlchemy session (PostgreSQL)
+            ids (list): Image ids
+            predictions (list): is_masc prediction per id
+            confidences (list): Confidence in [0, 1] per id
+            model_version (str): Version of the model that made them
+        """
+        session.execute(text("""
+            UPDATE images
+            SET is_masc_prediction = batch.prediction,
+                prediction_confidence = batch.confidence,
+                prediction_model_version = :model_version,
+                predicted_at = now()
+            FROM unnest(CAST(:ids AS INTEGER[]),
+                        CAST(:predictions AS BOOLEAN[]),
+                        CAST(:confidences AS REAL[]))
+                AS batch(id, prediction, confidence)
+            WHERE images.id = batch.id
+        """), {
+            'ids': [int(i) for i in ids],
+            'predictions': [bool(p) for p in predictions],
+            'confidences': [float(c) for c in confidences],
+            'model_version': model_version
+        })
+        session.commit()
+
+    @classmethod
+    def get_most_uncertain(cls, session, limit=10, window=50):
+        """
+        Get unclassified images the model is least confident about.
+
+        Reads the head of images_uncertainty_queue_idx, then samples limit
+        rows from the first window entries so that several web workers do
+        not all serve the exact same images.
+        """
+        candidates = session.query(cls).filter(
+            cls.is_masc_human.is_(None),
+            cls.deleted_at.is_(None),
+            cls.duplicate_of.is_(None),
+            cls.prediction_confidence.isnot(None)
+        ).order_by(cls.prediction_confidence).limit(max(window, limit)).all()
+        return random.sample(candidates, min(limit, len(candidates)))
+
+    @classmethod
+    def find_by_hashes(cls, session, hashes) -> dict:
+        """
+        Get the file_name of every stored image whose hash is in hashes,
+        in one lookup on images_hash_idx.
+
+        Returns:
+            dict: hash -> file_name, for the hashes that exist
+        """
+        hashes = list(hashes)
+        if not hashes:
+            return {}
+        rows = session.query(cls.hash, cls.file_name).filter(
+            cls.hash.in_(hashes)).all()
+        return {row.hash: row.file_name for row in rows}
+
     @classmethod
     def update_gender(cls, session, file_name: str, is_masc: bool) -> None:
         """ Updates the Gender, by human for a certain file name """
@@ -99,3 +319,39 @@ class Image_table_base(Base):
         if result == 0:
             raise ValueError(f"Image with file_name '{file_name}' not found")
         session.commit()
+
+    @classmethod
+    def apply_labels(cls, session, labels) -> set:
+        """
+        Apply a batch of labels in one transaction, without recording
+        label events (LABEL_WRITE_MODE=sync). labeled_at is set, so an
+        older event still pending in label_events can't overwrite them.
+
+        Args:
+            session: SQLAlchemy session
+            labels (list): (file_name, label) pairs, label one of LABELS.
+                           A later label for the same file wins.
+
+        Returns:
+            set: The file names that exist and were updated
+        """
+        latest = dict(labels)
+        if not latest:
+            return set()
+        found = {row[0] for row in session.query(cls.file_name).filter(
+            cls.file_name.in_(list(latest)))}
+
+        # Naive UTC, like label_events.created_at
+        labeled_at = datetime.now(timezone.utc).replace(tzinfo=None)
+        # One UPDATE per distinct label instead of one per image
+        for label in LABELS:
+            names = [name for name in found if latest[name] == label]
+            if not names:
+                continue
+            values = {'deleted_at': func.now()} if label == 'trash' else \
+                {'is_masc_human': LABEL_VALUES[label]}
+            values['labeled_at'] = labeled_at
+            session.query(cls).filter(cls.file_name.in_(names)).update(
+                values, synchronize_session=False)
+        session.commit()
+        return found
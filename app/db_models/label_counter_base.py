@@ -0,0 +1,41 @@
+"""
+Label counter model for the label_counters table.
+Counters are maintained by the statement-level label_counters_*
+triggers on images, so reading them never scans the images table.
+"""
+
+from sqlalchemy import Column, String, BigInteger
+
+from .image_table_base import Base
+
+# Every counter the triggers maintain, in display order
+COUNTER_NAMES = ('total', 'unclassified', 'masculine', 'feminine',
+                 'trashed', 'duplicate', 'agree', 'disagree')
+
+
+class Label_counter_base(Base):
+    """
+    Model for the 'label_counters' table.
+
+    Columns:
+    - counter_name: VARCHAR(32) PRIMARY KEY
+    - value: BIGINT NOT NULL
+    """
+
+    __tablename__ = 'label_counters'
+    __table_args__ = {'extend_existing': True}
+
+    counter_name = Column(String(32), primary_key=True)
+    value = Column(BigInteger, nullable=False, default=0)
+
+    def __repr__(self):
+        """String representation of the counter."""
+        return f'<Label_counter {self.counter_name}={self.value}>'
+
+    @classmethod
+    def get_counts(cls, session) -> dict:
+        """Get all counters as a dict. Missing counters read as 0."""
+        counts = {name: 0 for name in COUNTER_NAMES}
+        for name, value in session.query(cls.counter_name, cls.value):
+            counts[name] = value
+        return counts
@@ -0,0 +1,206 @@
+"""
+Label event model for the label_events table.
+Every label a labeler gives is appended here and never overwritten.
+compact() folds the events into images.is_masc_human and
+images.deleted_at, so relabels keep their history and labelers can be
+compared with each other.
+"""
+
+from sqlalchemy import Column, BigInteger, Integer, String, TIMESTAMP, \
+    func, insert, text
+
+from .image_table_base import Base, Image_table_base
+
+# Folds every pending event into images in one statement. Events are
+# taken in id order and locked with SKIP LOCKED, so several compactors
+# can run at once. The newest event per image wins, and an image never
+# goes back to an older label than the one it already holds. Newest is
+# by created_at, when the label was given: ids follow the order web
+# processes flush in, so a relabel flushed first can have the lower id.
+# With :image_ids only the pending events of those images are folded.
+COMPACT_SQL = text("""
+    WITH batch AS (
+        SELECT id FROM label_events
+        WHERE compacted_at IS NULL
+          AND (CAST(:image_ids AS INTEGER[]) IS NULL
+               OR image_id = ANY(:image_ids))
+        ORDER BY id
+        LIMIT :limit
+        FOR UPDATE SKIP LOCKED
+    ), latest AS (
+        SELECT DISTINCT ON (e.image_id) e.image_id, e.id, e.label,
+            e.created_at
+        FROM label_events e JOIN batch USING (id)
+        ORDER BY e.image_id, e.created_at DESC, e.id DESC
+    ), folded AS (
+        UPDATE images AS i SET
+            is_masc_human = CASE latest.label
+                WHEN 'male' THEN TRUE
+                WHEN 'female' THEN FALSE
+                ELSE i.is_masc_human END,
+            deleted_at = CASE WHEN latest.label = 'trash'
+                THEN COALESCE(i.deleted_at, now())
+                ELSE i.deleted_at END,
+            label_event_id = latest.id,
+            labeled_at = latest.created_at
+        FROM latest
+        WHERE i.id = latest.image_id
+          AND (i.labeled_at IS NULL OR
+               (latest.created_at, latest.id) >
+               (i.labeled_at, COALESCE(i.label_event_id, 0)))
+        RETURNING i.id
+    ), marked AS (
+        UPDATE label_events SET compacted_at = now()
+        WHERE id IN (SELECT id FROM batch)
+        RETURNING id
+    )
+    SELECT (SELECT count(*) FROM marked) AS events,
+           (SELECT count(*) FROM folded) AS images
+""")
+
+# Pairs of labelers who both gave a male/female label to the same
+# image, using each labeler's latest label
+AGREEMENT_SQL = text("""
+    WITH votes AS (
+        SELECT DISTINCT ON (image_id, labeler) image_id, labeler, label
+        FROM label_events
+        WHERE labeler IS NOT NULL AND label IN ('male', 'female')
+        ORDER BY image_id, labeler, created_at DESC, id DESC
+    )
+    SELECT count(*) AS pairs,
+           count(*) FILTER (WHERE a.label = b.label) AS agreeing,
+           count(DISTINCT a.image_id) AS images
+    FROM votes a
+    JOIN votes b ON a.image_id = b.image_id AND a.labeler < b.labeler
+""")
+
+
+class Label_event_base(Base):
+    """
+    Model for the 'label_events' table.
+
+    Columns:
+    - id: BIGSERIAL PRIMARY KEY
+    - image_id: INTEGER NOT NULL, references images(id)
+    - label: VARCHAR(16) male, female or trash
+    - labeler: VARCHAR(64) (nullable) id from the labeler cookie
+    - created_at: TIMESTAMP when the label was given
+    - compacted_at: TIMESTAMP (nullable) when compact() folded it
+    """
+
+    __tablename__ = 'label_events'
+    __table_args__ = {'extend_existing': True}
+
+    id = Column(BigInteger().with_variant(Integer, 'sqlite'),
+                primary_key=True)
+    image_id = Column(Integer, nullable=False)
+    label = Column(String(16), nullable=False)
+    labeler = Column(String(64), nullable=True)
+    created_at = Column(TIMESTAMP, nullable=False,
+                        server_default=func.now())
+    compacted_at = Column(TIMESTAMP, nullable=True)
+
+    def __repr__(self):
+        """String representation of the event."""
+        return f'<Label_event {self.id} image={self.image_id} ' \
+               f'{self.label} by {self.labeler}>'
+
+    @classmethod
+    def _insert(cls, session, events) -> tuple:
+        """
+        INSERT events with one lookup and one multi-row INSERT, without
+        committing.
+
+        Returns:
+            tuple: (events inserted, file name -> image id of the names
+            that exist)
+        """
+        names = {event[0] for event in events}
+        ids = dict(session.query(Image_table_base.file_name,
+                                 Image_table_base.id).filter(
+            Image_table_base.file_name.in_(names))) if names else {}
+        rows = [{'image_id': ids[file_name], 'label': label,
+                 'labeler': labeler, 'created_at': created_at}
+                for file_name, label, labeler, created_at in events
+                if file_name in ids]
+        if rows:
+            session.execute(insert(cls), rows)
+        return len(rows), ids
+
+    @classmethod
+    def append(cls, session, events) -> int:
+        """
+        Append events with one lookup and one multi-row INSERT.
+
+        Args:
+            session: SQLAlchemy session
+            events (list): (file_name, label, labeler, created_at) tuples
+
+        Returns:
+            int: Events written. Events for unknown file names are dropped
+        """
+        events = list(events)
+        if not events:
+            return 0
+        written, _ = cls._insert(session, events)
+        session.commit()
+        return written
+
+    @classmethod
+    def apply(cls, session, events) -> set:
+        """
+        Append events and fold them into images in the same transaction,
+        for labels that can't wait to be written behind (PostgreSQL).
+
+        Other pending events of the same images are folded with them, so
+        the newest label still wins whichever path it took.
+
+        Args:
+            session: SQLAlchemy session
+            events (list): (file_name, label, labeler, created_at) tuples
+
+        Returns:
+            set: The file names that exist and were labeled
+        """
+        events = list(events)
+        _, ids = cls._insert(session, events)
+        if ids:
+            session.execute(COMPACT_SQL, {
+                'limit': None, 'image_ids': sorted(set(ids.values()))})
+        session.commit()
+        return set(ids)
+
+    @classmethod
+    def compact(cls, session, limit=5000) -> dict:
+        """
+        Fold up to limit pending events into images (PostgreSQL).
+
+        Returns:
+            dict: {'events': events folded, 'images': images updated}
+        """
+        row = session.execute(COMPACT_SQL, {'limit': limit,
+                                            'image_ids': None}).one()
+        session.commit()
+        return {'events': row.events, 'images': row.images}
+
+    @classmethod
+    def pending_count(cls, session) -> int:
+        """Events not folded into images yet."""
+        return session.query(func.count(cls.id)).filter(
+            cls.compacted_at.is_(None)).scalar()
+
+    @classmethod
+    def agreement(cls, session) -> dict:
+        """
+        Inter-labeler agreement over images labeled by more than one
+        labeler (PostgreSQL).
+
+        Returns:
+            dict: pairs, agreeing, images and agreement_rate (None when
+            no image has two labelers)
+        """
+        row = session.execute(AGREEMENT_SQL).one()
+        return {'pairs': row.pairs, 'agreeing': row.agreeing,
+                'images': row.images,
+                'agreement_rate': row.agreeing / row.pairs
+                if row.pairs else None}
@@ -0,0 +1,82 @@
+"""
+Processing ledger model for the processing_ledger table.
+S3 notifications are delivered at least once, so the ingest handlers
+record every object version they have finished with here and skip
+redeliveries with a single primary key lookup.
+"""
+
+from sqlalchemy import Column, String, TIMESTAMP, func
+from sqlalchemy.exc import IntegrityError
+
+from .image_table_base import Base
+
+
+class Processing_ledger_base(Base):
+    """
+    Model for the 'processing_ledger' table.
+
+    Columns:
+    - stage: VARCHAR(64) handler that did the work, e.g. 'file_processor'
+    - object_key: VARCHAR(1024) S3 key from the event
+    - etag: VARCHAR(128) ETag of the object version from the event
+    - pipeline_version: VARCHAR(64) (nullable) version of the work done
+    - output_key: VARCHAR(1024) (nullable) S3 key the work produced
+    - status: VARCHAR(64) result status reported by the handler
+    - processed_at: TIMESTAMP
+
+    (stage, object_key, etag) is the primary key.
+    """
+
+    __tablename__ = 'processing_ledger'
+    __table_args__ = {'extend_existing': True}
+
+    stage = Column(String(64), primary_key=True)
+    object_key = Column(String(1024), primary_key=True)
+    etag = Column(String(128), primary_key=True)
+    pipeline_version = Column(String(64), nullable=True)
+    output_key = Column(String(1024), nullable=True)
+    status = Column(String(64), nullable=False)
+    processed_at = Column(TIMESTAMP, nullable=False,
+                          server_default=func.now())
+
+    def __repr__(self):
+        """String representation of the ledger entry."""
+        return f'<Processing_ledger {self.stage} {self.object_key} ' \
+               f'{self.etag}: {self.status}>'
+
+    @classmethod
+    def lookup(cls, session, stage, object_key, etag,
+               pipeline_version=None):
+        """
+        Get the entry for an object version, or None if it has not been
+        processed (by this pipeline_version, when one is given).
+        """
+        entry = session.get(cls, (stage, object_key, etag))
+        if entry is None:
+            return None
+        if pipeline_version is not None and \
+                entry.pipeline_version != pipeline_version:
+            return None
+        return entry
+
+    @classmethod
+    def record(cls, session, stage, object_key, etag, status,
+               output_key=None, pipeline_version=None) -> bool:
+        """
+        Record that an object version has been processed.
+
+        A concurrent delivery recording the same version first is not an
+        error, since the work is done either way.
+
+        Returns:
+            bool: True if this call wrote the entry
+        """
+        try:
+            session.merge(cls(stage=stage, object_key=object_key, etag=etag,
+                              status=status, output_key=output_key,
+                              pipeline_version=pipeline_version))
+            session.commit()
+            return True
+        except IntegrityError:
+            session.rollback()
+            return False
@@ -0,0 +1,157 @@
+#################################################################
+# Batch inference over the numpys/ folder
+# Loads a serialized LogisticModel, finds every live image whose
+# is_masc_prediction was not written by that model version,
+# streams the matching vectors from S3 in large batches and
+# writes the predictions back with one UPDATE per batch.
+# Runs incrementally: rerunning with the same model only touches
+# rows that are new or were skipped because their vector was
+# not converted yet.
+#################################################################
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+# Custom modules
+# Handle both container and local development layouts
+try:
+    from modules.s3_access import S3Access
+    from modules.classifier import LogisticModel
+    from modules.vectors import VectorLoader
+    from db_models.image_table_base import Image_table_base
+except ImportError:
+    # Fall back to local development (modules one level up)
+    sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+    from modules.s3_access import S3Access
+    from modules.classifier import LogisticModel
+    from modules.vectors import VectorLoader
+    from db_models.image_table_base import Image_table_base
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = int(os.environ.get('INFERENCE_BATCH_SIZE', '256'))
+DEFAULT_WORKERS = int(os.environ.get('INFERENCE_WORKERS', '32'))
+DEFAULT_MODEL_KEY = os.environ.get('MODEL_KEY', 'models/latest.npz')
+
+
+def get_db_session():
+    """Create a database session from the DB_* environment variables."""
+    db_host = os.environ.get('DB_HOST')
+    db_user = os.environ.get('DB_USER')
+    db_password = os.environ.get('DB_PASSWORD')
+
+    if not all([db_host, db_user, db_password]):
+        raise RuntimeError("Database environment variables not set")
+
+    # DB_HOST carries the database name, as it does for the other services
+    engine = create_engine(
+        f"postgresql://{db_user}:{db_password}@{db_host}"  # noqa: E231
+    )
+    return sessionmaker(bind=engine)()
+
+
+def load_model(s3_access, model_key=None, model_path=None):
+    """Load the model from a local file if given, otherwise from S3."""
+    if model_path:
+        logger.info(f"Loading model from {model_path}")
+        return LogisticModel.load(model_path)
+
+    logger.info(f"Loading model from s3 key {model_key}")
+    data = s3_access.get_object(model_key)
+    if data is None:
+        raise RuntimeError(f"Model {model_key} not found in bucket")
+    return LogisticModel.from_bytes(data)
+
+
+def iter_stale_pages(session, model_version, batch_size):
+    """Yield pages of (id, hash) rows that need a new prediction."""
+    after_id = 0
+    while True:
+        page = Image_table_base.get_stale_predictions(
+            session, model_version, after_id, batch_size)
+        if not page:
+            return
+        yield page
+        after_id = page[-1][0]
+
+
+def run_inference(session, s3_access, model, batch_size=DEFAULT_BATCH_SIZE,
+                  workers=DEFAULT_WORKERS):
+    """
+    Predict every stale row and write the results back.
+
+    Returns:
+        dict: Counts and throughput for the run
+    """
+    version = model.version
+    loader = VectorLoader(s3_access, workers=workers)
+    stats = {'model_version': version, 'batches': 0, 'predicted': 0,
+             'missing_vectors': 0, 'seconds': 0.0}
+    started = time.perf_counter()
+
+    try:
+        pages = iter_stale_pages(session, version, batch_size)
+        for rows, ids, matrix in loader.iter_batches(pages):
+            stats['batches'] += 1
+            stats['missing_vectors'] += len(rows) - len(ids)
+            if not ids:
+                continue
+
+            if matrix.shape[1] != model.n_features:
+                raise ValueError(f"Model expects {model.n_features} "
+                                 f"features, vectors have {matrix.shape[1]}")
+
+            probabilities = model.predict_proba(matrix)
+            Image_table_base.bulk_update_predictions(
+                session, ids, (probabilities >= 0.5).tolist(),
+                model.confidence(probabilities).tolist(), version)
+            stats['predicted'] += len(ids)
+            logger.info(f"Batch {stats['batches']}: wrote "
+                        f"{len(ids)} predictions")
+    finally:
+        loader.close()
+
+    stats['seconds'] = round(time.perf_counter() - started, 3)
+    stats['images_per_second'] = round(
+        stats['predicted'] / stats['seconds'], 2) if stats['seconds'] else 0
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Write is_masc_prediction for images with stale "
+                    "predictions.")
+    parser.add_argument('--model-key', default=DEFAULT_MODEL_KEY,
+                        help="S3 key of the serialized model")
+    parser.add_argument('--model-path',
+                        help="Local model file, overrides --model-key")
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS,
+                        help="Concurrent S3 GETs")
+    args = parser.parse_args()
+
+    bucket_name = os.environ.get('S3_BUCKET_NAME')
+    if not bucket_name:
+        logger.error('S3_BUCKET_NAME environment variable not set')
+        return 1
+
+    s3_access = S3Access(bucket_name, max_pool_connections=args.workers)
+    model = load_model(s3_access, args.model_key, args.model_path)
+    session = get_db_session()
+
+    stats = run_inference(session, s3_access, model, args.batch_size,
+                          args.workers)
+    print(json.dumps(stats, indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
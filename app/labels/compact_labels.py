@@ -0,0 +1,102 @@
+#################################################################
+# Fold label_events into the images table
+# The web app appends every label to label_events and each web
+# process compacts every LABEL_COMPACT_INTERVAL seconds. This job
+# does the same on demand: after a backfill, with compaction
+# turned off in the web tier, or on a schedule with --interval.
+# It prints the inter-labeler agreement when it is done, and deletes
+# expired image claims.
+#################################################################
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+# Custom modules
+# Handle both container and local development layouts
+try:
+    from db_models.label_event_base import Label_event_base
+    from db_models.image_claim_base import Image_claim_base
+except ImportError:
+    # Fall back to local development (modules one level up)
+    sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+    from db_models.label_event_base import Label_event_base
+    from db_models.image_claim_base import Image_claim_base
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = int(os.environ.get('COMPACT_BATCH_SIZE', '5000'))
+
+
+def get_db_session():
+    """Create a database session from the DB_* environment variables."""
+    db_host = os.environ.get('DB_HOST')
+    db_user = os.environ.get('DB_USER')
+    db_password = os.environ.get('DB_PASSWORD')
+
+    if not all([db_host, db_user, db_password]):
+        raise RuntimeError("Database environment variables not set")
+
+    # DB_HOST carries the database name, as it does for the other services
+    engine = create_engine(
+        f"postgresql://{db_user}:{db_password}@{db_host}"  # noqa: E231
+    )
+    return sessionmaker(bind=engine)()
+
+
+def run_compaction(session, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Fold every pending event into images, batch_size events per
+    statement.
+
+    Returns:
+        dict: Counts and throughput for the run
+    """
+    stats = {'batches': 0, 'events': 0, 'images': 0, 'seconds': 0.0}
+    started = time.perf_counter()
+    while True:
+        result = Label_event_base.compact(session, batch_size)
+        stats['batches'] += 1
+        stats['events'] += result['events']
+        stats['images'] += result['images']
+        logger.info(f"Batch {stats['batches']}: folded {result['events']} "
+                    f"events into {result['images']} images")
+        if result['events'] < batch_size:
+            break
+
+    stats['seconds'] = round(time.perf_counter() - started, 3)
+    stats['events_per_second'] = round(
+        stats['events'] / stats['seconds'], 2) if stats['seconds'] else 0
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Fold label_events into images.is_masc_human and "
+                    "images.deleted_at.")
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                        help="Events folded per statement")
+    parser.add_argument('--interval', type=float, default=0,
+                        help="Repeat every so many seconds, 0 runs once")
+    args = parser.parse_args()
+
+    session = get_db_session()
+    while True:
+        stats = run_compaction(session, args.batch_size)
+        stats['agreement'] = Label_event_base.agreement(session)
+        stats['expired_claims'] = Image_claim_base.purge_expired(session)
+        print(json.dumps(stats, indent=2))
+        if not args.interval:
+            return 0
+        time.sleep(args.interval)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,81 @@
+"""
+Pure NumPy binary classifier shared by the trainer and batch inference.
+
+The model is a logistic regression over the flattened image vectors in
+numpys/. It is serialized as an .npz file holding the weights and the bias.
+"""
+import hashlib
+from io import BytesIO
+
+import numpy as np
+
+
+class LogisticModel:
+    """Logistic regression predicting P(is_masc) for a batch of vectors."""
+
+    def __init__(self, weights, bias=0.0):
+        """
+        Args:
+            weights (np.ndarray): One weight per input feature
+            bias (float): Intercept
+        """
+        self.weights = np.ascontiguousarray(weights, dtype=np.float32)
+        self.bias = np.float32(bias)
+
+    @classmethod
+    def zeros(cls, n_features):
+        """Create an untrained model for n_features inputs."""
+        return cls(np.zeros(n_features, dtype=np.float32))
+
+    @property
+    def n_features(self) -> int:
+        """Number of inputs the model expects."""
+        return self.weights.size
+
+    @property
+    def version(self) -> str:
+        """Content hash of the parameters, used to find stale predictions."""
+        digest = hashlib.sha1(self.weights.tobytes())
+        digest.update(self.bias.tobytes())
+        return digest.hexdigest()[:16]
+
+    def decision_function(self, matrix) -> np.ndarray:
+        """Get the raw logit for each row of matrix."""
+        return matrix @ self.weights + self.bias
+
+    def predict_proba(self, matrix) -> np.ndarray:
+        """Get P(is_masc) for each row of matrix."""
+        logits = np.clip(self.decision_function(matrix), -30.0, 30.0)
+        return 1.0 / (1.0 + np.exp(-logits))
+
+    def predict(self, matrix, threshold=0.5) -> np.ndarray:
+        """Get a boolean is_masc prediction for each row of matrix."""
+        return self.predict_proba(matrix) >= threshold
+
+    @staticmethod
+    def confidence(probabilities) -> np.ndarray:
+        """Map P(is_masc) to confidence in [0, 1], 0 being a coin flip."""
+        return np.abs(2.0 * probabilities - 1.0)
+
+    def to_bytes(self) -> bytes:
+        """Serialize the model to .npz bytes."""
+        buffer = BytesIO()
+        np.savez(buffer, weights=self.weights, bias=self.bias)
+        return buffer.getvalue()
+
+    @classmethod
+    def from_bytes(cls, data):
+        """Load a model serialized with to_bytes."""
+        with np.load(BytesIO(data), allow_pickle=False) as archive:
+            return cls(archive['weights'], archive['bias'])
+
+    def save(self, path):
+        """Write the model to a local .npz file."""
+        with open(path, 'wb') as handle:
+            handle.write(self.to_bytes())
+
+    @classmethod
+    def load(cls, path):
+        """Read a model from a local .npz file."""
+        with open(path, 'rb') as handle:
+            return cls.from_bytes(handle.read())
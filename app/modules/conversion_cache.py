@@ -0,0 +1,114 @@
+"""
+Which conversions make_numpy has already written.
+
+A conversion is keyed by (output key, version): the S3 key it is
+written to, which holds the source md5 under the variant's or display
+derivative's prefix, and the content hash of what it writes
+(Variant.version, Display.version). The output's metadata holds the
+same version, so an output with that metadata is current and the decode
+and upload can be skipped. Keying by the output key rather than the md5
+keeps two variants with the same steps under different prefixes apart,
+as they share a version but not an object.
+
+ConversionCache answers from a local LRU first, which lives as long as
+the warm container, and otherwise from the output's S3 metadata. A
+redelivered event or a re-invoke over the same sources then costs no
+request at all, and one HEAD per output after a cold start. A backfill
+after a spec change only converts the variants whose version changed.
+"""
+import threading
+from collections import OrderedDict
+
+COUNTERS = ('local_hits', 'metadata_hits', 'misses')
+
+
+class ConversionCache:
+    """
+    Least recently used set of current (output key, version) pairs,
+    backed by the outputs' S3 metadata.
+    """
+
+    def __init__(self, max_entries=4096):
+        """
+        Args:
+            max_entries (int): Pairs kept before the oldest is dropped,
+                               0 to always read the metadata
+        """
+        self.max_entries = max_entries
+        self.counts = dict.fromkeys(COUNTERS, 0)
+        # (output key, version) -> source ETag the output was written from
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _same_source(written_etag, etag) -> bool:
+        """
+        An output is from another source only if both ETags are known
+        and differ, i.e. the source key was overwritten in place.
+        """
+        return not etag or not written_etag or written_etag == etag
+
+    def is_current(self, output_key, version, etag, head) -> bool:
+        """
+        Check whether the output of a conversion is already written.
+
+        Args:
+            output_key (str): S3 key the output is written to
+            version (str): Version of the variant or display derivative
+            etag (str): ETag of the source from the event, or None
+            head (callable): Returns the output's S3 metadata, or None
+                             when it does not exist
+
+        Returns:
+            bool: True on a hit, when the conversion can be skipped
+        """
+        key = (output_key, version)
+        with self._lock:
+            if key in self._entries and \
+                    self._same_source(self._entries[key], etag):
+                self._entries.move_to_end(key)
+                self.counts['local_hits'] += 1
+                return True
+
+        metadata = head()
+        if metadata is not None and \
+                metadata.get('pipeline-version') == version and \
+                self._same_source(metadata.get('source-etag'), etag):
+            self.add(output_key, version,
+                     metadata.get('source-etag') or etag)
+            with self._lock:
+                self.counts['metadata_hits'] += 1
+            return True
+
+        with self._lock:
+            self.counts['misses'] += 1
+        return False
+
+    def add(self, output_key, version, etag=None) -> None:
+        """Remember an output that was written or found current."""
+        if self.max_entries <= 0:
+            return
+        key = (output_key, version)
+        with self._lock:
+            self._entries[key] = etag
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        """Forget every pair, so the next checks read the metadata."""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self, since=None) -> dict:
+        """
+        Hit and miss counts since start, or since an earlier stats().
+
+        Returns:
+            dict: COUNTERS and the number of entries
+        """
+        with self._lock:
+            stats = {name: self.counts[name] - (since or {}).get(name, 0)
+                     for name in COUNTERS}
+            stats['entries'] = len(self._entries)
+        return stats
@@ -0,0 +1,87 @@
+"""
+S3 notifications as the ingest Lambdas receive them.
+
+S3 either invokes a Lambda with the notification as its event, or sends
+the notification to an SQS queue that a Lambda event source mapping
+reads in batches (see ingest-queues.tf). In an SQS batch every record's
+body is a whole S3 notification. The handlers iterate s3_records() and
+so accept both.
+
+One bad file must not send a whole SQS batch back to the queue. A
+handler collects the messages it failed on and returns
+batch_response(), and the event source mapping (ReportBatchItemFailures)
+makes only those visible again. The rest of the batch is deleted. A
+message whose body is not an S3 notification at all counts as failed on
+its own, so it ends up in the dead-letter queue without the rest of its
+batch.
+"""
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def is_sqs_event(event) -> bool:
+    """Check whether event is a batch of SQS messages."""
+    records = event.get('Records') or []
+    return bool(records) and records[0].get('eventSource') == 'aws:sqs'
+
+
+def s3_records(event, failed):
+    """
+    Iterate the S3 notification records in a Lambda event.
+
+    S3 test notifications, sent when a queue is subscribed, hold no
+    records and yield nothing.
+
+    Args:
+        event (dict): The Lambda event
+        failed (list): Ids of SQS messages whose body can't be parsed
+                       are appended, instead of raising
+
+    Yields:
+        tuple: (SQS message id, or None for a direct S3 invocation,
+        S3 notification record)
+    """
+    if not is_sqs_event(event):
+        for record in event['Records']:
+            yield None, record
+        return
+    for message in event['Records']:
+        try:
+            records = json.loads(message['body']).get('Records', [])
+            if not isinstance(records, list):
+                raise TypeError("Records is not a list")
+        except (KeyError, TypeError, ValueError, AttributeError) as e:
+            logger.error(f"SQS message {message['messageId']} is not an "
+                         f"S3 notification: {e}")
+            failed.append(message['messageId'])
+            continue
+        for record in records:
+            yield message['messageId'], record
+
+
+def batch_response(event, response, failed=()):
+    """
+    Add the SQS partial batch response to a handler's response.
+
+    A direct S3 invocation gets the response unchanged. For an SQS
+    batch, messages in failed are reported as batchItemFailures, and
+    every message is when the response is an error, so a batch that
+    failed as a whole is retried instead of deleted.
+
+    Args:
+        event (dict): The Lambda event
+        response (dict): The handler's response, with a statusCode
+        failed (iterable): Ids of the messages to retry
+
+    Returns:
+        dict: The response to return from the handler
+    """
+    if not is_sqs_event(event):
+        return response
+    if response.get('statusCode') != 200:
+        failed = [message['messageId'] for message in event['Records']]
+    return dict(response, batchItemFailures=[
+        {'itemIdentifier': message_id}
+        for message_id in dict.fromkeys(failed)])
@@ -0,0 +1,246 @@
+"""
+Parallel conversion for make_numpy.
+
+A ConvertPool processes the records of one event (an SQS batch) at the
+same time. Each record runs on a thread, so its S3 requests overlap
+with the other records' work. The CPU work runs in one of two places:
+
+- 'thread' runs it on the same thread. Pillow releases the GIL while
+  it decodes and resizes, and numpy does for its array math, so the
+  threads use several cores and nothing is copied between them. This
+  is the only mode that works in Lambda.
+- 'process' sends it to a process pool, for containers where the
+  threads still contend for the GIL. The pool process serializes the
+  outputs straight into one of a ring of shared memory slots, one per
+  record thread, and the thread uploads them from the slot, so they
+  are never pickled or copied out. This needs /dev/shm and POSIX
+  semaphores, which Lambda does not have. If a pool process dies (the
+  OOM killer, a segfault in a decoder) the pool is replaced and the
+  record retried once, so only a record that kills it again fails.
+
+Either way the CPU work serializes every output into one buffer that
+the uploads read from through a MemoryReader, so each output byte is
+written once and read once. The pools and the slots are created once
+and reused while the container is warm.
+"""
+import io
+import multiprocessing
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from multiprocessing import resource_tracker, shared_memory
+
+EXECUTORS = ('thread', 'process')
+# Bytes of each slot, enough for the serialized outputs of one image
+SLOT_SIZE = 32 * 2 ** 20
+
+# Per-process state of the pool processes, set up once by _init_worker
+_worker = {}
+
+
+def aligned(nbytes) -> int:
+    """Round up to 64 bytes, so every array in a buffer starts aligned."""
+    return -(-nbytes // 64) * 64
+
+
+def _init_worker(slot_names):
+    """Attach the slots in a pool process."""
+    # Workers are forked and share the parent's resource tracker, so
+    # attaching here does not hand ownership of the slots to the worker
+    _worker['slots'] = [shared_memory.SharedMemory(name=name)
+                        for name in slot_names]
+
+
+def _call_in_slot(function, args, slot_index):
+    """
+    Run in a pool process: call function(allocate, *args), where
+    allocate hands out the slot. Outputs that don't fit the slot are
+    written to a bytearray that is pickled back instead.
+
+    Returns:
+        tuple: (function's result, the bytearray or None)
+    """
+    slot = _worker['slots'][slot_index]
+    overflow = []
+
+    def allocate(size):
+        if size <= slot.size:
+            return slot.buf[:size]
+        overflow.append(bytearray(size))
+        return memoryview(overflow[0])
+
+    return function(allocate, *args), overflow[0] if overflow else None
+
+
+class MemoryReader(io.RawIOBase):
+    """
+    Read-only file object over a memoryview (or any buffer), so an
+    upload reads straight from it instead of from a BytesIO copy.
+    """
+
+    def __init__(self, buffer):
+        super().__init__()
+        self._view = memoryview(buffer).cast('B')
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buffer):
+        end = min(self._position + len(buffer), len(self._view))
+        size = max(end - self._position, 0)
+        buffer[:size] = self._view[self._position:end]
+        self._position += size
+        return size
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += len(self._view)
+        if offset < 0:
+            raise ValueError(f"Negative seek position {offset}")
+        self._position = offset
+        return offset
+
+    def tell(self):
+        return self._position
+
+    def __len__(self):
+        return len(self._view)
+
+    def close(self):
+        if not self.closed:
+            self._view.release()
+        super().close()
+
+
+class ConvertPool:
+    """Threads for records and, in 'process' mode, processes for decoding."""
+
+    def __init__(self, workers=1, executor='thread', slot_size=SLOT_SIZE):
+        """
+        Args:
+            workers (int): Records processed at once, 1 for serial
+            executor (str): One of EXECUTORS
+            slot_size (int): Bytes of each worker's slot in 'process'
+                             mode, enough for one image's outputs
+
+        Raises:
+            ValueError: If executor is not one of EXECUTORS
+        """
+        if executor not in EXECUTORS:
+            raise ValueError(f"Unknown executor '{executor}'. "
+                             f"Allowed: {', '.join(EXECUTORS)}")
+        self.workers = max(int(workers), 1)
+        self.executor = executor
+        self._threads = ThreadPoolExecutor(
+            self.workers, thread_name_prefix='convert') \
+            if self.workers > 1 else None
+        self._processes = None
+        self._processes_lock = threading.Lock()
+        self.slots = []
+        self._free = queue.SimpleQueue()
+        if executor == 'process':
+            # Started before forking, so the pool shares this tracker
+            resource_tracker.ensure_running()
+            # One slot per record thread, so none waits for a slot
+            self.slots = [shared_memory.SharedMemory(create=True,
+                                                     size=slot_size)
+                          for _ in range(self.workers)]
+            for slot_index in range(len(self.slots)):
+                self._free.put(slot_index)
+            self._processes = self._start_processes()
+
+    def _start_processes(self):
+        return ProcessPoolExecutor(
+            self.workers, mp_context=multiprocessing.get_context('fork'),
+            initializer=_init_worker,
+            initargs=([slot.name for slot in self.slots],))
+
+    def _replace_processes(self, broken):
+        """
+        Swap a broken process pool for a new one, once however many
+        records saw it break. The slots belong to this process, so they
+        outlive the dead worker and are kept: other records may still be
+        reading from theirs.
+        """
+        with self._processes_lock:
+            if self._processes is broken:
+                broken.shutdown(wait=False)
+                self._processes = self._start_processes()
+
+    def map(self, function, items) -> list:
+        """
+        Call function on every item, up to workers at a time.
+
+        Returns:
+            list: (result, None) or (None, exception) per item, in order
+        """
+        if self._threads is None:
+            return [self._outcome(function, item) for item in items]
+        return list(self._threads.map(
+            lambda item: self._outcome(function, item), items))
+
+    @staticmethod
+    def _outcome(function, item):
+        try:
+            return function(item), None
+        except Exception as e:
+            return None, e
+
+    @contextmanager
+    def encode(self, function, *args):
+        """
+        Call function(allocate, *args) where this pool runs CPU work,
+        and yield (its result, the buffer it wrote to) for the with
+        block to read from.
+
+        function calls allocate(size) once for a writable memoryview of
+        size bytes, writes its outputs there and returns where. Here
+        that is a new bytearray. In a pool process it is the slot this
+        call holds until the with block ends. function must be
+        importable by name.
+        """
+        if self._processes is None:
+            buffers = []
+
+            def allocate(size):
+                buffers.append(memoryview(bytearray(size)))
+                return buffers[0]
+
+            result = function(allocate, *args)
+            yield result, buffers[0] if buffers else None
+            return
+
+        slot_index = self._free.get()
+        try:
+            for attempt in range(2):
+                processes = self._processes
+                try:
+                    result, overflow = processes.submit(
+                        _call_in_slot, function, args, slot_index).result()
+                    break
+                except BrokenProcessPool:
+                    self._replace_processes(processes)
+                    if attempt:
+                        raise
+            yield result, memoryview(overflow) if overflow is not None \
+                else self.slots[slot_index].buf
+        finally:
+            self._free.put(slot_index)
+
+    def shutdown(self):
+        """Stop the pools and free the slots."""
+        if self._threads is not None:
+            self._threads.shutdown()
+        if self._processes is not None:
+            self._processes.shutdown()
+        for slot in self.slots:
+            slot.close()
+            slot.unlink()
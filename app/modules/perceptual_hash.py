@@ -0,0 +1,75 @@
+"""
+Perceptual hashing for near-duplicate image detection.
+
+A dHash compares each pixel of a 9x8 grayscale thumbnail with its right
+neighbour, giving a 64-bit code that survives re-encoding, resizing and
+small color changes. Two images are near-duplicates when the Hamming
+distance between their codes is small.
+
+For lookup the code is split into BAND_COUNT 16-bit bands (multi-index
+hashing). By the pigeonhole principle, two codes within distance
+BAND_COUNT - 1 agree exactly on at least one band. So an exact-match
+index per band finds every candidate, and only those few need their
+full distance checked.
+"""
+import numpy as np
+from PIL import Image
+
+from .pipeline import MAX_IMAGE_PIXELS, fit_budget, open_image
+
+HASH_BITS = 64
+BAND_COUNT = 4
+BAND_BITS = HASH_BITS // BAND_COUNT
+BAND_MASK = (1 << BAND_BITS) - 1
+
+# Largest distance the band index is guaranteed to find
+MAX_INDEXED_DISTANCE = BAND_COUNT - 1
+
+
+def dhash(file_content, max_pixels=MAX_IMAGE_PIXELS) -> int:
+    """
+    Compute the 64-bit difference hash of an encoded image.
+
+    JPEGs are decoded at reduced scale via draft(), so this costs a
+    fraction of a full decode.
+
+    Args:
+        file_content (bytes): Encoded image
+        max_pixels (int): Pixel budget, see pipeline.fit_budget
+
+    Returns:
+        int: Unsigned 64-bit hash
+
+    Raises:
+        ImageTooLargeError: The image can't be decoded within max_pixels
+    """
+    image = open_image(file_content)
+    image.draft('L', (64, 64))
+    fit_budget(image, max_pixels=max_pixels)
+    thumbnail = image.convert('L').resize((9, 8), Image.Resampling.LANCZOS)
+
+    pixels = np.asarray(thumbnail, dtype=np.int16)
+    bits = pixels[:, 1:] > pixels[:, :-1]
+    return int.from_bytes(np.packbits(bits.ravel()).tobytes(), 'big')
+
+
+def to_signed(code) -> int:
+    """Convert an unsigned 64-bit hash to the signed value BIGINT stores."""
+    return code - (1 << HASH_BITS) if code >= 1 << (HASH_BITS - 1) else code
+
+
+def to_unsigned(code) -> int:
+    """Convert a stored BIGINT back to the unsigned 64-bit hash."""
+    return code & ((1 << HASH_BITS) - 1)
+
+
+def bands(code):
+    """Split a hash into BAND_COUNT integers, lowest bits first."""
+    code = to_unsigned(code)
+    return [(code >> (band * BAND_BITS)) & BAND_MASK
+            for band in range(BAND_COUNT)]
+
+
+def hamming_distance(a, b) -> int:
+    """Number of differing bits between two hashes."""
+    return bin(to_unsigned(a) ^ to_unsigned(b)).count('1')
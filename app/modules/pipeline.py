@@ -0,0 +1,762 @@
+"""
+Declarative preprocessing pipelines for make_numpy.
+
+A spec is a list of named variants. Each variant is a list of steps
+applied in order to the decoded source image, and is written under its
+own prefix:
+
+    [
+      {"name": "rgb224", "prefix": "numpys/rgb224/", "format": "npy",
+       "steps": [{"op": "resize", "size": 256, "fit": "shorter"},
+                 {"op": "crop", "size": 224},
+                 {"op": "dtype", "dtype": "uint8"}]},
+      {"name": "gray64", "prefix": "numpys/gray64/", "format": "npy",
+       "steps": [{"op": "resize", "size": 64},
+                 {"op": "pad", "size": 64},
+                 {"op": "grayscale"},
+                 {"op": "normalize", "scale": 255, "mean": 0.5, "std": 0.25},
+                 {"op": "dtype", "dtype": "float16"}]}
+    ]
+
+Image steps (resize, pad, crop, grayscale) run on the PIL image. Array
+steps (normalize, dtype) run on the NumPy array, which is created from
+the image at the first array step. So image steps must come first.
+
+Every source is decoded once for all variants, and variants that start
+with the same steps share the work for that prefix. Decoding also
+normalizes the image (see normalize_image): EXIF orientation, ICC
+profile, palette and alpha. This work runs on the image after it has been
+reduced as far as the variants allow. Decoding never holds more than a
+pixel budget (see fit_budget), so a huge or malicious upload is decoded
+at reduced scale or rejected instead of running the Lambda out of memory.
+
+The same decoded image also gives the display derivative (see Display),
+a small WebP or AVIF the labeling UI shows instead of the source.
+"""
+import hashlib
+import json
+import math
+import warnings
+from functools import lru_cache
+from io import BytesIO
+
+import numpy as np
+from PIL import Image, features
+
+try:
+    from PIL import ImageCms
+except ImportError:
+    # Pillow built without LittleCMS; ICC profiles are then ignored
+    ImageCms = None
+
+RESAMPLING = {
+    'nearest': Image.Resampling.NEAREST,
+    'bilinear': Image.Resampling.BILINEAR,
+    'bicubic': Image.Resampling.BICUBIC,
+    'lanczos': Image.Resampling.LANCZOS,
+}
+# resize: "longer" scales the longer side to size (fits inside a square),
+# "shorter" scales the shorter side to size (covers it, ready to crop)
+RESIZE_FITS = ('longer', 'shorter')
+DTYPES = ('uint8', 'float16', 'float32', 'float64')
+# raw: the array bytes with no header, as make_numpy has always written
+# npy: np.save format, which keeps the dtype and shape
+OUTPUT_FORMATS = ('raw', 'npy')
+
+# Prefixes that trigger the ingest Lambdas, so must never be written to
+RESERVED_PREFIXES = ('upload/', 'sources/')
+
+IMAGE_STEPS = ('resize', 'pad', 'crop', 'grayscale')
+# Channels of a decoded image (decode always gives RGB) and after grayscale
+DECODED_CHANNELS = 3
+GRAYSCALE_CHANNELS = 1
+ARRAY_STEPS = ('normalize', 'dtype')
+
+# Bumped whenever decode() changes what every variant is computed from
+DECODE_VERSION = 2
+
+# Sources are reduced to no less than this multiple of the largest size
+# a variant resizes to, so the final resize keeps its quality (the same
+# trade-off as reducing_gap in Image.thumbnail)
+REDUCING_GAP = 2.0
+
+# Display derivative defaults and the formats it can be written in
+DISPLAY_SIZE = 512
+DISPLAY_QUALITY = 75
+DISPLAY_FORMATS = {'webp': 'image/webp', 'avif': 'image/avif'}
+
+EXIF_ORIENTATION = 0x0112
+ORIENTATION_TRANSPOSE = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT,
+    3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270,
+    7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90,
+}
+# Modes Image.reduce() works on; anything else is converted first
+REDUCIBLE_MODES = ('L', 'LA', 'RGB', 'RGBA', 'CMYK')
+
+# Default pixel budget: the most pixels decode() holds at once. Larger
+# JPEGs are decoded at 1/2, 1/4 or 1/8 scale, larger images in other
+# formats are rejected. The worst case, a palette or RGBA PNG, peaks at
+# about 9 bytes per pixel, so 16 megapixels fit a 256 MB Lambda.
+MAX_IMAGE_PIXELS = 16_000_000
+# Scales JPEG decoding can reduce by, see Image.draft()
+JPEG_REDUCTIONS = (2, 4, 8)
+
+# The pixel budget replaces Pillow's warning, which would fire for every
+# large JPEG decoded at reduced scale. Pillow still refuses to open
+# sources over twice Image.MAX_IMAGE_PIXELS (about 179 megapixels).
+warnings.simplefilter('ignore', Image.DecompressionBombWarning)
+
+
+class ImageTooLargeError(ValueError):
+    """An image can't be decoded within the pixel budget."""
+
+
+def _size(value, op):
+    """Validate a square side length."""
+    if isinstance(value, bool) or not isinstance(value, int) or value < 1:
+        raise ValueError(f"{op}: size must be a positive integer")
+    return value
+
+
+def _channels(value, op, name):
+    """Validate a number, or one number per channel."""
+    values = value if isinstance(value, list) else [value]
+    if not values or not all(isinstance(v, (int, float)) and
+                             not isinstance(v, bool) for v in values):
+        raise ValueError(f"{op}: {name} must be a number or list of numbers")
+    return value
+
+
+def normalize_step(step):
+    """
+    Validate a step and fill in its defaults.
+
+    Two steps that do the same thing come out identical, which is what
+    makes prefix sharing and pipeline versions stable.
+
+    Raises:
+        ValueError: If the step is not valid
+    """
+    if not isinstance(step, dict) or 'op' not in step:
+        raise ValueError(f"Step must be an object with an 'op': {step!r}")
+    op = step['op']
+    allowed = {
+        'resize': {'op', 'size', 'fit', 'resample'},
+        'pad': {'op', 'size', 'color'},
+        'crop': {'op', 'size'},
+        'grayscale': {'op'},
+        'normalize': {'op', 'scale', 'mean', 'std'},
+        'dtype': {'op', 'dtype'},
+    }
+    if op not in allowed:
+        raise ValueError(f"Unknown step '{op}'. "
+                         f"Allowed: {', '.join(allowed)}")
+    unknown = set(step) - allowed[op]
+    if unknown:
+        raise ValueError(f"{op}: unknown options {sorted(unknown)}")
+
+    if op == 'resize':
+        fit = step.get('fit', 'longer')
+        resample = step.get('resample', 'lanczos')
+        if fit not in RESIZE_FITS:
+            raise ValueError(f"resize: fit must be one of {RESIZE_FITS}")
+        if resample not in RESAMPLING:
+            raise ValueError(f"resize: resample must be one of "
+                             f"{tuple(RESAMPLING)}")
+        return {'op': op, 'size': _size(step.get('size'), op), 'fit': fit,
+                'resample': resample}
+    if op == 'pad':
+        color = step.get('color', [0, 0, 0])
+        if not (isinstance(color, list) and len(color) == 3 and
+                all(isinstance(c, int) and 0 <= c <= 255 for c in color)):
+            raise ValueError("pad: color must be a list of 3 ints 0-255")
+        return {'op': op, 'size': _size(step.get('size'), op),
+                'color': color}
+    if op == 'crop':
+        return {'op': op, 'size': _size(step.get('size'), op)}
+    if op == 'grayscale':
+        return {'op': op}
+    if op == 'normalize':
+        scale = step.get('scale', 255)
+        std = step.get('std', 1)
+        _channels(scale, op, 'scale')
+        _channels(std, op, 'std')
+        if not scale or std == 0 or (isinstance(std, list) and 0 in std):
+            raise ValueError("normalize: scale and std must be non-zero")
+        return {'op': op, 'scale': scale,
+                'mean': _channels(step.get('mean', 0), op, 'mean'),
+                'std': std}
+    dtype = step.get('dtype')
+    if dtype not in DTYPES:
+        raise ValueError(f"dtype: dtype must be one of {DTYPES}")
+    return {'op': op, 'dtype': dtype}
+
+
+class Variant:
+    """One named output of a pipeline spec."""
+
+    def __init__(self, name, steps, prefix=None, output_format='npy'):
+        """
+        Args:
+            name (str): Variant name, unique within a spec
+            steps (list): Step dicts, see the module docstring
+            prefix (str): Folder to write to, numpys/<name>/ by default
+            output_format (str): 'npy' or 'raw'
+
+        Raises:
+            ValueError: If any part of the variant is not valid
+        """
+        if not isinstance(name, str) or not name:
+            raise ValueError("Variant name must be a non-empty string")
+        self.name = name
+        self.prefix = prefix if prefix is not None else f"numpys/{name}/"
+        if not self.prefix.endswith('/') or \
+                self.prefix.startswith(RESERVED_PREFIXES):
+            raise ValueError(f"{name}: prefix must end with '/' and not be "
+                             f"one of {RESERVED_PREFIXES}")
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError(f"{name}: format must be one of "
+                             f"{OUTPUT_FORMATS}")
+        self.output_format = output_format
+
+        self.steps = tuple(normalize_step(step) for step in steps)
+        ops = [step['op'] for step in self.steps]
+        first_array = next((i for i, op in enumerate(ops)
+                            if op in ARRAY_STEPS), len(ops))
+        if any(op in IMAGE_STEPS for op in ops[first_array:]):
+            raise ValueError(f"{name}: image steps must come before "
+                             f"normalize and dtype")
+        # Per-channel normalize values must match the channels they meet,
+        # or every image of the variant fails to broadcast
+        channels = DECODED_CHANNELS
+        for step in self.steps:
+            if step['op'] == 'grayscale':
+                channels = GRAYSCALE_CHANNELS
+            elif step['op'] == 'normalize':
+                for param in ('scale', 'mean', 'std'):
+                    values = step[param]
+                    if isinstance(values, list) and \
+                            len(values) not in (1, channels):
+                        raise ValueError(
+                            f"{name}: normalize {param} has {len(values)} "
+                            f"values for {channels} channel(s)")
+
+    @property
+    def version(self) -> str:
+        """Content hash of what the variant writes, for staleness checks."""
+        canonical = json.dumps([list(self.steps), self.output_format,
+                                DECODE_VERSION], sort_keys=True)
+        return hashlib.sha1(canonical.encode()).hexdigest()[:16]
+
+    def key(self, image_hash) -> str:
+        """Get the S3 key this variant writes for an image hash."""
+        return f"{self.prefix}{image_hash}.npy"
+
+    def serialize(self, array):
+        """
+        Encode an output array in the variant's format. Raw output is a
+        view of the array's memory when it is contiguous, not a copy.
+
+        Returns:
+            bytes or memoryview: The encoded array
+        """
+        if self.output_format == 'raw':
+            return memoryview(np.ascontiguousarray(array)).cast('B')
+        buffer = BytesIO()
+        np.save(buffer, array, allow_pickle=False)
+        return buffer.getvalue()
+
+    def _header(self, array) -> bytes:
+        """The bytes serialize_into() writes before the array's data."""
+        if self.output_format == 'raw':
+            return b''
+        buffer = BytesIO()
+        np.lib.format.write_array_header_1_0(buffer, {
+            'descr': np.lib.format.dtype_to_descr(array.dtype),
+            'fortran_order': False,
+            'shape': array.shape,
+        })
+        return buffer.getvalue()
+
+    def serialized_size(self, array) -> int:
+        """Bytes serialize_into() writes for an output array."""
+        return len(self._header(array)) + array.nbytes
+
+    def serialize_into(self, array, buffer) -> int:
+        """
+        Encode an output array like serialize(), but straight into a
+        writable buffer of at least serialized_size() bytes, so the
+        array's data is copied exactly once. The data is always in C
+        order, and 64-byte aligned when buffer is.
+
+        Returns:
+            int: Bytes written
+        """
+        header = self._header(array)
+        buffer[:len(header)] = header
+        np.copyto(np.ndarray(array.shape, array.dtype, buffer, len(header)),
+                  array)
+        return len(header) + array.nbytes
+
+
+def parse_spec(spec):
+    """
+    Parse a pipeline spec.
+
+    Args:
+        spec: A JSON string, a list of variant dicts, or a dict with a
+              'variants' list
+
+    Returns:
+        list: Variant objects
+
+    Raises:
+        ValueError: If the spec is not valid
+    """
+    if isinstance(spec, str):
+        try:
+            spec = json.loads(spec)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"Pipeline spec is not valid JSON: {e}")
+    if isinstance(spec, dict):
+        spec = spec.get('variants')
+    if not isinstance(spec, list) or not spec:
+        raise ValueError("Pipeline spec must be a non-empty list of variants")
+
+    variants = []
+    for entry in spec:
+        if not isinstance(entry, dict) or 'steps' not in entry:
+            raise ValueError(f"Variant must be an object with 'steps': "
+                             f"{entry!r}")
+        variants.append(Variant(entry.get('name'), entry['steps'],
+                                entry.get('prefix'),
+                                entry.get('format', 'npy')))
+
+    names = [variant.name for variant in variants]
+    keys = [variant.prefix for variant in variants]
+    if len(set(names)) != len(names) or len(set(keys)) != len(keys):
+        raise ValueError("Variant names and prefixes must be unique")
+    return variants
+
+
+def default_spec(target_pixels, grayscale):
+    """
+    The spec make_numpy has always run: LANCZOS resize of the longer
+    side, black letterbox, optional grayscale, divide by 255, written
+    to numpys/ as raw float64 bytes.
+    """
+    steps = [
+        {'op': 'resize', 'size': target_pixels},
+        {'op': 'pad', 'size': target_pixels},
+    ]
+    if grayscale:
+        steps.append({'op': 'grayscale'})
+    steps += [
+        {'op': 'normalize', 'scale': 255},
+        {'op': 'dtype', 'dtype': 'float64'},
+    ]
+    return [Variant('default', steps, prefix='numpys/',
+                    output_format='raw')]
+
+
+def resize(image, size, fit='longer', resample='lanczos'):
+    """Scale image so its longer (or shorter) side is size pixels."""
+    width, height = image.size
+    side = max(width, height) if fit == 'longer' else min(width, height)
+    scale_factor = size / side
+    new_size = (max(1, int(width * scale_factor)),
+                max(1, int(height * scale_factor)))
+    return image.resize(new_size, RESAMPLING[resample])
+
+
+def pad(image, size, color=(0, 0, 0)):
+    """Center image on a size x size canvas of color."""
+    padded = Image.new(image.mode, (size, size),
+                       tuple(color) if image.mode == 'RGB'
+                       else int(sum(color) / 3))
+    padded.paste(image, ((size - image.width) // 2,
+                         (size - image.height) // 2))
+    return padded
+
+
+def crop(image, size):
+    """Take the size x size center of image, black where it is smaller."""
+    left = (image.width - size) // 2
+    top = (image.height - size) // 2
+    return image.crop((left, top, left + size, top + size))
+
+
+def normalize(array, step, dtype='float64') -> np.ndarray:
+    """
+    (array / scale - mean) / std for a normalize step, cast to dtype.
+
+    The result is bit for bit what computing in float64 and casting
+    afterwards gives, but a uint8 array is converted in one pass into
+    an array of the output dtype, with no float64 intermediate:
+
+    - With the default mean and std, np.divide computes in float64 and
+      writes the output dtype directly.
+    - Otherwise every channel is looked up in a 256 entry table of its
+      normalized values (float64 output is computed directly instead,
+      which is faster and allocates nothing extra).
+
+    Args:
+        array (np.ndarray): Image array, (h, w) or (h, w, channels)
+        step (dict): A normalized 'normalize' step
+        dtype (str): Output dtype, one of DTYPES
+
+    Returns:
+        np.ndarray: Normalized array
+    """
+    scale, mean, std = (np.asarray(step[name], dtype=np.float64)
+                        for name in ('scale', 'mean', 'std'))
+    channels = array.shape[2] if array.ndim == 3 else 1
+    if array.dtype == np.uint8 and \
+            all(param.size in (1, channels) for param in (scale, mean, std)):
+        if not mean.any() and (std == 1).all():
+            return np.divide(array, scale, casting='unsafe',
+                             out=np.empty(array.shape, dtype))
+        if dtype != 'float64':
+            levels = np.arange(256, dtype=np.float64)
+            table = ((levels / scale.reshape(-1, 1) - mean.reshape(-1, 1))
+                     / std.reshape(-1, 1)).astype(dtype)
+            if len(table) == 1:
+                return table[0][array]
+            output = np.empty(array.shape, dtype)
+            for channel in range(channels):
+                output[..., channel] = table[channel][array[..., channel]]
+            return output
+
+    result = array / scale
+    result -= mean
+    result /= std
+    return result.astype(dtype, copy=False)
+
+
+def _apply(step, value, dtype='float64'):
+    """
+    Apply one normalized step to an image or array. A normalize step
+    writes dtype directly, so a dtype step after it costs nothing.
+    """
+    op = step['op']
+    if op == 'resize':
+        return resize(value, step['size'], step['fit'], step['resample'])
+    if op == 'pad':
+        return pad(value, step['size'], step['color'])
+    if op == 'crop':
+        return crop(value, step['size'])
+    if op == 'grayscale':
+        return value.convert('L')
+
+    if isinstance(value, Image.Image):
+        value = np.asarray(value)
+    if op == 'normalize':
+        return normalize(value, step, dtype)
+    return value.astype(step['dtype'], copy=False)
+
+
+def decode_scale(variants, size, display_size=0) -> float:
+    """
+    Get the smallest fraction of size that every variant can be computed
+    from, which is only below 1 when they all start with a resize.
+
+    The display derivative is rendered from the same image, but only sets
+    the scale when there are no variants to compute, so variant outputs
+    never depend on the display settings.
+    """
+    if not variants:
+        return min(display_size * REDUCING_GAP / max(size), 1.0) \
+            if display_size else 1.0
+    scale = 0.0
+    for variant in variants:
+        first = variant.steps[0] if variant.steps else None
+        if first is None or first['op'] != 'resize':
+            return 1.0
+        side = max(size) if first['fit'] == 'longer' else min(size)
+        scale = max(scale, first['size'] * REDUCING_GAP / side)
+    return min(scale, 1.0)
+
+
+def background_color(variants):
+    """Alpha is flattened onto the first pad color in the spec."""
+    for variant in variants:
+        for step in variant.steps:
+            if step['op'] == 'pad':
+                return tuple(step['color'])
+    return (0, 0, 0)
+
+
+@lru_cache(maxsize=8)
+def _icc_transform(icc_profile, mode):
+    """Build, once per distinct embedded profile, a transform to sRGB."""
+    return ImageCms.buildTransform(
+        ImageCms.ImageCmsProfile(BytesIO(icc_profile)),
+        ImageCms.createProfile('sRGB'), mode, 'RGB')
+
+
+def to_srgb(image, icc_profile):
+    """Convert an L, RGB or CMYK image to sRGB using its ICC profile."""
+    if icc_profile and ImageCms is not None:
+        try:
+            return ImageCms.applyTransform(
+                image, _icc_transform(icc_profile, image.mode))
+        except (ImageCms.PyCMSError, OSError, ValueError):
+            # Broken or mismatched profile, fall back to a plain convert
+            pass
+    return image if image.mode == 'RGB' else image.convert('RGB')
+
+
+def normalize_image(image, scale=1.0, background=(0, 0, 0)):
+    """
+    Turn an opened image into an upright sRGB image with no alpha.
+
+    The image is first shrunk to scale of its size, or the nearest
+    larger size it can be shrunk to cheaply. JPEGs use draft(), so they
+    are decoded at reduced size in the first place, and other formats
+    are reduced straight from the decoded pixels. Orientation, ICC
+    conversion and alpha flattening then all run on the small image.
+    So no full-resolution copy is made for RGB and L images, and only
+    the one palette expansion or alpha premultiply that resampling needs
+    is made for the rest.
+
+    Args:
+        image (PIL.Image.Image): Opened, ideally not yet loaded, image
+        scale (float): Fraction of the size the caller needs, at most 1
+        background (tuple): RGB color alpha is flattened onto
+
+    Returns:
+        PIL.Image.Image: RGB image
+    """
+    # Image.reduce() and convert() drop these, so read them up front
+    orientation = image.getexif().get(EXIF_ORIENTATION, 1)
+    icc_profile = image.info.get('icc_profile')
+    has_alpha = 'A' in image.getbands() or 'transparency' in image.info
+
+    if scale < 1.0:
+        wanted = (max(1, math.ceil(image.width * scale)),
+                  max(1, math.ceil(image.height * scale)))
+        # Only has an effect on JPEGs that have not been loaded yet
+        image.draft(None, wanted)
+    if image.mode not in REDUCIBLE_MODES or \
+            (has_alpha and image.mode not in ('RGBA', 'LA')):
+        # Palette, 1-bit and 16-bit images can't be resampled as they
+        # are, and a transparent color key has to become a real alpha
+        image = image.convert('RGBA' if has_alpha else 'RGB')
+    if scale < 1.0:
+        factor = min(image.width // wanted[0], image.height // wanted[1])
+        if factor > 1:
+            image = image.reduce(factor)
+
+    if image.mode in ('RGBA', 'LA'):
+        alpha = image.getchannel('A')
+        color = to_srgb(image.convert(image.mode[:-1]), icc_profile)
+        image = Image.new('RGB', image.size, background)
+        image.paste(color, mask=alpha)
+    else:
+        image = to_srgb(image, icc_profile)
+
+    if orientation in ORIENTATION_TRANSPOSE:
+        image = image.transpose(ORIENTATION_TRANSPOSE[orientation])
+    return image
+
+
+def open_image(file_content) -> Image.Image:
+    """
+    Open an encoded image. Only the header is read, so the size can be
+    checked before anything is decoded.
+
+    Raises:
+        ImageTooLargeError: Pillow's decompression bomb check failed
+    """
+    try:
+        return Image.open(BytesIO(file_content))
+    except Image.DecompressionBombError as e:
+        raise ImageTooLargeError(str(e)) from e
+
+
+def fit_budget(image, scale=1.0, max_pixels=MAX_IMAGE_PIXELS) -> float:
+    """
+    Keep the decode of an opened image within max_pixels.
+
+    Images within the budget are left alone. A larger JPEG is set to
+    decode at the smallest draft() reduction that fits, or the larger
+    one scale allows. Anything else raises before a pixel is decoded.
+
+    Args:
+        image (PIL.Image.Image): Opened, not yet loaded, image
+        scale (float): Fraction of image.size the caller needs
+        max_pixels (int): Pixel budget, 0 for none
+
+    Returns:
+        float: scale, relative to image.size after any reduction
+
+    Raises:
+        ImageTooLargeError: No reduction brings the image within budget
+    """
+    width, height = image.size
+    if not max_pixels or width * height <= max_pixels:
+        return scale
+
+    if image.format == 'JPEG':
+        for factor in JPEG_REDUCTIONS:
+            if math.ceil(width / factor) * math.ceil(height / factor) \
+                    <= max_pixels:
+                # Same rounding as normalize_image, so the reduction
+                # scale asks for is not lost
+                wanted = (max(1, math.ceil(width * scale)),
+                          max(1, math.ceil(height * scale)))
+                factor = max(factor, min(width // wanted[0],
+                                         height // wanted[1]))
+                image.draft(None, (max(1, width // factor),
+                                   max(1, height // factor)))
+                break
+        if image.width * image.height <= max_pixels:
+            return min(1.0, scale * width / image.width)
+
+    raise ImageTooLargeError(
+        f"{width}x{height} {image.format} image is over the budget of "
+        f"{max_pixels} pixels")
+
+
+def decode(file_content, variants=(), display_size=0,
+           max_pixels=MAX_IMAGE_PIXELS) -> Image.Image:
+    """
+    Decode and normalize an encoded image, once for all variants.
+
+    Args:
+        file_content (bytes): Encoded image
+        variants (list): Variant objects the image is decoded for, which
+                         decide how far it can be reduced
+        display_size (int): Longer side of the display derivative, which
+                            decides the scale when there are no variants
+        max_pixels (int): Pixel budget, see fit_budget
+
+    Returns:
+        PIL.Image.Image: RGB image, see normalize_image
+
+    Raises:
+        ImageTooLargeError: The image can't be decoded within max_pixels
+    """
+    image = open_image(file_content)
+    scale = decode_scale(variants, image.size, display_size)
+    scale = fit_budget(image, scale, max_pixels)
+    return normalize_image(image, scale, background_color(variants))
+
+
+class Display:
+    """
+    Settings for the display derivative: the image the labeling UI shows
+    instead of the full resolution source.
+    """
+
+    def __init__(self, size=DISPLAY_SIZE, image_format='webp',
+                 quality=DISPLAY_QUALITY, prefix='display/'):
+        """
+        Args:
+            size (int): Longer side in pixels, smaller images are kept
+            image_format (str): One of DISPLAY_FORMATS. AVIF needs a
+                                Pillow built with it
+            quality (int): Encoder quality 1-100
+            prefix (str): Folder to write to
+
+        Raises:
+            ValueError: If any setting is not valid
+        """
+        self.size = _size(size, 'display')
+        if image_format not in DISPLAY_FORMATS:
+            raise ValueError(f"display: format must be one of "
+                             f"{tuple(DISPLAY_FORMATS)}")
+        # The web app builds display URLs from its own DISPLAY_FORMAT, so
+        # writing another format would make every derivative miss
+        if image_format == 'avif' and not features.check('avif'):
+            raise ValueError("display: format 'avif' needs Pillow built "
+                             "with AVIF support, use 'webp' instead")
+        self.image_format = image_format
+        if isinstance(quality, bool) or not isinstance(quality, int) or \
+                not 1 <= quality <= 100:
+            raise ValueError("display: quality must be an integer 1-100")
+        self.quality = quality
+        if not prefix.endswith('/') or prefix.startswith(RESERVED_PREFIXES):
+            raise ValueError(f"display: prefix must end with '/' and not be "
+                             f"one of {RESERVED_PREFIXES}")
+        self.prefix = prefix
+
+    @property
+    def version(self) -> str:
+        """Content hash of what the derivative is, for staleness checks."""
+        canonical = json.dumps([self.size, self.image_format, self.quality,
+                                DECODE_VERSION])
+        return hashlib.sha1(canonical.encode()).hexdigest()[:16]
+
+    @property
+    def content_type(self) -> str:
+        """MIME type to store the derivative with."""
+        return DISPLAY_FORMATS[self.image_format]
+
+    def key(self, image_hash) -> str:
+        """Get the S3 key of the derivative for an image hash."""
+        return f"{self.prefix}{image_hash}.{self.image_format}"
+
+    def render(self, image) -> bytes:
+        """
+        Encode the derivative of a decoded image.
+
+        Images are only ever scaled down. Nothing but the pixels is
+        written: decode() has already applied the EXIF orientation and
+        converted to sRGB, so no EXIF, XMP or ICC profile is kept.
+
+        Args:
+            image (PIL.Image.Image): Image from decode()
+
+        Returns:
+            bytes: Encoded image
+        """
+        if max(image.size) > self.size:
+            image = resize(image, self.size)
+        buffer = BytesIO()
+        image.save(buffer, self.image_format.upper(), quality=self.quality)
+        return buffer.getvalue()
+
+
+def run_variants(image, variants):
+    """
+    Run every variant over one decoded image.
+
+    Results of shared step prefixes are computed once. Steps never
+    modify their input, so sharing is safe. A normalize step followed
+    by a dtype step runs as one step (see normalize).
+
+    Args:
+        image (PIL.Image.Image): Image from decode()
+        variants (list): Variant objects
+
+    Returns:
+        dict: Variant name -> output array
+    """
+    cache = {(): image}
+    outputs = {}
+    for variant in variants:
+        done = ()
+        value = image
+        steps = list(variant.steps)
+        while steps:
+            group = [steps.pop(0)]
+            # normalize converts straight to the dtype that follows it
+            if group[0]['op'] == 'normalize' and steps and \
+                    steps[0]['op'] == 'dtype':
+                group.append(steps.pop(0))
+            key = done + tuple(json.dumps(step, sort_keys=True)
+                               for step in group)
+            if key not in cache:
+                cache[key] = _apply(group[0], value,
+                                    group[-1].get('dtype', 'float64'))
+            value, done = cache[key], key
+        if isinstance(value, Image.Image):
+            value = np.asarray(value)
+        outputs[variant.name] = value
+    return outputs
@@ -1,19 +1,27 @@
 import boto3
+from botocore.config import Config
 from botocore.exceptions import ClientError
 
 
 class S3Access:
     """S3 access class for managing S3 bucket operations."""
 
-    def __init__(self, bucket_name):
+    def __init__(self, bucket_name, max_pool_connections=None):
         """
         Initialize S3Access with a bucket name.
 
         @Args:
             bucket_name (str): Name of the S3 bucket to connect to
+            max_pool_connections (int): HTTP connection pool size. Raise it
+                                        when sharing one client across many
+                                        threads. Defaults to botocore's 10.
         """
         self.bucket_name = bucket_name
-        self.s3_client = boto3.client('s3')
+        if max_pool_connections:
+            self.s3_client = boto3.client('s3', config=Config(
+                max_pool_connections=max_pool_connections))
+        else:
+            self.s3_client = boto3.client('s3')
 
     def list_sources(self):
         """
@@ -77,22 +85,32 @@ class S3Access:
             print(f"Error renaming key {current_key} to {new_key}: {e}")
             return False
 
-    def put_object(self, key, file_object):
+    def put_object(self, key, file_object, metadata=None,
+                   content_type=None, cache_control=None):
         """
         Upload a file object to S3 with the specified key.
 
         Args:
             key (str): Key name for the S3 object
             file_object: File-like object to upload (must support read())
+            metadata (dict): User metadata to store with the object
+            content_type (str): Content-Type header to serve it with
+            cache_control (str): Cache-Control header to serve it with
 
         Returns:
             bool: True if successful, False otherwise
         """
         try:
+            extra = {'Metadata': metadata} if metadata else {}
+            if content_type:
+                extra['ContentType'] = content_type
+            if cache_control:
+                extra['CacheControl'] = cache_control
             self.s3_client.put_object(
                 Bucket=self.bucket_name,
                 Key=key,
-                Body=file_object
+                Body=file_object,
+                **extra
             )
 
             print(f"Successfully uploaded object to {key}")
@@ -150,6 +168,57 @@ class S3Access:
                 print(f"Error checking if object {key} exists: {e}")
                 return False
 
+    def head_object(self, key):
+        """
+        Get the user metadata of an object without downloading it.
+
+        Args:
+            key (str): Key name of the S3 object
+
+        Returns:
+            dict: User metadata (lower-case keys), or None if the object
+                  does not exist or can't be read
+        """
+        try:
+            response = self.s3_client.head_object(
+                Bucket=self.bucket_name,
+                Key=key
+            )
+            return response.get('Metadata', {})
+
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ('404', 'NoSuchKey'):
+                print(f"Error reading metadata of {key}: {e}")
+            return None
+
+    def generate_presigned_post(self, key, fields=None, conditions=None,
+                                expires_in=300):
+        """
+        Create a presigned POST that lets a browser upload one object.
+
+        Args:
+            key (str): Key the upload is written to
+            fields (dict): Form fields the client must send as given
+            conditions (list): Extra policy conditions, e.g. a
+                               content-length-range
+            expires_in (int): Seconds the policy stays valid
+
+        Returns:
+            dict: {'url': ..., 'fields': {...}}, or None if error
+        """
+        try:
+            return self.s3_client.generate_presigned_post(
+                Bucket=self.bucket_name,
+                Key=key,
+                Fields=fields,
+                Conditions=conditions,
+                ExpiresIn=expires_in
+            )
+
+        except ClientError as e:
+            print(f"Error presigning upload to {key}: {e}")
+            return None
+
     def delete_object(self, key):
         """
         Delete an object from S3 with the specified key.
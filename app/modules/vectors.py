@@ -0,0 +1,117 @@
+"""
+Helpers for reading the numpy vectors written to the numpys/ folder.
+
+make_numpy writes each converted image as the raw bytes of a flattened
+float64 array, with no .npy header. Files that do carry a header are
+also accepted so other writers can use np.save.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+import numpy as np
+
+NPY_MAGIC = b'\x93NUMPY'
+
+
+def numpy_key(image_hash, prefix='numpys/'):
+    """Get the S3 key of the vector for an image hash."""
+    return f"{prefix}{image_hash}.npy"
+
+
+def decode_vector(data, dtype=np.float64) -> np.ndarray:
+    """
+    Decode the bytes of a numpys/ object into a flat array.
+
+    Headerless files are read as dtype without copying. Files written
+    with np.save use the dtype and shape from their header.
+    """
+    if data[:len(NPY_MAGIC)] == NPY_MAGIC:
+        return np.load(BytesIO(data), allow_pickle=False).reshape(-1)
+    return np.frombuffer(data, dtype=dtype)
+
+
+class VectorLoader:
+    """
+    Load batches of vectors from S3 into one contiguous matrix.
+
+    GETs run on a thread pool since they are network bound, and each
+    vector is converted straight into its row of the output matrix so a
+    batch never exists twice in memory.
+    """
+
+    def __init__(self, s3_access, workers=16, dtype=np.float32,
+                 prefix='numpys/'):
+        """
+        Args:
+            s3_access (S3Access): Bucket access, shared by all threads
+            workers (int): Concurrent GETs per batch
+            dtype: dtype of the returned matrices
+            prefix (str): Folder the vectors live in
+        """
+        self.s3_access = s3_access
+        self.dtype = dtype
+        self.prefix = prefix
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        # Loads the next batch while the caller works on the current one
+        self.prefetcher = ThreadPoolExecutor(max_workers=1)
+
+    def fetch(self, image_hash):
+        """Get one vector, or None if it has not been converted yet."""
+        data = self.s3_access.get_object(numpy_key(image_hash, self.prefix))
+        if data is None:
+            return None
+        return decode_vector(data)
+
+    def load_batch(self, rows, out=None):
+        """
+        Load the vectors for a batch of rows.
+
+        Args:
+            rows (list): Tuples whose first two items are (id, hash)
+            out (np.ndarray): Optional (len(rows), d) matrix to fill
+                              instead of allocating a new one
+
+        Returns:
+            tuple: (list of ids that were found, matrix of shape (n, d)).
+                   When out is given the matrix is a view of its first
+                   n rows.
+        """
+        vectors = self.pool.map(lambda row: self.fetch(row[1]), rows)
+        found = [(row[0], vec) for row, vec in zip(rows, vectors)
+                 if vec is not None]
+        if not found:
+            return [], np.empty((0, 0), dtype=self.dtype)
+
+        width = found[0][1].size if out is None else out.shape[1]
+        matrix = out
+        if matrix is None:
+            matrix = np.empty((len(found), width), dtype=self.dtype)
+        ids = []
+        for row_id, vec in found:
+            if vec.size != width:
+                raise ValueError(f"Vector for id {row_id} has {vec.size} "
+                                 f"values, expected {width}")
+            matrix[len(ids)] = vec
+            ids.append(row_id)
+        return ids, matrix[:len(ids)]
+
+    def iter_batches(self, pages):
+        """
+        Yield (rows, ids, matrix) for each page of rows, one batch ahead.
+
+        Args:
+            pages: Iterable of row lists as accepted by load_batch
+        """
+        pending = None
+        for rows in pages:
+            upcoming = (rows, self.prefetcher.submit(self.load_batch, rows))
+            if pending is not None:
+                yield (pending[0], *pending[1].result())
+            pending = upcoming
+        if pending is not None:
+            yield (pending[0], *pending[1].result())
+
+    def close(self):
+        """Shut down the worker threads."""
+        self.pool.shutdown()
+        self.prefetcher.shutdown()
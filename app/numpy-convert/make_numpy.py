@@ -4,27 +4,54 @@
 # uploaded to the sources/ folder.
 # It converts the images to black and white and saves them to
 # the monochrome/ folder with _bw suffix.
+# The same decode also gives a small WebP (or AVIF) display image
+# in display/, which the labeling UI shows instead of the source.
+# Decoding keeps to a pixel budget (MAX_IMAGE_PIXELS): huge JPEGs
+# are decoded at reduced scale, other huge images are rejected.
+# Each output carries the source ETag and pipeline version in its
+# metadata, and a warm container remembers what it wrote, so a
+# redelivered event or re-conversion is skipped without a decode or
+# upload (see modules/conversion_cache.py).
+# Events arrive straight from S3 or in batches from an SQS queue;
+# a failed file in a batch is reported back so only it is retried.
+# With CONVERT_WORKERS > 1 the files of a batch convert in parallel.
+# Sources uploaded straight to sources/ by the web app have no images
+# row yet. They get file_processor's checks here (pixel budget,
+# near-duplicates) and their row is written only once those pass.
 #################################################################
 import json
 import logging
 import os
 import sys
 import numpy as np
+from contextlib import contextmanager
 from urllib.parse import unquote_plus
-from io import BytesIO
 from botocore.exceptions import ClientError, NoCredentialsError, \
     ParamValidationError
 # import numpy as np # not used yet, but here for future use
 from PIL import Image
+from sqlalchemy import create_engine
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import sessionmaker
 
 
 try:
     # Try Lambda environment first (modules at same level)
     from modules.s3_access import S3Access
+    from modules.conversion_cache import ConversionCache
+    from modules import events, parallel, pipeline
+    from modules.perceptual_hash import dhash, to_signed, \
+        MAX_INDEXED_DISTANCE
+    from db_models import Image_table
 except ImportError:
     # Fall back to local development (modules one level up)
     sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
     from modules.s3_access import S3Access
+    from modules.conversion_cache import ConversionCache
+    from modules import events, parallel, pipeline
+    from modules.perceptual_hash import dhash, to_signed, \
+        MAX_INDEXED_DISTANCE
+    from db_models import Image_table
 
 
 # Configure CloudWatch logging
@@ -34,15 +61,117 @@ logger.setLevel(logging.INFO)
 # Initialize S3 access
 s3_access = None
 
+# Database the rows of direct uploads are written to. A sessionmaker,
+# since CONVERT_WORKERS threads register sources at once.
+db_engine = None
+db_sessions = None
+
+# Near-duplicate handling for direct uploads, as in file_processor
+PHASH_MAX_DISTANCE = min(int(os.environ.get('PHASH_MAX_DISTANCE', '3')),
+                         MAX_INDEXED_DISTANCE)
+PHASH_DUPLICATE_ACTION = os.environ.get('PHASH_DUPLICATE_ACTION', 'flag')
+
 # Get default target pixels from environment variable
 DEFAULT_TARGET_PIXELS = int(os.environ.get('DEFAULT_TARGET_PIXELS', '500'))
 TO_GRAYSCALE = bool(int(os.environ.get('TO_GRAYSCALE', '0')))
 
+# JSON list of output variants, see modules/pipeline.py. When unset the
+# single legacy variant built from the two settings above is written.
+PIPELINE_SPEC = os.environ.get('PIPELINE_SPEC', '').strip()
+VARIANTS = pipeline.parse_spec(PIPELINE_SPEC) if PIPELINE_SPEC else \
+    pipeline.default_spec(DEFAULT_TARGET_PIXELS, TO_GRAYSCALE)
+
+# Display derivative for the labeling UI; DISPLAY_SIZE=0 turns it off
+DISPLAY_SIZE = int(os.environ.get('DISPLAY_SIZE',
+                                  str(pipeline.DISPLAY_SIZE)))
+DISPLAY = pipeline.Display(
+    DISPLAY_SIZE, os.environ.get('DISPLAY_FORMAT', 'webp'),
+    int(os.environ.get('DISPLAY_QUALITY', str(pipeline.DISPLAY_QUALITY)))
+) if DISPLAY_SIZE else None
+# Keys are content addressed, so a derivative never changes in place
+DISPLAY_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+# Most pixels a decode may hold in memory, 0 for no limit. Larger JPEGs
+# are decoded at reduced scale and anything else larger is rejected, so
+# the Lambda's memory size only has to cover this many pixels.
+MAX_IMAGE_PIXELS = int(os.environ.get('MAX_IMAGE_PIXELS',
+                                      str(pipeline.MAX_IMAGE_PIXELS)))
+
+# (source md5, version) pairs of current outputs remembered while the
+# container is warm, 0 to HEAD every output instead
+CONVERSION_CACHE_SIZE = int(os.environ.get('CONVERSION_CACHE_SIZE',
+                                           '4096'))
+conversion_cache = ConversionCache(CONVERSION_CACHE_SIZE)
+
+# Records of one event converted at once, see modules/parallel.py. Give
+# the Lambda enough memory for that many decodes; Lambda gets a second
+# vCPU above 1769 MB. CONVERT_EXECUTOR=process is for containers only.
+CONVERT_WORKERS = int(os.environ.get('CONVERT_WORKERS', '1'))
+CONVERT_EXECUTOR = os.environ.get('CONVERT_EXECUTOR', 'thread')
+if CONVERT_EXECUTOR not in parallel.EXECUTORS:
+    raise ValueError(f"CONVERT_EXECUTOR must be one of "
+                     f"{parallel.EXECUTORS}")
+# Shared memory per worker for one image's serialized outputs in
+# process mode; larger outputs are pickled back instead
+CONVERT_SLOT_MB = int(os.environ.get('CONVERT_SLOT_MB',
+                                     str(parallel.SLOT_SIZE // 2 ** 20)))
+# Created on first use and kept while the container is warm
+convert_pool = None
+
+
+def get_convert_pool():
+    """Get or create the pool records are converted on."""
+    global convert_pool
+    if convert_pool is None:
+        convert_pool = parallel.ConvertPool(
+            CONVERT_WORKERS, CONVERT_EXECUTOR, CONVERT_SLOT_MB * 2 ** 20)
+    return convert_pool
+
+
+def get_db_sessions():
+    """Get or create the database sessionmaker, None if not configured."""
+    global db_engine, db_sessions
+
+    if db_sessions is None:
+        db_host = os.environ.get('DB_HOST')
+        db_user = os.environ.get('DB_USER')
+        db_password = os.environ.get('DB_PASSWORD')
+        if not all([db_host, os.environ.get('DB_NAME'), db_user,
+                    db_password]):
+            logger.warning("Database environment variables not set, "
+                           "direct uploads are not registered")
+            return None
+
+        connection_string = f"postgresql://{db_user}:{db_password}@{db_host}"  # noqa: E501, E231
+        db_engine = create_engine(connection_string)
+        db_sessions = sessionmaker(bind=db_engine)
+        logger.info(f"Database connection configured for {db_host}")
+
+    return db_sessions
+
 
 def lambda_handler(event, context):
     """
     AWS Lambda handler for converting images to black and white.
-    Triggered by S3 events when files are uploaded to the sources/ folder.
+    Triggered by S3 events when files are uploaded to the sources/ folder,
+    either directly or in batches from the sources SQS queue.
+    """
+    failed = []
+    return events.batch_response(
+        event, handle_records(event, context, failed), failed)
+
+
+def handle_records(event, context, failed):
+    """
+    Process every S3 record in event.
+
+    Args:
+        event (dict): S3 notification or SQS batch event
+        context: Lambda context
+        failed (list): Ids of the SQS messages that failed are appended
+
+    Returns:
+        dict: The handler response
     """
     global s3_access
 
@@ -74,55 +203,24 @@ def lambda_handler(event, context):
 
     try:
         processed_files = []
-
-        # Process each record in the S3 event
-        for record in event['Records']:
-            # Extract bucket and object key from the event
-            event_bucket = record['s3']['bucket']['name']
-            object_key = unquote_plus(record['s3']['object']['key'])
-
-            logger.info(f"Processing file: {object_key} from bucket: "
-                        f"{event_bucket}")
-
-            # Verify this is the correct bucket
-            if event_bucket != bucket_name:
-                logger.warning(f"Skipping file from different bucket: "
-                               f"{event_bucket}")
-                continue
-
-            # DEFENSIVE: Ensure we only process files from sources folder
-            if not object_key.startswith('sources/'):
-                logger.warning(f"Skipping file not in sources folder: "
-                               f"{object_key}")
-                continue
-
-            # DEFENSIVE: Skip the folder itself
-            if object_key.endswith('/'):
-                logger.info(f"Skipping folder: {object_key}")
-                continue
-
-            # DEFENSIVE: Skip files have _bw suffix (prevent reprocessing)
-            filename = object_key.split('/')[-1]
-            if '_bw.' in filename:
-                logger.info(f"Skipping already processed file: {object_key}")
-                processed_files.append({
-                    'original_file': object_key,
-                    'status': 'skipped_already_processed'
-                })
+        cache_stats = conversion_cache.stats()
+
+        # One S3 notification per record, or SQS messages wrapping them,
+        # CONVERT_WORKERS records at a time
+        records = list(events.s3_records(event, failed))
+        outcomes = get_convert_pool().map(
+            lambda item: process_record(item[1], bucket_name), records)
+        for (message_id, record), (result, error) in zip(records, outcomes):
+            if error is not None:
+                # In an SQS batch only this message goes back to the queue
+                if message_id is None:
+                    raise error
+                logger.error(f"Failed on SQS message {message_id}: "
+                             f"{error}", exc_info=error)
+                failed.append(message_id)
                 continue
-
-            # Check if file has valid image extension
-            if is_valid_image_file(filename):
-                # Process valid image file
-                result = process_image_file(object_key)
+            if result is not None:
                 processed_files.append(result)
-                logger.info(f"Successfully processed: {object_key}")
-            else:
-                logger.warning(f"Skipping invalid image file: {object_key}")
-                processed_files.append({
-                    'original_file': object_key,
-                    'status': 'skipped_invalid_extension'
-                })
 
         logger.info(f"Image conversion completed. Processed "
                     f"{len(processed_files)} files")
@@ -130,7 +228,8 @@ def lambda_handler(event, context):
             'statusCode': 200,
             'body': json.dumps({
                 'message': 'Image conversion completed',
-                'processed_files': processed_files
+                'processed_files': processed_files,
+                'conversion_cache': conversion_cache.stats(cache_stats)
             })
         }
 
@@ -173,6 +272,61 @@ def lambda_handler(event, context):
         }
 
 
+def process_record(record, bucket_name):
+    """
+    Handle one S3 notification record.
+
+    Returns:
+        dict: Result for the record, or None if it was skipped
+    """
+    # Extract bucket and object key from the event
+    event_bucket = record['s3']['bucket']['name']
+    object_key = unquote_plus(record['s3']['object']['key'])
+    etag = record['s3']['object'].get('eTag')
+
+    logger.info(f"Processing file: {object_key} from bucket: "
+                f"{event_bucket}")
+
+    # Verify this is the correct bucket
+    if event_bucket != bucket_name:
+        logger.warning(f"Skipping file from different bucket: "
+                       f"{event_bucket}")
+        return None
+
+    # DEFENSIVE: Ensure we only process files from sources folder
+    if not object_key.startswith('sources/'):
+        logger.warning(f"Skipping file not in sources folder: "
+                       f"{object_key}")
+        return None
+
+    # DEFENSIVE: Skip the folder itself
+    if object_key.endswith('/'):
+        logger.info(f"Skipping folder: {object_key}")
+        return None
+
+    # DEFENSIVE: Skip files have _bw suffix (prevent reprocessing)
+    filename = object_key.split('/')[-1]
+    if '_bw.' in filename:
+        logger.info(f"Skipping already processed file: {object_key}")
+        return {
+            'original_file': object_key,
+            'status': 'skipped_already_processed'
+        }
+
+    # Check if file has valid image extension
+    if not is_valid_image_file(filename):
+        logger.warning(f"Skipping invalid image file: {object_key}")
+        return {
+            'original_file': object_key,
+            'status': 'skipped_invalid_extension'
+        }
+
+    # Process valid image file
+    result = process_image_file(object_key, etag)
+    logger.info(f"Successfully processed: {object_key}")
+    return result
+
+
 def is_valid_image_file(filename):
     """Check if the file has a valid image extension."""
     valid_extensions = ['.jpeg', '.jpg', '.png']
@@ -235,44 +389,33 @@ def resize_and_pad_image(image_file_object,
             print("Error: Input is not a PIL.Image.Image object. (resize)")
             return None
 
-        original_width, original_height = image_file_object.size
-        if original_width > original_height:
-            scale_factor = target_pixels_on_side / original_width
-        else:
-            scale_factor = target_pixels_on_side / original_height
-
-        new_width = int(original_width * scale_factor)
-        new_height = int(original_height * scale_factor)
+        # Orient, color manage and flatten alpha at reduced size
+        scale = min(1.0, target_pixels_on_side * pipeline.REDUCING_GAP /
+                    max(image_file_object.size))
+        normalized = pipeline.normalize_image(image_file_object, scale,
+                                              background_color)
 
         # Resize the image while maintaining aspect ratio
-        resized_img = image_file_object.convert("RGB").resize(
-            (new_width, new_height),
-            Image.Resampling.LANCZOS)
+        resized_img = pipeline.resize(normalized, target_pixels_on_side)
 
-        # Create a new square image with the background color
-        padded_img = Image.new('RGB',
-                               (target_pixels_on_side, target_pixels_on_side),
-                               background_color)
-
-        paste_x = (target_pixels_on_side - new_width) // 2
-        paste_y = (target_pixels_on_side - new_height) // 2
-
-        # Paste the resized image onto the new background
-        padded_img.paste(resized_img, (paste_x, paste_y))
-
-        return padded_img
+        # Center it on a square of the background color
+        return pipeline.pad(resized_img, target_pixels_on_side,
+                            background_color)
 
     except Exception as e:
         print(f"An error occurred during resizing and padding: {e}")
         return None
 
 
-def convert_to_numpy(file_object, grayscale=TO_GRAYSCALE) -> np.ndarray:
+def convert_to_numpy(file_object, grayscale=TO_GRAYSCALE,
+                     target_pixels=DEFAULT_TARGET_PIXELS) -> np.ndarray:
     """
     Function 2: Convert image file object to black and white.
 
     Args:
         file_object (bytes): File content as bytes
+        grayscale (bool): Convert to a single channel
+        target_pixels (int): Side of the square output image
 
     Returns:
         bytes: Black and white image as bytes, or None if error
@@ -280,20 +423,12 @@ def convert_to_numpy(file_object, grayscale=TO_GRAYSCALE) -> np.ndarray:
     try:
         logger.info("Converting image to numpy")
 
-        # Convert bytes to PIL Image
-        image = Image.open(BytesIO(file_object))
-        image = resize_and_pad_image(image)
-
-        if grayscale:
-            # Convert to grayscale (black and white)
-            image = image.convert('L')
-        else:
-            image = image.convert('RGB')
-
-        # Convert to numpy array
-        img_array = np.array(image)
-        img_array = img_array / 255.0
-        flattened_img = img_array.flatten()
+        # Run the legacy variant: resize, pad, optional grayscale, / 255
+        variant, = pipeline.default_spec(target_pixels, grayscale)
+        outputs = pipeline.run_variants(
+            pipeline.decode(file_object, [variant],
+                            max_pixels=MAX_IMAGE_PIXELS), [variant])
+        flattened_img = outputs[variant.name].reshape(-1)
 
         logger.info("Successfully converted to a numpy array")
         return flattened_img
@@ -303,13 +438,130 @@ def convert_to_numpy(file_object, grayscale=TO_GRAYSCALE) -> np.ndarray:
         return None
 
 
-def save_numpy_array(numpy_array: np.ndarray, original_key: str) -> None:
+@contextmanager
+def convert_variants(file_object, variants=None, display=None):
+    """
+    Decode an image once, run every pipeline variant over it and
+    serialize the outputs, for the with block to upload.
+
+    The serialized outputs are views of one buffer (in 'process' mode,
+    a shared memory slot) that is only valid inside the with block.
+
+    Args:
+        file_object (bytes): File content as bytes
+        variants (list): pipeline.Variant objects, VARIANTS when None
+        display (pipeline.Display): Also render this display derivative
+
+    Yields:
+        tuple: (variant name -> serialized output, encoded display
+        image or None), as memoryviews
+
+    Raises:
+        pipeline.ImageTooLargeError: The image is over MAX_IMAGE_PIXELS
+    """
+    variants = VARIANTS if variants is None else variants
+    with get_convert_pool().encode(encode_variants, file_object, variants,
+                                   display, MAX_IMAGE_PIXELS) as encoded:
+        (spans, display_span), buffer = encoded
+        views = {name: buffer[offset:offset + size]
+                 for name, (offset, size) in spans.items()}
+        display_view = buffer[display_span[0]:sum(display_span)] \
+            if display_span else None
+        try:
+            yield views, display_view
+        finally:
+            for view in [*views.values(), display_view]:
+                if view is not None:
+                    view.release()
+
+
+def encode_variants(allocate, file_object, variants, display, max_pixels):
+    """
+    The CPU work of convert_variants, which may run in a pool process:
+    decode, run the variants, and serialize every output and the
+    display image into one buffer from allocate(size).
+
+    Returns:
+        tuple: (variant name -> (offset, size) of its output in the
+        buffer, (offset, size) of the display image or None)
+    """
+    image = pipeline.decode(file_object, variants,
+                            display.size if display else 0, max_pixels)
+    outputs = pipeline.run_variants(image, variants)
+    display_bytes = display.render(image) if display else None
+    del image
+
+    spans, size = {}, 0
+    for variant in variants:
+        spans[variant.name] = (
+            size, variant.serialized_size(outputs[variant.name]))
+        size = parallel.aligned(sum(spans[variant.name]))
+    display_span = (size, len(display_bytes)) \
+        if display_bytes is not None else None
+
+    buffer = allocate(sum(display_span) if display_span else size)
+    for variant in variants:
+        offset, length = spans[variant.name]
+        variant.serialize_into(outputs.pop(variant.name),
+                               buffer[offset:offset + length])
+    if display_span:
+        buffer[display_span[0]:sum(display_span)] = display_bytes
+    return spans, display_span
+
+
+def output_is_current(output, md5_hash, etag):
+    """
+    Check whether a variant's (or the display derivative's) output was
+    already written from this source by this version of the pipeline,
+    in conversion_cache or else in the output's metadata.
+    """
+    return conversion_cache.is_current(
+        output.key(md5_hash), output.version, etag,
+        lambda: s3_access.head_object(output.key(md5_hash)))
+
+
+def output_metadata(output, etag):
+    """S3 user metadata to write an output with."""
+    metadata = {'pipeline-version': output.version}
+    if etag:
+        metadata['source-etag'] = etag
+    return metadata
+
+
+def save_display_image(display, image_bytes, md5_hash, metadata=None):
+    """
+    Save a display derivative to S3.
+
+    Args:
+        display (pipeline.Display): Settings it was rendered with
+        image_bytes (bytes or memoryview): Encoded image
+        md5_hash (str): Hash of the source file
+        metadata (dict): S3 user metadata to store with the image
+
+    Returns:
+        str: S3 key of the saved image, or None if error
+    """
+    new_key = display.key(md5_hash)
+    if not s3_access.put_object(new_key, parallel.MemoryReader(image_bytes),
+                                metadata,
+                                content_type=display.content_type,
+                                cache_control=DISPLAY_CACHE_CONTROL):
+        logger.error(f"Failed to save display image to {new_key}")
+        return None
+    logger.info(f"Saved display image: {new_key}")
+    return new_key
+
+
+def save_numpy_array(numpy_array, original_key: str,
+                     prefix: str = 'numpys/', metadata=None) -> None:
     """
     Function 3: Save black and white image to S3 numpys folder.
 
     Args:
-        file_object (bytes): Black and white image as bytes
+        numpy_array: Array, or bytes or memoryview serialized by a Variant
         original_key (str): Original S3 key of the source file
+        prefix (str): Folder to save to
+        metadata (dict): S3 user metadata to store with the array
 
     Returns:
         str: New S3 key of the saved file, or None if error
@@ -333,12 +585,13 @@ def save_numpy_array(numpy_array: np.ndarray, original_key: str) -> None:
         md5_hash, extension = name_parts  # hash of the source file
 
         new_filename = f"{md5_hash}.npy"
-        new_key = f"numpys/{new_filename}"
+        new_key = f"{prefix}{new_filename}"
 
         logger.info(f"New file key will be: {new_key}")
 
         # Save to S3 using S3Access
-        success = s3_access.put_object(new_key, BytesIO(numpy_array))
+        success = s3_access.put_object(
+            new_key, parallel.MemoryReader(numpy_array), metadata)
         if not success:
             error_msg = f"Failed to save numpy array to {new_key}"
             logger.error(error_msg)
@@ -352,15 +605,160 @@ def save_numpy_array(numpy_array: np.ndarray, original_key: str) -> None:
         return None
 
 
-def process_image_file(file_key):
+def save_outputs(file_key, md5_hash, etag, variants, display, outputs,
+                 display_bytes):
+    """
+    Upload the outputs of convert_variants.
+
+    Returns:
+        tuple: (variant name -> S3 key, display image S3 key or None)
+
+    Raises:
+        Exception: If an upload failed
+    """
+    saved = {}
+    for variant in variants:
+        new_key = save_numpy_array(outputs[variant.name], file_key,
+                                   variant.prefix,
+                                   output_metadata(variant, etag))
+        if new_key is None:
+            error_msg = f"Failed to save variant {variant.name}: " \
+                        f"{file_key}"
+            logger.error(error_msg)
+            raise Exception(error_msg)
+        saved[variant.name] = new_key
+        conversion_cache.add(variant.key(md5_hash), variant.version, etag)
+
+    display_key = None
+    if display is not None:
+        display_key = save_display_image(display, display_bytes,
+                                         md5_hash,
+                                         output_metadata(display, etag))
+        if display_key is None:
+            raise Exception(f"Failed to save display image: {file_key}")
+        conversion_cache.add(display_key, display.version, etag)
+    return saved, display_key
+
+
+def is_registered(file_name) -> bool:
+    """
+    Check whether a source has its images row. Without a database every
+    source counts as registered.
+    """
+    sessions = get_db_sessions()
+    if sessions is None:
+        return True
+    with sessions() as session:
+        return session.query(Image_table.id).filter(
+            Image_table.file_name == file_name).first() is not None
+
+
+def register_source(file_key, file_object):
+    """
+    Write the images row of a source the web app uploaded straight to
+    sources/, after the checks file_processor runs on uploads. A source
+    over the pixel budget, or a near-duplicate with
+    PHASH_DUPLICATE_ACTION=skip, is deleted and never gets a row. Other
+    near-duplicates get duplicate_of, which keeps them out of labeling.
+
+    Returns:
+        dict: The result if the source was dropped, None once registered
+
+    Raises:
+        Exception: If the row can't be written, so the record is retried
+    """
+    file_name = file_key.split('/')[-1]
+    try:
+        phash = dhash(file_object, MAX_IMAGE_PIXELS)
+    except pipeline.ImageTooLargeError as e:
+        logger.warning(f"Rejected {file_key}: {e}")
+        s3_access.delete_object(file_key)
+        return {
+            'original_file': file_key,
+            'error': str(e),
+            'status': 'rejected_too_large'
+        }
+    except Exception as e:
+        # Stored without a perceptual hash, as file_processor does
+        logger.warning(f"Could not compute perceptual hash for "
+                       f"{file_key}: {e}")
+        phash = None
+
+    with get_db_sessions()() as session:
+        duplicate = None
+        if phash is not None:
+            duplicate, distance = Image_table.find_near_duplicate(
+                session, phash, PHASH_MAX_DISTANCE)
+        if duplicate is not None:
+            logger.info(f"{file_key} is {distance} bits from "
+                        f"{duplicate.file_name}")
+            if PHASH_DUPLICATE_ACTION == 'skip':
+                s3_access.delete_object(file_key)
+                return {
+                    'original_file': file_key,
+                    'duplicate_of': duplicate.file_name,
+                    'status': 'near_duplicate_removed'
+                }
+
+        image = Image_table()
+        image.file_name = file_name
+        if phash is not None:
+            image.phash = to_signed(phash)
+        if duplicate is not None:
+            image.duplicate_of = duplicate.id
+        session.add(image)
+        try:
+            session.commit()
+            logger.info(f"Registered direct upload {file_name}")
+        except IntegrityError:
+            # Registered meanwhile by another delivery of the event
+            session.rollback()
+    return None
+
+
+def process_image_file(file_key, etag=None, file_object=None,
+                       register=True):
     """
     Process a valid image file: convert to black and white
     and save to numpys folder.
+
+    Only variants whose output is missing or stale are computed, so a
+    redelivered event does no work and a variant added to the spec (or
+    the display derivative, for sources stored before it existed) is
+    backfilled on its own. A source without an images row is a direct
+    upload and is registered first, see register_source.
+
+    Args:
+        file_key (str): Key of the source in sources/
+        etag (str): ETag of the source, stored with the outputs
+        file_object (bytes): Content of the source if the caller has
+                             it already (file_processor's fused mode),
+                             otherwise it is read from S3
+        register (bool): Register the source if it has no images row.
+                         file_processor's fused mode has just written
+                         it, so passes False
     """
     try:
         logger.info(f"Starting to process image file: {file_key}")
 
-        file_object = get_file_object(file_key)
+        file_name = file_key.split('/')[-1]
+        md5_hash = file_name.rsplit('.', 1)[0]
+        unregistered = register and not is_registered(file_name)
+        variants = [variant for variant in VARIANTS
+                    if not output_is_current(variant, md5_hash, etag)]
+        display = DISPLAY if DISPLAY and \
+            not output_is_current(DISPLAY, md5_hash, etag) else None
+        if not variants and display is None and not unregistered:
+            logger.info(f"Outputs of {file_key} ({etag}) are current, "
+                        f"skipping redelivered event")
+            return {
+                'original_file': file_key,
+                'new_file': VARIANTS[0].key(md5_hash),
+                'status': 'skipped_already_processed'
+            }
+
+        if file_object is None:
+            file_object = get_file_object(file_key)
         if file_object is None:
             error_msg = f"Failed to retrieve file {file_key}"
             logger.error(error_msg)
@@ -370,23 +768,37 @@ def process_image_file(file_key):
                 operation_name='GetObject'
             )
 
-        numpy_array = convert_to_numpy(file_object)
-        if numpy_array is None:
-            error_msg = f"Failed to convert image to \
-                numpy array: {file_key}"
-            logger.error(error_msg)
-            raise Exception(error_msg)
+        if unregistered:
+            dropped = register_source(file_key, file_object)
+            if dropped is not None:
+                return dropped
+            if not variants and display is None:
+                return {
+                    'original_file': file_key,
+                    'new_file': VARIANTS[0].key(md5_hash),
+                    'status': 'registered'
+                }
 
-        new_key = save_numpy_array(numpy_array, file_key)
-        if new_key is None:
-            error_msg = f"Failed to save black and white image: {file_key}"
-            logger.error(error_msg)
-            raise Exception(error_msg)
+        try:
+            with convert_variants(file_object, variants,
+                                  display) as converted:
+                saved, display_key = save_outputs(
+                    file_key, md5_hash, etag, variants, display, *converted)
+        except pipeline.ImageTooLargeError as e:
+            # Retrying can't help, so this is a result and not an error
+            logger.warning(f"Rejected {file_key}: {e}")
+            return {
+                'original_file': file_key,
+                'error': str(e),
+                'status': 'rejected_too_large'
+            }
 
-        logger.info(f"Successfully processed {file_key} -> {new_key}")
+        logger.info(f"Successfully processed {file_key} -> {saved}")
         return {
             'original_file': file_key,
-            'new_file': new_key,
+            'new_file': VARIANTS[0].key(md5_hash),
+            'variants': saved,
+            'display': display_key,
             'status': 'converted_to_numpy_array'
         }
 
@@ -5,6 +5,17 @@
 # It processes the files by calculating the MD5 hash and copying
 # the file to the sources/ folder.
 # It also deletes the original file from the upload/ folder.
+# Near-duplicates (re-encoded or resized copies of an image that
+# is already stored) are found by perceptual hash and flagged or
+# skipped before they reach the labeling queue.
+# Uploads too large to decode within MAX_IMAGE_PIXELS are rejected
+# here, before they reach sources/.
+# Every upload version handled is recorded in processing_ledger,
+# so a redelivered S3 event is skipped after one lookup.
+# With FUSED_CONVERT=1 it also writes the make_numpy outputs from
+# the bytes it already holds, so make_numpy skips those sources.
+# Events arrive straight from S3 or in batches from an SQS queue;
+# a failed file in a batch is reported back so only it is retried.
 #################################################################
 import hashlib
 import json
@@ -24,12 +35,22 @@ from sqlalchemy.orm import sessionmaker
 try:
     # Try Lambda environment first (modules at same level)
     from modules.s3_access import S3Access
+    from modules import events
+    from modules.perceptual_hash import dhash, to_signed, \
+        MAX_INDEXED_DISTANCE
+    from modules.pipeline import MAX_IMAGE_PIXELS, ImageTooLargeError
     from ..db_models import Image_table
+    from ..db_models.processing_ledger_base import Processing_ledger_base
 except ImportError:
     # Fall back to local development (modules one level up)
     sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
     from modules.s3_access import S3Access
+    from modules import events
+    from modules.perceptual_hash import dhash, to_signed, \
+        MAX_INDEXED_DISTANCE
+    from modules.pipeline import MAX_IMAGE_PIXELS, ImageTooLargeError
     from db_models import Image_table
+    from db_models.processing_ledger_base import Processing_ledger_base
 
 
 # Configure CloudWatch logging
@@ -43,6 +64,39 @@ s3_access = None
 db_engine = None
 db_session = None
 
+# Near-duplicate handling. Distances above MAX_INDEXED_DISTANCE are not
+# guaranteed to be found by the band index, so they are clamped.
+PHASH_MAX_DISTANCE = min(int(os.environ.get('PHASH_MAX_DISTANCE', '3')),
+                         MAX_INDEXED_DISTANCE)
+# 'flag' stores the image with duplicate_of set, which keeps it out of
+# labeling and the label counts; 'skip' drops the upload
+PHASH_DUPLICATE_ACTION = os.environ.get('PHASH_DUPLICATE_ACTION', 'flag')
+
+# Uploads that can't be decoded within this many pixels are rejected
+# before they reach sources/, see modules/pipeline.py
+MAX_IMAGE_PIXELS = int(os.environ.get('MAX_IMAGE_PIXELS',
+                                      str(MAX_IMAGE_PIXELS)))
+
+# Fused ingest: also convert each stored image to numpys/ and display/
+# from the bytes in memory, as make_numpy would. make_numpy then finds
+# the outputs current and skips the source without downloading it. Its
+# PIPELINE_SPEC and DISPLAY_* settings must be set here too.
+FUSED_CONVERT = bool(int(os.environ.get('FUSED_CONVERT', '0')))
+if FUSED_CONVERT:
+    try:
+        import make_numpy
+    except ImportError:
+        sys.path.append(os.path.join(os.path.dirname(__file__), '..',
+                                     'numpy-convert'))
+        import make_numpy
+
+# Stage name of this handler's processing_ledger entries
+LEDGER_STAGE = 'file_processor'
+# Results that mean the upload needs no more work
+LEDGER_STATUSES = ('processed', 'duplicate_removed',
+                   'near_duplicate_removed', 'near_duplicate_flagged',
+                   'rejected_too_large')
+
 
 def get_db_session():
     """Get or create database session."""
@@ -83,7 +137,25 @@ def get_db_session():
 def lambda_handler(event, context):
     """
     AWS Lambda handler for processing uploaded files in S3.
-    Triggered by S3 events when files are uploaded to the upload/ folder.
+    Triggered by S3 events when files are uploaded to the upload/ folder,
+    either directly or in batches from the upload SQS queue.
+    """
+    failed = []
+    return events.batch_response(
+        event, handle_records(event, context, failed), failed)
+
+
+def handle_records(event, context, failed):
+    """
+    Process every S3 record in event.
+
+    Args:
+        event (dict): S3 notification or SQS batch event
+        context: Lambda context
+        failed (list): Ids of the SQS messages that failed are appended
+
+    Returns:
+        dict: The handler response
     """
     global s3_access
 
@@ -116,50 +188,20 @@ def lambda_handler(event, context):
     try:
         processed_files = []
 
-        # Process each record in the S3 event
-        for record in event['Records']:
-            # Extract bucket and object key from the event
-            event_bucket = record['s3']['bucket']['name']
-            object_key = unquote_plus(record['s3']['object']['key'])
-
-            logger.info(f"Processing file: {object_key} from bucket: "
-                        f"{event_bucket}")
-
-            # Verify this is the correct bucket
-            if event_bucket != bucket_name:
-                logger.warning(f"Skipping file from different bucket: "
-                               f"{event_bucket}")
+        # One S3 notification per record, or SQS messages wrapping them
+        for message_id, record in events.s3_records(event, failed):
+            try:
+                result = process_record(record, bucket_name)
+            except Exception as e:
+                # In an SQS batch only this message goes back to the queue
+                if message_id is None:
+                    raise
+                logger.error(f"Failed on SQS message {message_id}: {e}",
+                             exc_info=True)
+                failed.append(message_id)
                 continue
-
-            # Skip if not in upload folder (shouldn't happen due to filter,
-            # but safety check)
-            if not object_key.startswith('upload/'):
-                logger.warning(f"Skipping file not in upload folder: "
-                               f"{object_key}")
-                continue
-
-            # Skip the folder itself
-            if object_key.endswith('/'):
-                logger.info(f"Skipping folder: {object_key}")
-                continue
-
-            # Extract filename from key
-            filename = object_key.split('/')[-1]
-
-            # Check if file has valid image extension
-            if is_valid_image_file(filename):
-                # Process valid image file
-                result = process_image_file(object_key)
+            if result is not None:
                 processed_files.append(result)
-                logger.info(f"Successfully processed: {object_key}")
-            else:
-                # Delete invalid file
-                delete_file(object_key)
-                processed_files.append({
-                    'original_file': object_key,
-                    'status': 'deleted_invalid_extension'
-                })
-                logger.info(f"Deleted invalid file: {object_key}")
 
         logger.info(f"File processing completed. Processed "
                     f"{len(processed_files)} files")
@@ -210,6 +252,58 @@ def lambda_handler(event, context):
         }
 
 
+def process_record(record, bucket_name):
+    """
+    Handle one S3 notification record.
+
+    Returns:
+        dict: Result for the record, or None if it was skipped
+    """
+    # Extract bucket and object key from the event
+    event_bucket = record['s3']['bucket']['name']
+    object_key = unquote_plus(record['s3']['object']['key'])
+    etag = record['s3']['object'].get('eTag')
+
+    logger.info(f"Processing file: {object_key} from bucket: "
+                f"{event_bucket}")
+
+    # Verify this is the correct bucket
+    if event_bucket != bucket_name:
+        logger.warning(f"Skipping file from different bucket: "
+                       f"{event_bucket}")
+        return None
+
+    # Skip if not in upload folder (shouldn't happen due to filter,
+    # but safety check)
+    if not object_key.startswith('upload/'):
+        logger.warning(f"Skipping file not in upload folder: "
+                       f"{object_key}")
+        return None
+
+    # Skip the folder itself
+    if object_key.endswith('/'):
+        logger.info(f"Skipping folder: {object_key}")
+        return None
+
+    # Extract filename from key
+    filename = object_key.split('/')[-1]
+
+    # Check if file has valid image extension
+    if not is_valid_image_file(filename):
+        # Delete invalid file
+        delete_file(object_key)
+        logger.info(f"Deleted invalid file: {object_key}")
+        return {
+            'original_file': object_key,
+            'status': 'deleted_invalid_extension'
+        }
+
+    # Process valid image file
+    result = process_image_file(object_key, etag)
+    logger.info(f"Successfully processed: {object_key}")
+    return result
+
+
 def is_valid_image_file(filename):
     """Check if the file has a valid image extension."""
     valid_extensions = ['.jpeg', '.jpg', '.png']
@@ -217,13 +311,31 @@ def is_valid_image_file(filename):
     return any(filename_lower.endswith(ext) for ext in valid_extensions)
 
 
-def process_image_file(file_key):
+def process_image_file(file_key, etag=None):
     """
     Process a valid image file: calculate MD5 hash and copy to sources folder.
+
+    Args:
+        file_key (str): Key of the upload
+        etag (str): ETag of the upload from the S3 event, used to skip
+                    versions that were already processed
     """
     try:
         logger.info(f"Starting to process image file: {file_key}")
 
+        entry = ledger_lookup(file_key, etag)
+        if entry is not None:
+            logger.info(f"{file_key} ({etag}) was already processed, "
+                        f"skipping redelivered event")
+            # Gone after the first delivery, unless the same bytes were
+            # uploaded again under the same name
+            s3_access.delete_object(file_key)
+            return {
+                'original_file': file_key,
+                'new_file': entry.output_key,
+                'status': 'skipped_already_processed'
+            }
+
         # Get the file object using S3Access
         file_content = s3_access.get_object(file_key)
         if file_content is None:
@@ -251,12 +363,36 @@ def process_image_file(file_key):
             logger.info(f"File with MD5 {md5_hash} already exists in "
                         f"sources, skipping copy")
             s3_access.delete_object(file_key)
-            return {
+            return ledger_record(file_key, etag, {
                 'original_file': file_key,
                 'existing_file': new_key,
                 'md5_hash': md5_hash,
                 'status': 'duplicate_removed'
-            }
+            })
+
+        # Look for a perceptual near-duplicate before the image is stored
+        try:
+            phash, duplicate = find_near_duplicate(file_content, file_key)
+        except ImageTooLargeError as e:
+            # Would run the numpy Lambda out of memory too
+            logger.warning(f"Rejected {file_key}: {e}")
+            s3_access.delete_object(file_key)
+            return ledger_record(file_key, etag, {
+                'original_file': file_key,
+                'md5_hash': md5_hash,
+                'error': str(e),
+                'status': 'rejected_too_large'
+            })
+        if duplicate is not None and PHASH_DUPLICATE_ACTION == 'skip':
+            logger.info(f"{file_key} is a near-duplicate of "
+                        f"{duplicate.file_name}, removing upload")
+            s3_access.delete_object(file_key)
+            return ledger_record(file_key, etag, {
+                'original_file': file_key,
+                'duplicate_of': duplicate.file_name,
+                'md5_hash': md5_hash,
+                'status': 'near_duplicate_removed'
+            })
 
         # Copy file to sources folder with new name using S3Access
         success = s3_access.rename_key(file_key, new_key)
@@ -270,12 +406,20 @@ def process_image_file(file_key):
             )
 
         # Insert record into database
+        session = None
         try:
             session = get_db_session()
             if session:
                 # Create new Image_table record
                 new_image = Image_table()
                 new_image.file_name = new_filename
+                if phash is not None:
+                    new_image.phash = to_signed(phash)
+                if duplicate is not None:
+                    # Not trashed: trash is a human label, and training
+                    # reads it. duplicate_of alone keeps it out of the
+                    # labeling queue and counts it as 'duplicate'
+                    new_image.duplicate_of = duplicate.id
 
                 session.add(new_image)
                 session.commit()
@@ -287,16 +431,26 @@ def process_image_file(file_key):
         except Exception as e:
             logger.error(f"Failed to insert database record for \
                          {new_filename}: {e}")
+            # The session serves the rest of the batch
+            if session is not None:
+                session.rollback()
             # Don't fail the entire process if database insertion fails
             # The file was successfully copied, so we continue
 
         logger.info(f"Successfully processed {file_key} -> {new_key}")
-        return {
+        result = {
             'original_file': file_key,
             'new_file': new_key,
             'md5_hash': md5_hash,
             'status': 'processed'
         }
+        if duplicate is not None:
+            result['duplicate_of'] = duplicate.file_name
+            result['status'] = 'near_duplicate_flagged'
+        if FUSED_CONVERT:
+            result['converted'] = convert_fused(new_key, md5_hash,
+                                                file_content)
+        return ledger_record(file_key, etag, result)
 
     except ClientError as e:
         logger.error(f"S3 error processing image file {file_key}: {e}")
@@ -307,6 +461,119 @@ def process_image_file(file_key):
         raise e
 
 
+def convert_fused(source_key, md5_hash, file_content):
+    """
+    Write the make_numpy outputs of a newly stored source.
+
+    A single-part copy's ETag is the MD5 of its content, so the outputs
+    carry the ETag that the sources/ event will have (with SSE-KMS it
+    differs, and make_numpy converts the source again). Failures never
+    block ingest; make_numpy then converts the source from its event.
+
+    Returns:
+        dict: make_numpy's result, or None if the conversion failed
+    """
+    make_numpy.s3_access = s3_access
+    try:
+        return make_numpy.process_image_file(source_key, md5_hash,
+                                             file_content, register=False)
+    except Exception as e:
+        logger.warning(f"Fused conversion of {source_key} failed, "
+                       f"leaving it to make_numpy: {e}")
+        return None
+
+
+def find_near_duplicate(file_content, file_key):
+    """
+    Hash an image perceptually and look up a stored near-duplicate.
+
+    Failures here never block ingest: the image is stored without a
+    perceptual hash instead. Only an image over the pixel budget is
+    refused.
+
+    Returns:
+        tuple: (unsigned phash or None, matching Image_table or None)
+
+    Raises:
+        ImageTooLargeError: The image is over MAX_IMAGE_PIXELS
+    """
+    try:
+        phash = dhash(file_content, MAX_IMAGE_PIXELS)
+    except ImageTooLargeError:
+        raise
+    except Exception as e:
+        logger.warning(f"Could not compute perceptual hash for "
+                       f"{file_key}: {e}")
+        return None, None
+
+    session = None
+    try:
+        session = get_db_session()
+        if session is None:
+            return phash, None
+        duplicate, distance = Image_table.find_near_duplicate(
+            session, phash, PHASH_MAX_DISTANCE)
+        if duplicate is not None:
+            logger.info(f"{file_key} is {distance} bits from "
+                        f"{duplicate.file_name}")
+        return phash, duplicate
+    except Exception as e:
+        logger.error(f"Near-duplicate lookup failed for {file_key}: {e}")
+        if session is not None:
+            session.rollback()
+        return phash, None
+
+
+def ledger_lookup(file_key, etag):
+    """
+    Get the processing_ledger entry for an upload version.
+
+    The ledger only saves work, so when it can't be read the upload is
+    processed as if it were new.
+
+    Returns:
+        Processing_ledger_base: The entry, or None
+    """
+    if not etag:
+        return None
+    session = None
+    try:
+        session = get_db_session()
+        if session is None:
+            return None
+        return Processing_ledger_base.lookup(session, LEDGER_STAGE,
+                                             file_key, etag)
+    except Exception as e:
+        logger.warning(f"Ledger lookup failed for {file_key}: {e}")
+        if session is not None:
+            session.rollback()
+        return None
+
+
+def ledger_record(file_key, etag, result):
+    """
+    Record a finished upload version in processing_ledger.
+
+    Returns:
+        dict: result, unchanged
+    """
+    if not etag or result.get('status') not in LEDGER_STATUSES:
+        return result
+    session = None
+    try:
+        session = get_db_session()
+        if session is not None:
+            Processing_ledger_base.record(
+                session, LEDGER_STAGE, file_key, etag, result['status'],
+                output_key=result.get('new_file',
+                                      result.get('existing_file')))
+    except Exception as e:
+        logger.warning(f"Failed to record {file_key} in the ledger: {e}")
+        if session is not None:
+            session.rollback()
+    return result
+
+
 def delete_file(file_key):
     """Delete an invalid file from S3."""
     try:
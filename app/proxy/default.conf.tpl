@@ -5,6 +5,12 @@ upstream flask_app {
     server ${APP_HOST}:${FLASK_PORT};
 }
 
+# Shared cache for /static/ and /health. Fingerprinted static files are
+# kept as long as the app's Cache-Control allows; 10m of keys is about
+# 80k entries.
+proxy_cache_path /var/cache/nginx/proxy levels=1:2 keys_zone=web_cache:10m
+                 max_size=256m inactive=7d use_temp_path=off;
+
 # Real IP configuration for ALB
 real_ip_header X-Forwarded-For;
 real_ip_recursive on;
@@ -37,32 +43,48 @@ server {
         text/xml
         text/javascript
         application/json
+        application/x-ndjson
         application/javascript
         application/xml+rss
         application/atom+xml
         image/svg+xml;
 
-    # Health check endpoint for ALB
+    # Health check endpoint for ALB. Every target group checker polls
+    # it, so a healthy answer is reused for a few seconds; failures are
+    # never cached.
     location /health {
         access_log off;
         proxy_pass http://${APP_HOST}:${FLASK_PORT};
         include /etc/nginx/gunicorn_headers;
         add_header Content-Type text/plain;
+
+        proxy_cache web_cache;
+        proxy_cache_valid 200 5s;
+        proxy_cache_lock on;
     }
 
-    # Static files (CSS, JS, images)
+    # Static files (CSS, JS, images). Flask sets Cache-Control: a year
+    # and immutable for fingerprinted ?v=<hash> URLs, STATIC_MAX_AGE
+    # otherwise. nginx keeps them for as long as that allows.
     location /static/ {
         proxy_pass http://${APP_HOST}:${FLASK_PORT};
-        
-        # Cache static files
-        expires 1y;
-        add_header Cache-Control "public, immutable";
-        
+
+        proxy_cache web_cache;
+        proxy_cache_key $scheme$host$uri$is_args$args;
+        proxy_cache_valid 200 10m;
+        proxy_cache_valid 404 1m;
+        proxy_cache_lock on;
+        proxy_cache_use_stale error timeout updating http_500 http_502
+                              http_503 http_504;
+        add_header X-Cache-Status $upstream_cache_status always;
+
         # Include gunicorn headers
         include /etc/nginx/gunicorn_headers;
     }
 
-    # Flask routes
+    # Flask routes. Not cached here: the JSON endpoints send ETags and
+    # cache read-mostly responses in process, and nginx passes
+    # If-None-Match through so unchanged data costs a 304.
     location / {
         proxy_pass http://${APP_HOST}:${FLASK_PORT};
         
@@ -1,7 +1,8 @@
 #!/bin/bash
 
-# Run environment substitution on templates
-envsubst < /etc/nginx/templates/default.conf.template > /etc/nginx/conf.d/default.conf
+# Run environment substitution on templates. Only our variables are
+# listed, so nginx variables such as $host are left alone.
+envsubst '${APP_HOST} ${FLASK_PORT}' < /etc/nginx/templates/default.conf.template > /etc/nginx/conf.d/default.conf
 
 # Start nginx
 exec nginx -g "daemon off;" 
\ No newline at end of file
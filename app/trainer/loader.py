@@ -0,0 +1,117 @@
+"""
+Multi-process streaming loader for training batches.
+
+Worker processes fetch and decode numpys/ vectors and write each batch
+straight into one of a small ring of shared memory slots. The trainer
+reads the slot in place, so batches are never pickled between processes
+and at most `prefetch` batches exist in memory at any time.
+"""
+import multiprocessing as mp
+import time
+from collections import deque
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from modules.vectors import VectorLoader
+
+# Per-process state, set up once by _init_worker
+_worker = {}
+
+
+def _init_worker(store_factory, store_args, slot_names, threads):
+    """Create the worker's own store client and attach the slots."""
+    store = store_factory(*store_args)
+    _worker['loader'] = VectorLoader(store, workers=threads)
+    # Workers are forked and share the parent's resource tracker, so
+    # attaching here does not hand ownership of the slots to the worker
+    _worker['slots'] = [shared_memory.SharedMemory(name=name)
+                        for name in slot_names]
+
+
+def _fill_slot(slot_index, rows, n_features):
+    """Load one batch into a slot and return the ids that were found."""
+    out = np.ndarray((len(rows), n_features), dtype=np.float32,
+                     buffer=_worker['slots'][slot_index].buf)
+    ids, _ = _worker['loader'].load_batch(rows, out=out)
+    return ids
+
+
+class StreamingBatchLoader:
+    """
+    Stream (X, y) training batches from a pool of loader processes.
+
+    Args:
+        store_factory: Picklable callable returning an object with
+                       get_object(key), called once in each worker
+        store_args (tuple): Arguments for store_factory
+        n_features (int): Width of every vector
+        batch_size (int): Largest batch that will be requested
+        processes (int): Loader processes
+        threads (int): Concurrent GETs inside each process
+        prefetch (int): Slots in the ring, which bounds memory use to
+                        prefetch * batch_size * n_features * 4 bytes
+    """
+
+    def __init__(self, store_factory, store_args, n_features, batch_size,
+                 processes=4, threads=8, prefetch=None):
+        self.n_features = n_features
+        self.batch_size = batch_size
+        self.wait_seconds = 0.0
+
+        slot_bytes = batch_size * n_features * np.dtype(np.float32).itemsize
+        self.slots = [shared_memory.SharedMemory(create=True, size=slot_bytes)
+                      for _ in range(prefetch or processes + 1)]
+        self.pool = mp.get_context('fork').Pool(
+            processes, initializer=_init_worker,
+            initargs=(store_factory, store_args,
+                      [slot.name for slot in self.slots], threads))
+
+    def iter_batches(self, batches):
+        """
+        Yield (X, y) for each batch of (id, hash, label) rows, in order.
+
+        X is a float32 view of a shared slot and is only valid until the
+        next batch is requested. Rows whose vector is missing are dropped.
+        """
+        batches = iter(batches)
+        free = deque(range(len(self.slots)))
+        pending = deque()
+
+        def submit():
+            while free:
+                rows = next(batches, None)
+                if rows is None:
+                    return
+                if len(rows) > self.batch_size:
+                    raise ValueError(f"Batch of {len(rows)} rows exceeds "
+                                     f"batch_size {self.batch_size}")
+                slot_index = free.popleft()
+                pending.append((slot_index, rows, self.pool.apply_async(
+                    _fill_slot, (slot_index, rows, self.n_features))))
+
+        submit()
+        while pending:
+            slot_index, rows, result = pending.popleft()
+            waited = time.perf_counter()
+            ids = result.get()
+            self.wait_seconds += time.perf_counter() - waited
+
+            labels = {row[0]: row[2] for row in rows}
+            X = np.ndarray((len(ids), self.n_features), dtype=np.float32,
+                           buffer=self.slots[slot_index].buf)
+            y = np.fromiter((labels[i] for i in ids), dtype=np.float32,
+                            count=len(ids))
+            yield X, y
+
+            del X
+            free.append(slot_index)
+            submit()
+
+    def close(self):
+        """Stop the workers and free the shared memory."""
+        self.pool.terminate()
+        self.pool.join()
+        for slot in self.slots:
+            slot.close()
+            slot.unlink()
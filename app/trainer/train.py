@@ -0,0 +1,249 @@
+#################################################################
+# Train the baseline is_masc classifier on the numpys/ corpus
+# Reads every live, human labeled row from the images table,
+# splits it into train and validation sets by hash, and fits a
+# LogisticModel with mini-batch SGD. Vectors are streamed from
+# S3 by a pool of loader processes, so the corpus never has to
+# fit in memory. Throughput is reported per epoch.
+#################################################################
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+import zlib
+
+import numpy as np
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+# Custom modules
+# Handle both container and local development layouts
+try:
+    from modules.s3_access import S3Access
+    from modules.classifier import LogisticModel
+    from modules.vectors import numpy_key, decode_vector
+    from db_models.image_table_base import Image_table_base
+except ImportError:
+    # Fall back to local development (modules one level up)
+    sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+    from modules.s3_access import S3Access
+    from modules.classifier import LogisticModel
+    from modules.vectors import numpy_key, decode_vector
+    from db_models.image_table_base import Image_table_base
+
+from loader import StreamingBatchLoader
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = int(os.environ.get('TRAIN_BATCH_SIZE', '64'))
+DEFAULT_PROCESSES = int(os.environ.get('TRAIN_PROCESSES',
+                                       str(os.cpu_count() or 1)))
+DEFAULT_THREADS = int(os.environ.get('TRAIN_THREADS', '8'))
+
+# Keeps log() finite for saturated predictions
+EPSILON = 1e-7
+
+
+def get_db_session():
+    """Create a database session from the DB_* environment variables."""
+    db_host = os.environ.get('DB_HOST')
+    db_user = os.environ.get('DB_USER')
+    db_password = os.environ.get('DB_PASSWORD')
+
+    if not all([db_host, db_user, db_password]):
+        raise RuntimeError("Database environment variables not set")
+
+    # DB_HOST carries the database name, as it does for the other services
+    engine = create_engine(
+        f"postgresql://{db_user}:{db_password}@{db_host}"  # noqa: E231
+    )
+    return sessionmaker(bind=engine)()
+
+
+def get_labeled_rows(session, page_size=10000):
+    """Get every (id, hash, is_masc_human) row that can be trained on."""
+    rows = []
+    after_id = 0
+    while True:
+        page = Image_table_base.get_labeled(session, after_id, page_size)
+        if not page:
+            return rows
+        rows.extend((row[0], row[1], float(row[2])) for row in page)
+        after_id = page[-1][0]
+
+
+def split_rows(rows, val_percent):
+    """
+    Split rows into train and validation sets by hash, so an image stays
+    on the same side as the corpus grows.
+    """
+    train, val = [], []
+    for row in rows:
+        if zlib.crc32(row[1].encode()) % 100 < val_percent:
+            val.append(row)
+        else:
+            train.append(row)
+    return train, val
+
+
+def log_loss(probabilities, labels) -> float:
+    """Mean binary cross entropy."""
+    p = np.clip(probabilities, EPSILON, 1 - EPSILON)
+    return float(-np.mean(labels * np.log(p) + (1 - labels) * np.log1p(-p)))
+
+
+def sgd_step(model, X, y, learning_rate, l2):
+    """
+    Apply one mini-batch gradient step to model in place.
+
+    Returns:
+        float: Log loss of the batch before the step
+    """
+    probabilities = model.predict_proba(X)
+    error = (probabilities - y) / len(y)
+
+    gradient = X.T @ error
+    gradient += l2 * model.weights
+    model.weights -= np.float32(learning_rate) * gradient
+    model.bias -= np.float32(learning_rate * error.sum())
+    return log_loss(probabilities, y)
+
+
+def make_batches(rows, batch_size, rng=None):
+    """Cut rows into batches, shuffled first when rng is given."""
+    order = rng.permutation(len(rows)) if rng is not None \
+        else range(len(rows))
+    batch = []
+    for index in order:
+        batch.append(rows[index])
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def evaluate(model, loader, rows, batch_size):
+    """Get log loss and accuracy over rows."""
+    samples, correct, loss = 0, 0, 0.0
+    for X, y in loader.iter_batches(make_batches(rows, batch_size)):
+        probabilities = model.predict_proba(X)
+        loss += log_loss(probabilities, y) * len(y)
+        correct += int(np.sum((probabilities >= 0.5) == (y >= 0.5)))
+        samples += len(y)
+    if not samples:
+        return {'samples': 0, 'loss': None, 'accuracy': None}
+    return {'samples': samples, 'loss': round(loss / samples, 5),
+            'accuracy': round(correct / samples, 5)}
+
+
+def train(loader, model, train_rows, val_rows, epochs=5, batch_size=64,
+          learning_rate=0.01, l2=1e-4, seed=0):
+    """
+    Fit model with mini-batch SGD, streaming batches from loader.
+
+    Returns:
+        list: One dict of loss and throughput numbers per epoch
+    """
+    rng = np.random.default_rng(seed)
+    history = []
+
+    for epoch in range(1, epochs + 1):
+        loader.wait_seconds = 0.0
+        samples, loss = 0, 0.0
+        started = time.perf_counter()
+
+        for X, y in loader.iter_batches(
+                make_batches(train_rows, batch_size, rng)):
+            loss += sgd_step(model, X, y, learning_rate, l2) * len(y)
+            samples += len(y)
+
+        seconds = time.perf_counter() - started
+        stats = {
+            'epoch': epoch,
+            'samples': samples,
+            'seconds': round(seconds, 3),
+            'samples_per_second': round(samples / seconds, 2)
+            if seconds else 0,
+            'loader_wait_seconds': round(loader.wait_seconds, 3),
+            'train_loss': round(loss / samples, 5) if samples else None,
+            'validation': evaluate(model, loader, val_rows, batch_size)
+        }
+        logger.info(f"Epoch {epoch}: {json.dumps(stats)}")
+        history.append(stats)
+
+    return history
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Train the is_masc classifier on numpys/ vectors.")
+    parser.add_argument('--epochs', type=int, default=5)
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument('--learning-rate', type=float, default=0.01)
+    parser.add_argument('--l2', type=float, default=1e-4)
+    parser.add_argument('--val-percent', type=int, default=10)
+    parser.add_argument('--processes', type=int, default=DEFAULT_PROCESSES,
+                        help="Loader processes")
+    parser.add_argument('--threads', type=int, default=DEFAULT_THREADS,
+                        help="Concurrent GETs per loader process")
+    parser.add_argument('--max-samples', type=int,
+                        help="Train on at most this many labeled rows")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='model.npz',
+                        help="Local path to write the model to")
+    parser.add_argument('--model-key',
+                        help="Also upload the model to this S3 key, "
+                             "e.g. models/latest.npz for batch inference")
+    args = parser.parse_args()
+
+    bucket_name = os.environ.get('S3_BUCKET_NAME')
+    if not bucket_name:
+        logger.error('S3_BUCKET_NAME environment variable not set')
+        return 1
+
+    rows = get_labeled_rows(get_db_session())
+    if args.max_samples:
+        rows = rows[:args.max_samples]
+    train_rows, val_rows = split_rows(rows, args.val_percent)
+    logger.info(f"{len(train_rows)} training rows, "
+                f"{len(val_rows)} validation rows")
+    if not train_rows:
+        logger.error("No labeled rows to train on")
+        return 1
+
+    # Size the model and the shared slots from the first vector
+    s3_access = S3Access(bucket_name)
+    first = s3_access.get_object(numpy_key(train_rows[0][1]))
+    if first is None:
+        logger.error(f"Vector for {train_rows[0][1]} not found")
+        return 1
+    n_features = decode_vector(first).size
+
+    model = LogisticModel.zeros(n_features)
+    loader = StreamingBatchLoader(
+        S3Access, (bucket_name, args.threads), n_features, args.batch_size,
+        processes=args.processes, threads=args.threads)
+    try:
+        history = train(loader, model, train_rows, val_rows, args.epochs,
+                        args.batch_size, args.learning_rate, args.l2,
+                        args.seed)
+    finally:
+        loader.close()
+
+    model.save(args.output)
+    logger.info(f"Saved model {model.version} to {args.output}")
+    if args.model_key:
+        s3_access.put_object(args.model_key, model.to_bytes())
+
+    print(json.dumps({'model_version': model.version, 'epochs': history},
+                     indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
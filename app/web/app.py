@@ -1,8 +1,20 @@
 import os
+import re
 import sys
+import json
+import base64
+import hashlib
 import logging
-from flask import Flask, render_template, request, redirect, url_for, jsonify
+import uuid
+import time
+import atexit
+import socket
+from datetime import datetime
+from functools import lru_cache, wraps
+from flask import Flask, render_template, request, redirect, url_for, \
+    jsonify, Response, stream_with_context, make_response, g
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.orm import Session
 from botocore.exceptions import ClientError, NoCredentialsError
 import sqlalchemy.exc
 
@@ -17,14 +29,26 @@ try:
     # Try Lambda environment first (modules at same level)
     from modules.cdn import CDN
     from db_models.image_table_base import Base
-    from db_models.image_table_base import Image_table_base
+    from db_models.image_table_base import Image_table_base, LABELS
+    from db_models.label_counter_base import Label_counter_base
+    from db_models.label_event_base import Label_event_base
+    from db_models.image_claim_base import Image_claim_base
+    from response_cache import ResponseCache
+    from label_log import LabelLog, label_events
+    from read_router import ReadRouter
     logger.info("Modules imported at Root Successfully")
 except ImportError:
     # Fall back to local development (modules one level up)
     sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
     from modules.cdn import CDN
     from db_models.image_table_base import Base
-    from db_models.image_table_base import Image_table_base
+    from db_models.image_table_base import Image_table_base, LABELS
+    from db_models.label_counter_base import Label_counter_base
+    from db_models.label_event_base import Label_event_base
+    from db_models.image_claim_base import Image_claim_base
+    from response_cache import ResponseCache
+    from label_log import LabelLog, label_events
+    from read_router import ReadRouter
     logger.info("Modules imported at fallback Successfully")
 
 try:
@@ -40,12 +64,79 @@ app = Flask(__name__)
 db = SQLAlchemy()
 db.Model = Base
 
+# (file_name, deadline) pairs waiting to be served, see next_file_names
 file_name_cache = []
+
+# Paging limits for /api/images
+API_PAGE_SIZE = int(os.environ.get('API_PAGE_SIZE', '100'))
+API_MAX_PAGE_SIZE = int(os.environ.get('API_MAX_PAGE_SIZE', '1000'))
+STREAM_BATCH_SIZE = int(os.environ.get('STREAM_BATCH_SIZE', '1000'))
+# Output formats of /api/images
+API_FORMATS = ('json', 'ndjson')
+
+# Direct-to-S3 uploads through /api/uploads
+UPLOAD_MAX_BYTES = int(os.environ.get('UPLOAD_MAX_BYTES',
+                                      str(25 * 1024 * 1024)))
+UPLOAD_URL_EXPIRES = int(os.environ.get('UPLOAD_URL_EXPIRES', '300'))
+UPLOAD_BATCH_MAX = int(os.environ.get('UPLOAD_BATCH_MAX', '100'))
+UPLOAD_CONTENT_TYPES = {'jpg': 'image/jpeg', 'jpeg': 'image/jpeg',
+                        'png': 'image/png'}
+MD5_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+
+# Show the small display/ derivative written by make_numpy instead of
+# the full resolution source; the page falls back to the source when a
+# derivative has not been written yet
+SERVE_DISPLAY_IMAGES = bool(int(os.environ.get('SERVE_DISPLAY_IMAGES',
+                                               '1')))
+DISPLAY_FORMAT = os.environ.get('DISPLAY_FORMAT', 'webp')
+
+# HTTP caching. Read-mostly JSON endpoints are cached in process for
+# RESPONSE_CACHE_TTL seconds (0 disables). Fingerprinted static URLs are
+# cached for a year, anything else under /static/ for STATIC_MAX_AGE.
+RESPONSE_CACHE_TTL = float(os.environ.get('RESPONSE_CACHE_TTL', '5'))
+STATIC_MAX_AGE = int(os.environ.get('STATIC_MAX_AGE', '300'))
+STATIC_IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+response_cache = ResponseCache(RESPONSE_CACHE_TTL)
+
+# Prefetch and batched labels for the no-reload labeling page
+NEXT_MAX_COUNT = int(os.environ.get('NEXT_MAX_COUNT', '20'))
+LABEL_BATCH_MAX = int(os.environ.get('LABEL_BATCH_MAX', '100'))
+
+# 'events': labels are appended to label_events by a write-behind buffer
+# and folded into images by compaction. 'sync': the request updates
+# images directly, as before label_events existed.
+LABEL_WRITE_MODE = os.environ.get('LABEL_WRITE_MODE', 'events')
+LABEL_FLUSH_SIZE = int(os.environ.get('LABEL_FLUSH_SIZE', '200'))
+LABEL_FLUSH_INTERVAL = float(os.environ.get('LABEL_FLUSH_INTERVAL', '1'))
+# Seconds between compactions run by each web process, 0 leaves them
+# to labels/compact_labels.py
+LABEL_COMPACT_INTERVAL = float(os.environ.get('LABEL_COMPACT_INTERVAL',
+                                              '30'))
+LABELER_COOKIE = 'labeler'
+LABELER_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+
+# How the labeling queue is filled: 'random' or 'uncertainty'
+SAMPLING_MODE = os.environ.get('SAMPLING_MODE', 'random')
+UNCERTAINTY_WINDOW = int(os.environ.get('UNCERTAINTY_WINDOW', '50'))
+# Seconds a worker holds the images it claims for its labelers, 0 samples
+# without claims (and lets two workers serve the same image)
+CLAIM_LEASE = float(os.environ.get('CLAIM_LEASE', '600'))
+CLAIM_BATCH = int(os.environ.get('CLAIM_BATCH', '10'))
 # Database configuration
 DB_HOST = os.environ.get('DB_HOST')
 DB_NAME = os.environ.get('DB_NAME', 'image-trainer-db')
 DB_USER = os.environ.get('DB_USER', 'image-trainer-user')
 DB_PASSWORD = os.environ.get('DB_PASSWORD')
+# Read replicas, comma separated host:port/name like DB_HOST. Sampling
+# and the read-only API read from them while they are within
+# REPLICA_MAX_LAG seconds of the primary
+DB_READ_HOSTS = [host for host in
+                 os.environ.get('DB_READ_HOSTS', '').split(',') if host]
+REPLICA_MAX_LAG = float(os.environ.get('REPLICA_MAX_LAG', '5'))
+REPLICA_CHECK_INTERVAL = float(os.environ.get('REPLICA_CHECK_INTERVAL',
+                                              '5'))
+REPLICA_RETRY_INTERVAL = float(os.environ.get('REPLICA_RETRY_INTERVAL',
+                                              '30'))
 
 # Print out Variables For Debugging
 logger.info(f"DB_HOST: {DB_HOST}")
@@ -58,13 +149,39 @@ if len(DB_PASSWORD) > 0:
 else:
     logger.info("DB_PASSWORD: Not SET!")
 
-if DB_HOST and DB_PASSWORD:
+# A full SQLAlchemy URI, e.g. for a local database, overrides the above
+DATABASE_URI = os.environ.get('DATABASE_URI')
+# Likewise comma separated URIs override DB_READ_HOSTS
+DATABASE_READ_URIS = [uri for uri in
+                      os.environ.get('DATABASE_READ_URIS', '').split(',')
+                      if uri]
+read_router = None
+
+if DATABASE_URI or (DB_HOST and DB_PASSWORD):
     # Construct database connection string
-    DATABASE_URI = f'postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}'  # noqa
+    if not DATABASE_URI:
+        DATABASE_URI = f'postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}'  # noqa
     app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URI
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    if not DATABASE_READ_URIS:
+        DATABASE_READ_URIS = [
+            f'postgresql://{DB_USER}:{DB_PASSWORD}@{host}'  # noqa
+            for host in DB_READ_HOSTS]
+    # Models have no bind key, so only read_session() uses these
+    app.config['SQLALCHEMY_BINDS'] = {
+        f'replica{index}': uri
+        for index, uri in enumerate(DATABASE_READ_URIS)}
 
     db.init_app(app)
+    if DATABASE_READ_URIS:
+        with app.app_context():
+            read_router = ReadRouter(
+                [db.engines[key] for key in app.config['SQLALCHEMY_BINDS']],
+                primary=db.engine,
+                max_lag=REPLICA_MAX_LAG,
+                check_interval=REPLICA_CHECK_INTERVAL,
+                retry_interval=REPLICA_RETRY_INTERVAL)
+        logger.info(f"Reading from {len(DATABASE_READ_URIS)} replica(s)")
 
     logger.info("Database connection configured successfully")
 else:
@@ -72,9 +189,100 @@ else:
                    database features disabled")
     db = None
     Image_table_base = None  # noqa F811
+    Label_counter_base = None  # noqa F811
+    Label_event_base = None  # noqa F811
+    Image_claim_base = None  # noqa F811
+
+
+def label_log_session():
+    """A session outside any request, for the label writer thread."""
+    with app.app_context():
+        return Session(db.engine)
+
+
+def read_session():
+    """
+    Session for read-only queries: a replica that is caught up when any
+    is configured, db.session otherwise. Replica sessions last until the
+    app context ends. Never write through it.
+    """
+    if read_router is None:
+        return db.session
+    if 'read_session' not in g:
+        engine = read_router.engine()
+        g.read_session = Session(engine) if engine is not None \
+            else db.session
+    return g.read_session
+
+
+def run_read(query):
+    """
+    Run query(session) on read_session(). If a replica fails, skip it
+    for a while and run the query again on the primary.
+    """
+    session = read_session()
+    try:
+        return query(session)
+    except sqlalchemy.exc.OperationalError as e:
+        if session is db.session:
+            raise
+        logger.warning(f"Replica read failed, using the primary: {e}")
+        read_router.mark_down(session.get_bind())
+        g.pop('read_session').close()
+        g.read_session = db.session
+        return query(db.session)
+
+
+@app.teardown_appcontext
+def close_read_session(exception=None):
+    """Close the replica session, db.session is removed by Flask."""
+    session = g.pop('read_session', None)
+    if session is not None and session is not db.session:
+        session.close()
 
 
-def get_image_url_by_db() -> str:
+label_log = LabelLog(
+    Label_event_base, label_log_session,
+    flush_size=LABEL_FLUSH_SIZE, flush_interval=LABEL_FLUSH_INTERVAL,
+    compact_interval=LABEL_COMPACT_INTERVAL
+) if db is not None and LABEL_WRITE_MODE == 'events' else None
+
+
+def worker_id() -> str:
+    """Id of this web worker process in image_claims."""
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+def release_claims():
+    """Give back the claimed images still queued when the worker exits."""
+    names = [name for name, deadline in file_name_cache
+             if deadline is not None]
+    if not names:
+        return
+    with app.app_context():
+        try:
+            released = Image_claim_base.release(db.session, worker_id(),
+                                                names)
+            logger.info(f"Released {released} claimed images")
+        except sqlalchemy.exc.SQLAlchemyError as e:
+            logger.error(f"Error releasing claimed images: {e}")
+
+
+if db is not None and CLAIM_LEASE > 0:
+    atexit.register(release_claims)
+
+
+def next_file_names(count=1) -> list:
+    """
+    Take the file names of the next images to label from the queue,
+    refilling it from the database as often as needed.
+
+    Args:
+        count (int): How many names to take
+
+    Returns:
+        list: Up to count distinct file names, at least one
+    """
     # Initial checks for database feature availability
     if Image_table_base is None or db is None:
         logger.warning("Database features disabled. Cannot get image from DB.")
@@ -83,46 +291,191 @@ def get_image_url_by_db() -> str:
 
     with app.app_context():  # ensures app context!
         try:
-            if len(file_name_cache) == 0:
-                # Call model methods, passing Flask-SQLAlchemy's db.session
-                next_batch = Image_table_base.get_random_unclassified(db.session)  # noqa E501
+            names = []
+            # Random refills can repeat names, so give up after a few
+            refills = count // 10 + 2
+            while len(names) < count:
+                if len(file_name_cache) == 0:
+                    if refills == 0 and names:
+                        break
+                    refills -= 1
+                    next_batch = []
+                    deadline = None
+                    if CLAIM_LEASE > 0:
+                        # Lease the batch so no other worker serves it.
+                        # A name is served only while half its lease is
+                        # left, so its labeler has time to label it
+                        next_batch = Image_claim_base.claim(
+                            db.session, worker_id(), limit=CLAIM_BATCH,
+                            lease=CLAIM_LEASE, order=SAMPLING_MODE)
+                        deadline = time.monotonic() + CLAIM_LEASE / 2
+                    else:
+                        # Call model methods on the read session, a
+                        # replica when one is configured and caught up
+                        if SAMPLING_MODE == 'uncertainty':
+                            # Images the model is least sure about teach
+                            # it most
+                            next_batch = run_read(
+                                lambda session: Image_table_base
+                                .get_most_uncertain(
+                                    session, window=UNCERTAINTY_WINDOW))
 
-                # If no unclassified images, try getting classified ones
-                if len(next_batch) == 0:
-                    logger.warn("We did not find any unclassified images! \
-                                Getting classified images instead.")
-                    next_batch = Image_table_base.get_random_classified(db.session)  # noqa E501
+                        # Rows with no prediction yet are still sampled
+                        # at random
+                        if len(next_batch) == 0:
+                            next_batch = run_read(Image_table_base.get_random_unclassified)  # noqa E501
+                        next_batch = [row.file_name for row in next_batch]
 
-                if not next_batch:
-                    raise RuntimeError("Could not find rows to \
-                                       classify or unclassify")
+                    # If no unclassified images, try getting classified ones
+                    if len(next_batch) == 0:
+                        logger.warn("We did not find any unclassified images! \
+                                    Getting classified images instead.")
+                        next_batch = [row.file_name for row in run_read(
+                            Image_table_base.get_random_classified)]
 
-                # Populate cache with file names
-                for element in next_batch:
-                    file_name_cache.append(element.file_name)
+                    if not next_batch:
+                        raise RuntimeError("Could not find rows to \
+                                           classify or unclassify")
 
-            # Get the next file from the cache
-            next_file = file_name_cache.pop()
+                    # Populate cache with file names
+                    for file_name in next_batch:
+                        file_name_cache.append((file_name, deadline))
 
-            # Return the full URL
-            return f"{cloudfront_url}/{next_file}"
+                # Get the next file from the cache
+                name, deadline = file_name_cache.pop()
+                if deadline is not None and deadline < time.monotonic():
+                    # Soon claimable by other workers again
+                    continue
+                if name not in names:
+                    names.append(name)
+            return names
 
         except sqlalchemy.exc.SQLAlchemyError as e:
             # Catch SQLAlchemy-specific errors, log, rollback, and re-raise
-            logger.error(f"Database error in get_image_url_by_db: {e}")
+            logger.error(f"Database error in next_file_names: {e}")
             db.session.rollback()  # Rollback the session
             raise RuntimeError(f"Database error: {e}")
 
         except Exception as e:
             # Catch any other unexpected errors
             logger.error(f"An unexpected error occurred in \
-                         get_image_url_by_db: {e}")
+                         next_file_names: {e}")
             raise RuntimeError(f"An unexpected error occurred: {e}")
 
         finally:
             pass  # db.session.remove()
 
 
+def next_file_name() -> str:
+    """Get the file name of the next image to label from the queue."""
+    return next_file_names(1)[0]
+
+
+def image_url_for(file_name, display=SERVE_DISPLAY_IMAGES) -> str:
+    """
+    Get the CloudFront URL of an image.
+
+    Args:
+        file_name (str): Source file name, <md5>.<ext>
+        display (bool): URL of the display derivative instead of the
+                        source
+
+    Returns:
+        str: Full URL
+    """
+    if display:
+        md5_hash = file_name.rsplit('.', 1)[0]
+        return f"{cloudfront_url}/display/{md5_hash}.{DISPLAY_FORMAT}"
+    return f"{cloudfront_url}/{file_name}"
+
+
+def get_image_url_by_db(display=SERVE_DISPLAY_IMAGES) -> str:
+    """Get the URL of the next image to label, see image_url_for."""
+    return image_url_for(next_file_name(), display)
+
+
+@lru_cache(maxsize=128)
+def static_fingerprint(filename):
+    """
+    Short hash of a static file's content, or None if it does not exist.
+    Files only change with a new image, so it is computed once.
+    """
+    path = os.path.join(app.static_folder, filename)
+    try:
+        with open(path, 'rb') as handle:
+            return hashlib.md5(handle.read()).hexdigest()[:12]
+    except OSError:
+        return None
+
+
+@app.url_defaults
+def fingerprint_static_urls(endpoint, values):
+    """Add ?v=<content hash> to every url_for('static', ...)."""
+    if endpoint == 'static' and 'v' not in values:
+        fingerprint = static_fingerprint(values.get('filename', ''))
+        if fingerprint:
+            values['v'] = fingerprint
+
+
+@app.after_request
+def static_cache_headers(response):
+    """
+    Let browsers and the proxy keep fingerprinted static files forever,
+    since a change gives them a new URL.
+    """
+    if request.endpoint == 'static' and response.status_code in (200, 304):
+        filename = (request.view_args or {}).get('filename', '')
+        fingerprint = static_fingerprint(filename)
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        if fingerprint and request.args.get('v') == fingerprint:
+            response.cache_control.max_age = STATIC_IMMUTABLE_MAX_AGE
+            response.cache_control.immutable = True
+        else:
+            response.cache_control.max_age = STATIC_MAX_AGE
+    return response
+
+
+def conditional(response):
+    """
+    Give a 200 JSON response an ETag, and answer a matching
+    If-None-Match with 304 Not Modified. Clients must revalidate.
+    """
+    if response.status_code != 200 or response.is_streamed:
+        return response
+    if response.get_etag()[0] is None:
+        response.add_etag()
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
+def cached_json(view):
+    """
+    Serve a read-mostly JSON endpoint from response_cache, keyed by the
+    full path and query string, with ETag support. Streamed and error
+    responses are never cached.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        key = request.full_path
+        entry = response_cache.get(key)
+        if entry is not None:
+            body, mimetype, etag = entry
+            response = Response(body, mimetype=mimetype)
+            response.set_etag(etag)
+            response.headers['X-Cache'] = 'HIT'
+            return conditional(response)
+
+        response = make_response(view(*args, **kwargs))
+        if response.status_code == 200 and not response.is_streamed:
+            response.add_etag()
+            response_cache.set(key, (response.get_data(), response.mimetype,
+                                     response.get_etag()[0]))
+            response.headers['X-Cache'] = 'MISS'
+        return conditional(response)
+    return wrapper
+
+
 def get_image_url() -> str:
     """Function to get the external image URL from environment variable."""
     image_url = cloudfront_access.get_random()[0]
@@ -134,22 +487,162 @@ def extract_filename_from_url(url):
     return url.split('/')[-1]
 
 
+def labeler_id():
+    """Get the labeler id from the labeler cookie, or None."""
+    value = request.cookies.get(LABELER_COOKIE, '')
+    return value if LABELER_PATTERN.match(value) else None
+
+
+def record_labels(labels) -> list:
+    """
+    Record (file_name, label) pairs as LABEL_WRITE_MODE says.
+
+    In 'events' mode they are buffered and written behind. When the
+    buffer is full they are appended to label_events and folded into
+    images within the request instead, so they still have their place
+    in the log and a buffered older label can't overwrite them.
+
+    Returns:
+        list: 'queued', 'applied' or 'not_found' per label
+
+    Raises:
+        sqlalchemy.exc.SQLAlchemyError: If a synchronous write fails
+    """
+    if label_log is None:
+        updated = Image_table_base.apply_labels(db.session, labels)
+    elif label_log.append(labels, labeler_id()):
+        return ['queued'] * len(labels)
+    else:
+        updated = Label_event_base.apply(
+            db.session, label_events(labels, labeler_id()))
+    response_cache.clear()
+    return ['applied' if name in updated else 'not_found'
+            for name, _ in labels]
+
+
 @app.route('/')
 def index():
-    # Get the image URL server-side and pass it to the template
-    image_url = get_image_url_by_db()
+    # Get the image URLs server-side and pass them to the template. The
+    # forms post the source URL, which names the row to update.
+    file_name = next_file_name()
+    image_url = image_url_for(file_name)
+    source_url = image_url_for(file_name, display=False)
     selected_gender = request.args.get('gender', None)
     message = None
 
     if selected_gender:
         message = f"You selected: {selected_gender.upper()}"
 
-    return render_template(
+    response = make_response(render_template(
         'index.html',
+        file_name=file_name,
         image_url=image_url,
+        source_url=source_url,
         selected_gender=selected_gender,
-        message=message
-    )
+        message=message,
+        prefetch_count=min(5, NEXT_MAX_COUNT),
+        label_batch_max=LABEL_BATCH_MAX
+    ))
+    # An anonymous id per browser, so label events can be compared
+    # between labelers
+    if labeler_id() is None:
+        response.set_cookie(LABELER_COOKIE, uuid.uuid4().hex,
+                            max_age=365 * 24 * 3600, httponly=True,
+                            samesite='Lax')
+    return response
+
+
+@app.route('/api/next')
+def get_next_images():
+    """
+    Take the next images to label from the queue, for the page to
+    prefetch.
+
+    Query parameters:
+        n: How many images, capped at NEXT_MAX_COUNT (default 1)
+    """
+    if Image_table_base is None or db is None:
+        return jsonify({"error": "Database not configured"}), 500
+    try:
+        count = int(request.args.get('n', 1))
+    except ValueError:
+        return jsonify({"error": "n must be an integer"}), 400
+    if count < 1:
+        return jsonify({"error": "n must be positive"}), 400
+
+    try:
+        names = next_file_names(min(count, NEXT_MAX_COUNT))
+    except RuntimeError as e:
+        logger.error(f"Error getting next images: {e}")
+        return jsonify({"error": "Could not get images"}), 500
+    return jsonify({'images': [{
+        'file_name': name,
+        'image_url': image_url_for(name),
+        'source_url': image_url_for(name, display=False)
+    } for name in names]})
+
+
+@app.route('/api/labels', methods=['POST'])
+def post_labels():
+    """
+    Apply a batch of labels in one transaction.
+
+    The body is parsed whatever its Content-Type, so pages can flush
+    pending labels with navigator.sendBeacon while unloading.
+
+    Body: {"labels": [{"file_name": ..., "label": "male" | "female" |
+           "trash"}, ...]}
+    """
+    if Image_table_base is None or db is None:
+        return jsonify({"error": "Database not configured"}), 500
+    items = (request.get_json(force=True, silent=True) or {}).get('labels')
+    if not isinstance(items, list) or not items:
+        return jsonify({"error": "labels must be a non-empty list"}), 400
+    if len(items) > LABEL_BATCH_MAX:
+        return jsonify({"error": f"At most {LABEL_BATCH_MAX} labels "
+                                 f"per batch"}), 400
+
+    labels = []
+    for item in items:
+        if not isinstance(item, dict) or \
+                not isinstance(item.get('file_name'), str) or \
+                item.get('label') not in LABELS:
+            return jsonify({"error": f"Each label needs a file_name and a "
+                                     f"label in {', '.join(LABELS)}"}), 400
+        labels.append((extract_filename_from_url(item['file_name']),
+                       item['label']))
+
+    try:
+        statuses = record_labels(labels)
+    except sqlalchemy.exc.SQLAlchemyError as e:
+        logger.error(f"Error applying labels: {e}")
+        db.session.rollback()
+        return jsonify({"error": "Database error"}), 500
+
+    return jsonify({'labels': [
+        {'file_name': name, 'status': status}
+        for (name, _), status in zip(labels, statuses)
+    ]})
+
+
+@app.route('/api/labels/agreement')
+@cached_json
+def get_label_agreement():
+    """
+    Agreement between labelers who labeled the same images, from
+    label_events, and how many events compaction has not folded yet.
+    """
+    if Label_event_base is None:
+        return jsonify({"error": "Database not configured"}), 500
+    try:
+        agreement = run_read(Label_event_base.agreement)
+        agreement['pending_events'] = run_read(
+            Label_event_base.pending_count)
+    except sqlalchemy.exc.SQLAlchemyError as e:
+        logger.error(f"Error computing label agreement: {e}")
+        db.session.rollback()
+        return jsonify({"error": "Database error"}), 500
+    return jsonify(agreement)
 
 
 @app.route('/select-gender', methods=['POST'])
@@ -174,9 +667,10 @@ def select_gender():
 
         # Update the database with the gender selection
         try:
-            # Convert gender string to boolean
-            is_masc = gender.lower() == 'male'
-            Image_table_base.update_gender(db.session, filename, is_masc)
+            label = 'male' if gender.lower() == 'male' else 'female'
+            if record_labels([(filename, label)]) == ['not_found']:
+                raise ValueError(f"Image with file_name '{filename}' "
+                                 f"not found")
             logger.info(f'Successfully updated database for \
                         {filename} with gender: {gender}')
         except ValueError as e:
@@ -208,7 +702,9 @@ def trash_image():
 
     if filename is not None:
         try:
-            Image_table_base.trash_file(db.session, filename)
+            if record_labels([(filename, 'trash')]) == ['not_found']:
+                raise ValueError(f"Image with file_name '{filename}' "
+                                 f"not found")
             logger.info(f'Successfully trashed image: {filename}')
             message = f"Trashed image {filename}"
         except ValueError as e:
@@ -234,23 +730,311 @@ def trash_image():
 @app.route('/health')
 def health():
     container_name = os.environ.get('CONTAINER_NAME', 'web')
-    return jsonify({"message": f"{container_name} is up"}), 200
+    body = {"message": f"{container_name} is up"}
+    if read_router is not None:
+        # Last known state only, health checks never query the database
+        body['replicas'] = read_router.status()
+    return jsonify(body), 200
+
+
+def serialize_row(row: dict) -> dict:
+    """Make a row dict JSON safe (timestamps become ISO 8601 strings)."""
+    return {
+        key: value.isoformat() if isinstance(value, datetime) else value
+        for key, value in row.items()
+    }
 
 
 @app.route('/api/images')
+@cached_json
 def get_images():
-    """Get all images from the database."""
+    """
+    Get images from the database, one keyset page at a time.
+
+    Query parameters:
+        after_id: Only return rows with a larger id (default 0)
+        limit: Page size, capped at API_MAX_PAGE_SIZE
+        filter: all, classified, unclassified, trashed, mismatch or
+                duplicate
+        fields: Comma separated columns to return (default all)
+        format: 'json' for a page, 'ndjson' to stream every matching row
+
+    An ndjson stream always includes id. If the database fails part way
+    the stream ends with {"error": ..., "after_id": ...}, the id of the
+    last row sent, and can be resumed by requesting after_id from there.
+    A stream whose last line is a row is complete.
+    """
     if Image_table_base is None:
         return jsonify({"error": "Database not configured"}), 500
 
     try:
-        images = Image_table_base.query.all()
-        return jsonify([img.to_dict() for img in images])
+        after_id = int(request.args.get('after_id', 0))
+        limit = min(int(request.args.get('limit', API_PAGE_SIZE)),
+                    API_MAX_PAGE_SIZE)
+    except ValueError:
+        return jsonify({"error": "after_id and limit must be integers"}), 400
+    if limit < 1:
+        return jsonify({"error": "limit must be positive"}), 400
+
+    status = request.args.get('filter', 'all')
+    fields = request.args.get('fields')
+    fields = [f.strip() for f in fields.split(',')] if fields else None
+    output_format = request.args.get('format', 'json')
+    if output_format not in API_FORMATS:
+        return jsonify({"error": f"format must be one of "
+                                 f"{', '.join(API_FORMATS)}"}), 400
+
+    try:
+        # Validate the filter and projection before any streaming starts
+        Image_table_base.filtered_query(read_session(), status, fields)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    if output_format == 'ndjson':
+        def generate():
+            last_id = after_id
+            try:
+                for row in Image_table_base.stream_rows(
+                        read_session(), after_id, status, fields,
+                        STREAM_BATCH_SIZE):
+                    yield json.dumps(serialize_row(row)) + '\n'
+                    last_id = row['id']
+            except sqlalchemy.exc.SQLAlchemyError as e:
+                # The 200 is already sent, so a truncated export has to
+                # say so in its body
+                logger.error(f"Error streaming images after id "
+                             f"{last_id}: {e}")
+                read_session().rollback()
+                yield json.dumps({"error": "Database error",
+                                  "after_id": last_id}) + '\n'
+
+        # X-Accel-Buffering lets nginx pass chunks through as they arrive
+        return Response(stream_with_context(generate()),
+                        mimetype='application/x-ndjson',
+                        headers={'X-Accel-Buffering': 'no'})
+
+    try:
+        page, next_after_id = run_read(
+            lambda session: Image_table_base.keyset_page(
+                session, after_id, limit, status, fields))
+        return jsonify({
+            'images': [serialize_row(row) for row in page],
+            'next_after_id': next_after_id
+        })
     except Exception as e:
         logger.error(f"Error fetching images: {e}")
         return jsonify({"error": "Database error"}), 500
 
 
+@app.route('/api/stats')
+@cached_json
+def get_stats():
+    """
+    Get labeling progress from the trigger-maintained label counters.
+
+    Reads a few primary key rows, so polling dashboards cost next to
+    nothing on the database.
+    """
+    if Label_counter_base is None:
+        return jsonify({"error": "Database not configured"}), 500
+
+    try:
+        counts = run_read(Label_counter_base.get_counts)
+    except sqlalchemy.exc.SQLAlchemyError as e:
+        logger.error(f"Error fetching label counters: {e}")
+        db.session.rollback()
+        return jsonify({"error": "Database error"}), 500
+
+    compared = counts['agree'] + counts['disagree']
+    counts['agreement_rate'] = (
+        counts['agree'] / compared if compared else None
+    )
+    return jsonify(counts)
+
+
+def parse_upload(item) -> tuple:
+    """
+    Validate one file description from an upload request.
+
+    Args:
+        item (dict): {'md5': hex digest, 'extension': 'jpg' | 'jpeg' |
+                      'png', 'size': bytes (optional for /complete)}
+
+    Returns:
+        tuple: (md5, extension, size or None)
+
+    Raises:
+        ValueError: If any field is missing or not allowed
+    """
+    if not isinstance(item, dict):
+        raise ValueError("Each file must be an object")
+    md5 = str(item.get('md5', '')).lower()
+    if not MD5_PATTERN.match(md5):
+        raise ValueError("md5 must be 32 hex characters")
+    extension = str(item.get('extension', '')).lower().lstrip('.')
+    if extension not in UPLOAD_CONTENT_TYPES:
+        raise ValueError(f"extension must be one of "
+                         f"{', '.join(UPLOAD_CONTENT_TYPES)}")
+    size = item.get('size')
+    if size is not None:
+        if not isinstance(size, int) or not 0 < size <= UPLOAD_MAX_BYTES:
+            raise ValueError(f"size must be between 1 and "
+                             f"{UPLOAD_MAX_BYTES} bytes")
+    return md5, extension, size
+
+
+def presign_upload(md5, extension, size) -> dict:
+    """
+    Presign a POST of one image straight to sources/<md5>.<ext>.
+
+    S3 checks the body against Content-MD5, so the object can only ever
+    hold the bytes its name claims.
+    """
+    content_type = UPLOAD_CONTENT_TYPES[extension]
+    content_md5 = base64.b64encode(bytes.fromhex(md5)).decode()
+    key = f"sources/{md5}.{extension}"
+    post = cloudfront_access.generate_presigned_post(
+        key,
+        fields={'Content-Type': content_type, 'Content-MD5': content_md5},
+        conditions=[
+            {'Content-Type': content_type},
+            {'Content-MD5': content_md5},
+            ['content-length-range', size, size]
+        ],
+        expires_in=UPLOAD_URL_EXPIRES)
+    if post is None:
+        raise RuntimeError(f"Could not presign upload to {key}")
+    return {'md5': md5, 'status': 'upload', 'key': key,
+            'url': post['url'], 'fields': post['fields']}
+
+
+def plan_uploads(items) -> list:
+    """
+    Presign uploads for the files that are not stored yet. Duplicates
+    are found with one indexed lookup for the whole list.
+    """
+    files = [parse_upload(item) for item in items]
+    for md5, extension, size in files:
+        if size is None:
+            raise ValueError("size is required")
+
+    existing = Image_table_base.find_by_hashes(
+        db.session, {md5 for md5, _, _ in files})
+    planned, seen = [], set()
+    for md5, extension, size in files:
+        if md5 in existing:
+            planned.append({'md5': md5, 'status': 'duplicate',
+                            'file_name': existing[md5]})
+        elif md5 in seen:
+            planned.append({'md5': md5, 'status': 'duplicate_in_batch'})
+        else:
+            seen.add(md5)
+            planned.append(presign_upload(md5, extension, size))
+    return planned
+
+
+def upload_error(e):
+    """Map an upload planning error to a JSON response."""
+    if isinstance(e, ValueError):
+        return jsonify({"error": str(e)}), 400
+    logger.error(f"Error planning uploads: {e}")
+    if isinstance(e, sqlalchemy.exc.SQLAlchemyError):
+        db.session.rollback()
+    return jsonify({"error": "Could not plan upload"}), 500
+
+
+@app.route('/upload')
+def upload_page():
+    return render_template('upload.html', max_bytes=UPLOAD_MAX_BYTES,
+                           batch_max=UPLOAD_BATCH_MAX)
+
+
+@app.route('/api/uploads', methods=['POST'])
+def create_upload():
+    """
+    Get a presigned POST for one image, named by the MD5 the browser
+    computed. Returns status 'duplicate' and no URL when the image is
+    already stored.
+
+    Body: {"md5": ..., "extension": ..., "size": ...}
+    """
+    if Image_table_base is None or cloudfront_access is None:
+        return jsonify({"error": "Uploads not configured"}), 500
+    try:
+        return jsonify(plan_uploads([request.get_json(silent=True)])[0])
+    except (ValueError, RuntimeError,
+            sqlalchemy.exc.SQLAlchemyError) as e:
+        return upload_error(e)
+
+
+@app.route('/api/uploads/batch', methods=['POST'])
+def create_uploads():
+    """
+    Batch form of /api/uploads for bulk uploads.
+
+    Body: {"files": [{"md5": ..., "extension": ..., "size": ...}, ...]}
+    """
+    if Image_table_base is None or cloudfront_access is None:
+        return jsonify({"error": "Uploads not configured"}), 500
+    items = (request.get_json(silent=True) or {}).get('files')
+    if not isinstance(items, list) or not items:
+        return jsonify({"error": "files must be a non-empty list"}), 400
+    if len(items) > UPLOAD_BATCH_MAX:
+        return jsonify({"error": f"At most {UPLOAD_BATCH_MAX} files "
+                                 f"per batch"}), 400
+    try:
+        return jsonify({'files': plan_uploads(items)})
+    except (ValueError, RuntimeError,
+            sqlalchemy.exc.SQLAlchemyError) as e:
+        return upload_error(e)
+
+
+@app.route('/api/uploads/complete', methods=['POST'])
+def complete_uploads():
+    """
+    Report on images the browser has finished uploading. make_numpy
+    writes their rows once it has checked them for size and
+    near-duplicates, so an upload in S3 without a row is 'pending'.
+    Uploads that are not in S3 (or were dropped by those checks) are
+    reported missing.
+
+    Body: {"files": [{"md5": ..., "extension": ...}, ...]}
+    """
+    if Image_table_base is None or cloudfront_access is None:
+        return jsonify({"error": "Uploads not configured"}), 500
+    items = (request.get_json(silent=True) or {}).get('files')
+    if not isinstance(items, list) or not items:
+        return jsonify({"error": "files must be a non-empty list"}), 400
+    if len(items) > UPLOAD_BATCH_MAX:
+        return jsonify({"error": f"At most {UPLOAD_BATCH_MAX} files "
+                                 f"per batch"}), 400
+    try:
+        files = [parse_upload(item) for item in items]
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    try:
+        registered = set(Image_table_base.find_by_hashes(
+            db.session, [md5 for md5, _, _ in files]).values())
+    except sqlalchemy.exc.SQLAlchemyError as e:
+        logger.error(f"Error looking up uploads: {e}")
+        db.session.rollback()
+        return jsonify({"error": "Database error"}), 500
+
+    results = []
+    for md5, extension, _ in files:
+        file_name = f"{md5}.{extension}"
+        if file_name in registered:
+            status = 'registered'
+        elif cloudfront_access.object_exists(f"sources/{file_name}"):
+            status = 'pending'
+        else:
+            status = 'missing'
+        results.append({'md5': md5, 'file_name': file_name,
+                        'status': status})
+    return jsonify({'files': results})
+
+
 @app.route('/api/images/random')
 def get_random_images():
     """Get 10 random unclassified images."""
@@ -258,8 +1042,8 @@ def get_random_images():
         return jsonify({"error": "Database not configured"}), 500
 
     try:
-        random_images = Image_table_base.get_random_unclassified(10)
-        return jsonify([img.to_dict() for img in random_images])
+        random_images = run_read(Image_table_base.get_random_unclassified)
+        return conditional(jsonify([img.to_dict() for img in random_images]))
     except Exception as e:
         logger.error(f"Error fetching random images: {e}")
         return jsonify({"error": "Database error"}), 500
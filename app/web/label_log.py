@@ -0,0 +1,220 @@
+"""
+Write-behind buffer for label events.
+
+Requests append labels to an in-memory buffer and return at once. A
+background thread writes the buffer to label_events in batches, and
+every compact_interval seconds folds pending events into images (see
+Label_event_base.compact).
+
+Labels that are buffered but not written yet are lost if the process is
+killed; they are flushed on a normal shutdown.
+"""
+import atexit
+import logging
+import threading
+import time
+from collections import deque
+from datetime import datetime, timezone
+
+from sqlalchemy.exc import IntegrityError
+
+logger = logging.getLogger(__name__)
+
+
+def label_events(labels, labeler=None) -> list:
+    """
+    Events for labels given now.
+
+    Args:
+        labels (list): (file_name, label) pairs
+        labeler (str): Id of who gave them
+
+    Returns:
+        list: (file_name, label, labeler, created_at) tuples, created_at
+        in naive UTC like the label_events column
+    """
+    created_at = datetime.now(timezone.utc).replace(tzinfo=None)
+    return [(file_name, label, labeler, created_at)
+            for file_name, label in labels]
+
+
+class LabelLog:
+    """Buffers label events for one web process and writes them behind."""
+
+    def __init__(self, event_model, session_factory, flush_size=200,
+                 flush_interval=1.0, max_buffer=10000, compact_interval=30,
+                 compact_batch=5000):
+        """
+        Args:
+            event_model: Label_event_base, or a model with the same
+                         append and compact classmethods
+            session_factory (callable): Returns a new SQLAlchemy session
+            flush_size (int): Write as soon as this many are buffered
+            flush_interval (float): Otherwise write every so many seconds
+            max_buffer (int): Events held before append() refuses more
+            compact_interval (float): Seconds between compactions, 0 to
+                                      leave compaction to the job
+            compact_batch (int): Events folded per compaction statement
+        """
+        self.event_model = event_model
+        self.session_factory = session_factory
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self.compact_interval = compact_interval
+        self.compact_batch = compact_batch
+
+        self._buffer = deque()
+        self._condition = threading.Condition()
+        self._thread = None
+        self._stopping = False
+        self._registered = False
+        self._last_compact = time.monotonic()
+        self.stats = {'appended': 0, 'written': 0, 'dropped_unknown': 0,
+                      'dropped_invalid': 0, 'flushes': 0, 'flush_errors': 0,
+                      'compacted': 0}
+
+    def append(self, labels, labeler=None) -> bool:
+        """
+        Buffer labels for writing.
+
+        Args:
+            labels (list): (file_name, label) pairs
+            labeler (str): Id of who gave them
+
+        Returns:
+            bool: False if the buffer is full and nothing was buffered,
+            so the caller can write synchronously instead
+        """
+        events = label_events(labels, labeler)
+        with self._condition:
+            if len(self._buffer) + len(events) > self.max_buffer:
+                return False
+            self._buffer.extend(events)
+            self.stats['appended'] += len(labels)
+            if len(self._buffer) >= self.flush_size:
+                self._condition.notify()
+        self._start()
+        return True
+
+    def pending(self) -> int:
+        """Events buffered and not written yet."""
+        return len(self._buffer)
+
+    def flush(self) -> int:
+        """
+        Write everything buffered now.
+
+        A batch that breaks a constraint (say, an event for an image
+        deleted since it was buffered) is split in halves that are
+        written on their own, down to single events. Those are logged
+        and dropped, so one bad event can't hold back the others. On
+        any other database error the events not written yet go back to
+        the front of the buffer and are retried by the next flush.
+
+        Returns:
+            int: Events written
+        """
+        with self._condition:
+            batch = list(self._buffer)
+            self._buffer.clear()
+        if not batch:
+            return 0
+
+        # Chunks still to write, the next one last
+        chunks = [batch]
+        written = processed = 0
+        failed = False
+        session = self.session_factory()
+        try:
+            while chunks:
+                chunk = chunks.pop()
+                try:
+                    written += self.event_model.append(session, chunk)
+                    processed += len(chunk)
+                except IntegrityError as e:
+                    session.rollback()
+                    if len(chunk) > 1:
+                        middle = len(chunk) // 2
+                        chunks += [chunk[middle:], chunk[:middle]]
+                        continue
+                    logger.error(f"Dropping label event {chunk[0]}: "
+                                 f"{e.orig}")
+                    self.stats['dropped_invalid'] += 1
+        except Exception as e:
+            unwritten = chunk + [event for pending in reversed(chunks)
+                                 for event in pending]
+            logger.error(f"Error writing {len(unwritten)} label events: "
+                         f"{e}")
+            session.rollback()
+            with self._condition:
+                self._buffer.extendleft(reversed(unwritten))
+            self.stats['flush_errors'] += 1
+            failed = True
+        finally:
+            session.close()
+
+        if not failed:
+            self.stats['flushes'] += 1
+        self.stats['written'] += written
+        self.stats['dropped_unknown'] += processed - written
+        return written
+
+    def compact(self) -> int:
+        """Fold pending events into images until none are left."""
+        session = self.session_factory()
+        folded = 0
+        try:
+            while True:
+                result = self.event_model.compact(session,
+                                                  self.compact_batch)
+                folded += result['events']
+                if result['events'] < self.compact_batch:
+                    break
+        except Exception as e:
+            logger.error(f"Error compacting label events: {e}")
+            session.rollback()
+        finally:
+            session.close()
+        self.stats['compacted'] += folded
+        return folded
+
+    def stop(self, timeout=5.0) -> None:
+        """Stop the writer thread after a last flush."""
+        with self._condition:
+            self._stopping = True
+            self._condition.notify()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self.flush()
+
+    def _start(self):
+        """Start the writer thread on first use, in the serving process."""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._condition:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stopping = False
+            self._thread = threading.Thread(target=self._run,
+                                            name='label-log', daemon=True)
+            self._thread.start()
+            if not self._registered:
+                atexit.register(self.stop)
+                self._registered = True
+
+    def _run(self):
+        while True:
+            with self._condition:
+                if not self._stopping and \
+                        len(self._buffer) < self.flush_size:
+                    self._condition.wait(self.flush_interval)
+                stopping = self._stopping
+            self.flush()
+            if self.compact_interval and \
+                    time.monotonic() - self._last_compact >= \
+                    self.compact_interval:
+                self._last_compact = time.monotonic()
+                self.compact()
+            if stopping:
+                return
@@ -0,0 +1,187 @@
+"""
+Routes read-only queries to PostgreSQL read replicas.
+
+Writes always go to the primary through db.session. Reads that can take
+slightly stale data (/api/images, /api/stats, sampling the labeling
+queue when image claims are off) ask ReadRouter.engine() for a
+replica. Replicas are used in turn, skipping any that lag more than
+max_lag seconds or failed recently; when none qualifies the caller
+falls back to the primary.
+
+Lag is measured against the primary: a replica that has replayed the
+primary's current WAL position is current, otherwise it is as old as
+the last transaction it replayed. A replica whose WAL receiver is not
+streaming is down, as it would otherwise look current while serving
+data of any age.
+"""
+import itertools
+import logging
+import threading
+import time
+
+from sqlalchemy import text
+
+logger = logging.getLogger(__name__)
+
+# Read on the primary before the replica, so a replica that replayed up
+# to it was current at least then
+PRIMARY_LSN_SQL = text("SELECT CAST(pg_current_wal_lsn() AS text)")
+
+# The replica's side. receiver is NULL without a WAL receiver process,
+# and 'unknown' when the role may not read its status. Without a
+# primary LSN, replaying everything received counts as caught up.
+REPLICA_SQL = text("""
+    SELECT pg_is_in_recovery() AS in_recovery,
+        (SELECT COALESCE(status, 'unknown')
+         FROM pg_stat_wal_receiver) AS receiver,
+        CASE WHEN CAST(:primary_lsn AS text) IS NULL
+            THEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn()
+            ELSE pg_last_wal_replay_lsn() >= CAST(:primary_lsn AS pg_lsn)
+        END AS caught_up,
+        EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+            AS replay_age
+""")
+
+
+class ReplicaDownError(Exception):
+    """The replica is reachable but not replicating."""
+
+
+def name(engine) -> str:
+    """Host of a replica engine, for logs (the file for SQLite)."""
+    return engine.url.host or engine.url.database
+
+
+class ReadRouter:
+    """Picks a caught-up replica engine for read-only queries."""
+
+    def __init__(self, engines, primary=None, max_lag=5.0,
+                 check_interval=5.0, retry_interval=30.0,
+                 clock=time.monotonic):
+        """
+        Args:
+            engines (list): SQLAlchemy engines of the replicas
+            primary: Engine of the primary, whose WAL position replicas
+                     are measured against
+            max_lag (float): Replicas further behind are skipped
+            check_interval (float): Seconds a measured lag is trusted
+            retry_interval (float): Seconds a failed replica is skipped
+            clock (callable): Returns the current time in seconds
+        """
+        self.engines = list(engines)
+        self.primary = primary
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.retry_interval = retry_interval
+        self.clock = clock
+
+        self._lock = threading.Lock()
+        self._turn = itertools.count()
+        # Per engine: last measured lag, when it was measured and until
+        # when the replica is skipped after a failure
+        self._state = {id(engine): {'lag': None, 'checked': None,
+                                    'down_until': None}
+                       for engine in self.engines}
+        self.stats = {'replica': 0, 'primary': 0, 'lagging': 0,
+                      'failures': 0}
+
+    def engine(self):
+        """
+        The replica engine to read from next.
+
+        Returns:
+            Engine: A replica, or None to read from the primary
+        """
+        start = next(self._turn)
+        for offset in range(len(self.engines)):
+            engine = self.engines[(start + offset) % len(self.engines)]
+            lag = self.lag(engine)
+            if lag is None:
+                continue
+            if lag <= self.max_lag:
+                self._count('replica')
+                return engine
+            self._count('lagging')
+        self._count('primary')
+        return None
+
+    def lag(self, engine):
+        """
+        Replication lag of engine in seconds, measured at most every
+        check_interval seconds.
+
+        Returns:
+            float: Seconds behind, or None while the replica is down
+        """
+        state = self._state[id(engine)]
+        now = self.clock()
+        if state['down_until'] is not None and now < state['down_until']:
+            return None
+        if state['checked'] is not None and \
+                now - state['checked'] < self.check_interval:
+            return state['lag']
+
+        try:
+            lag = self.measure(engine)
+        except ReplicaDownError as e:
+            logger.warning(f"Replica {name(engine)} is down: {e}")
+            self.mark_down(engine)
+            return None
+        except Exception as e:
+            logger.warning(f"Replica {name(engine)} is unreachable: {e}")
+            self.mark_down(engine)
+            return None
+        with self._lock:
+            state.update(lag=lag, checked=now, down_until=None)
+        if lag > self.max_lag:
+            logger.warning(f"Replica {name(engine)} is {lag:.1f}s "
+                           f"behind, reading from the primary")
+        return lag
+
+    def measure(self, engine) -> float:
+        """
+        Seconds the replica is behind the primary (PostgreSQL only).
+
+        Raises:
+            ReplicaDownError: If its WAL receiver is not streaming
+        """
+        if engine.dialect.name != 'postgresql':
+            return 0.0
+        primary_lsn = None
+        if self.primary is not None and \
+                self.primary.dialect.name == 'postgresql':
+            with self.primary.connect() as connection:
+                primary_lsn = connection.execute(PRIMARY_LSN_SQL).scalar()
+        with engine.connect() as connection:
+            row = connection.execute(
+                REPLICA_SQL, {'primary_lsn': primary_lsn}).one()
+        if not row.in_recovery:
+            return 0.0
+        if row.receiver not in ('streaming', 'unknown'):
+            raise ReplicaDownError(f"WAL receiver is "
+                                   f"{row.receiver or 'not running'}")
+        if row.caught_up:
+            return 0.0
+        if row.replay_age is None:
+            raise ReplicaDownError("behind and has replayed nothing yet")
+        return float(row.replay_age)
+
+    def mark_down(self, engine) -> None:
+        """Skip engine for retry_interval seconds after an error."""
+        with self._lock:
+            self._state[id(engine)].update(
+                checked=None, down_until=self.clock() + self.retry_interval)
+            self.stats['failures'] += 1
+
+    def status(self) -> list:
+        """Last known lag and availability of every replica."""
+        now = self.clock()
+        return [{'host': name(engine),
+                 'lag': self._state[id(engine)]['lag'],
+                 'down': self._state[id(engine)]['down_until'] is not None
+                 and now < self._state[id(engine)]['down_until']}
+                for engine in self.engines]
+
+    def _count(self, key):
+        with self._lock:
+            self.stats[key] += 1
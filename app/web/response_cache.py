@@ -0,0 +1,72 @@
+"""
+In-process TTL cache for JSON responses of read-mostly endpoints.
+
+Each web worker keeps its own copy, so a cached response can be up to
+ttl seconds stale after another worker writes. Writes made by this
+worker clear it straight away.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+
+class ResponseCache:
+    """
+    Least recently used cache of (body, mimetype, etag) entries that
+    expire ttl seconds after they were stored.
+    """
+
+    def __init__(self, ttl, max_entries=256, clock=time.monotonic):
+        """
+        Args:
+            ttl (float): Seconds an entry stays fresh, 0 disables caching
+            max_entries (int): Entries kept before the oldest is dropped
+            clock (callable): Returns the current time in seconds
+        """
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        """Whether entries are stored at all."""
+        return self.ttl > 0
+
+    def get(self, key):
+        """Get a fresh entry, or None."""
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > self.clock():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def set(self, key, value) -> None:
+        """Store an entry for ttl seconds."""
+        if not self.enabled:
+            return
+        with self._lock:
+            self._entries[key] = (self.clock() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        """Drop every entry, after a write that may change responses."""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        """Hit and miss counts since start."""
+        return {'hits': self.hits, 'misses': self.misses,
+                'entries': len(self._entries)}
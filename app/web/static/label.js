@@ -0,0 +1,188 @@
+// Labeling without page reloads.
+// 1. Keep a queue of the next images from /api/next. Each one is already
+//    downloading in a detached Image, so the switch to it is instant.
+// 2. A click records the label locally and shows the next image.
+// 3. Labels go to /api/labels in batches: after flushSize labels, after
+//    flushDelay ms, and with sendBeacon when the page is hidden.
+// Without JavaScript the forms still post to /select-gender and
+// /trash-image as before.
+(function () {
+    'use strict';
+
+    var config = window.LABEL_CONFIG;
+    var image = document.getElementById('main-image');
+    var status = document.getElementById('label-status');
+    var current = config.current;
+    var queue = [];
+    var pending = [];
+    var fetching = null;
+    var flushTimer = null;
+    var waiting = false;
+
+    function setStatus(text) {
+        status.textContent = text;
+    }
+
+    function preload(entry) {
+        var loader = new Image();
+        loader.onerror = function () {
+            // No display derivative yet, use the source instead
+            loader.onerror = null;
+            entry.image_url = entry.source_url;
+            loader.src = entry.source_url;
+        };
+        loader.src = entry.image_url;
+        // Keep a reference so the download is not dropped
+        entry.loader = loader;
+        return entry;
+    }
+
+    function isKnown(fileName) {
+        return fileName === current.file_name ||
+            queue.some(function (entry) {
+                return entry.file_name === fileName;
+            });
+    }
+
+    function refill() {
+        if (fetching || queue.length > config.prefetch / 2) {
+            return fetching || Promise.resolve();
+        }
+        fetching = fetch(config.nextUrl + '?n=' + config.prefetch,
+                         {credentials: 'same-origin'})
+            .then(function (response) {
+                if (!response.ok) {
+                    throw new Error('server returned ' + response.status);
+                }
+                return response.json();
+            })
+            .then(function (data) {
+                data.images.forEach(function (entry) {
+                    if (!isKnown(entry.file_name)) {
+                        queue.push(preload(entry));
+                    }
+                });
+            })
+            .catch(function (error) {
+                setStatus('Could not load images: ' + error.message);
+            })
+            .then(function () {
+                fetching = null;
+            });
+        return fetching;
+    }
+
+    function show(entry) {
+        current = entry;
+        image.onerror = function () {
+            image.onerror = null;
+            image.src = entry.source_url;
+        };
+        image.src = entry.image_url;
+        // Keep the no-JavaScript forms pointing at the shown image
+        Array.prototype.forEach.call(
+            document.getElementsByName('current_image_url'),
+            function (input) { input.value = entry.source_url; });
+    }
+
+    function advance() {
+        var entry = queue.shift();
+        if (entry) {
+            show(entry);
+            refill();
+            return;
+        }
+        // The queue ran dry, wait for the request already on its way
+        waiting = true;
+        setStatus('Loading...');
+        refill().then(function () {
+            waiting = false;
+            if (queue.length) {
+                setStatus('');
+                advance();
+            }
+        });
+    }
+
+    function postLabels(batch) {
+        return fetch(config.labelsUrl, {
+            method: 'POST',
+            credentials: 'same-origin',
+            headers: {'Content-Type': 'application/json'},
+            body: JSON.stringify({labels: batch})
+        }).then(function (response) {
+            // Retry server errors; a rejected batch would fail again
+            if (response.status >= 500) {
+                throw new Error('server returned ' + response.status);
+            }
+            if (!response.ok) {
+                setStatus('Labels were rejected (' + response.status + ')');
+            }
+        });
+    }
+
+    function scheduleFlush() {
+        if (!flushTimer) {
+            flushTimer = setTimeout(flush, config.flushDelay);
+        }
+    }
+
+    function flush() {
+        clearTimeout(flushTimer);
+        flushTimer = null;
+        if (!pending.length) {
+            return;
+        }
+        var batch = pending.splice(0, config.batchMax);
+        postLabels(batch).catch(function () {
+            pending = batch.concat(pending);
+            scheduleFlush();
+        });
+    }
+
+    function flushOnExit() {
+        if (!pending.length) {
+            return;
+        }
+        var body = JSON.stringify(
+            {labels: pending.splice(0, config.batchMax)});
+        if (!navigator.sendBeacon ||
+                !navigator.sendBeacon(config.labelsUrl, body)) {
+            fetch(config.labelsUrl, {method: 'POST', body: body,
+                                     credentials: 'same-origin',
+                                     keepalive: true});
+        }
+    }
+
+    function label(value) {
+        if (waiting) {
+            return;
+        }
+        pending.push({file_name: current.file_name, label: value});
+        setStatus(value === 'trash' ? 'Trashed ' + current.file_name
+                                    : 'You selected: ' + value.toUpperCase());
+        if (pending.length >= config.flushSize) {
+            flush();
+        } else {
+            scheduleFlush();
+        }
+        advance();
+    }
+
+    Array.prototype.forEach.call(
+        document.querySelectorAll('[data-label]'),
+        function (button) {
+            button.addEventListener('click', function (event) {
+                event.preventDefault();
+                label(button.getAttribute('data-label'));
+            });
+        });
+    document.addEventListener('visibilitychange', function () {
+        if (document.visibilityState === 'hidden') {
+            flushOnExit();
+        }
+    });
+    window.addEventListener('pagehide', flushOnExit);
+
+    refill();
+})();
@@ -0,0 +1,92 @@
+// MD5 of an ArrayBuffer, as a lower-case hex string (RFC 1321).
+// Web Crypto has no MD5, and the upload API names every source by the
+// MD5 of its bytes, so the browser has to compute it itself.
+(function (global) {
+    'use strict';
+
+    // Per-round shift amounts
+    var S = [7, 12, 17, 22, 7, 12, 17, 22, 7, 12, 17, 22, 7, 12, 17, 22,
+             5, 9, 14, 20, 5, 9, 14, 20, 5, 9, 14, 20, 5, 9, 14, 20,
+             4, 11, 16, 23, 4, 11, 16, 23, 4, 11, 16, 23, 4, 11, 16, 23,
+             6, 10, 15, 21, 6, 10, 15, 21, 6, 10, 15, 21, 6, 10, 15, 21];
+
+    // K[i] = floor(abs(sin(i + 1)) * 2^32)
+    var K = new Int32Array(64);
+    for (var i = 0; i < 64; i++) {
+        K[i] = Math.floor(Math.abs(Math.sin(i + 1)) * 4294967296) | 0;
+    }
+
+    function processBlock(state, words) {
+        var a = state[0], b = state[1], c = state[2], d = state[3];
+        for (var i = 0; i < 64; i++) {
+            var f, g;
+            if (i < 16) {
+                f = (b & c) | (~b & d);
+                g = i;
+            } else if (i < 32) {
+                f = (d & b) | (~d & c);
+                g = (5 * i + 1) % 16;
+            } else if (i < 48) {
+                f = b ^ c ^ d;
+                g = (3 * i + 5) % 16;
+            } else {
+                f = c ^ (b | ~d);
+                g = (7 * i) % 16;
+            }
+            var sum = (a + f + K[i] + words[g]) | 0;
+            a = d;
+            d = c;
+            c = b;
+            b = (b + ((sum << S[i]) | (sum >>> (32 - S[i])))) | 0;
+        }
+        state[0] = (state[0] + a) | 0;
+        state[1] = (state[1] + b) | 0;
+        state[2] = (state[2] + c) | 0;
+        state[3] = (state[3] + d) | 0;
+    }
+
+    function md5(buffer) {
+        var bytes = new Uint8Array(buffer);
+        var length = bytes.length;
+        var state = new Int32Array([0x67452301, 0xefcdab89 | 0,
+                                    0x98badcfe | 0, 0x10325476]);
+        var words = new Int32Array(16);
+        var view = new DataView(bytes.buffer, bytes.byteOffset, length);
+
+        // Whole 64-byte blocks straight from the input
+        var whole = length - (length % 64);
+        for (var offset = 0; offset < whole; offset += 64) {
+            for (var w = 0; w < 16; w++) {
+                words[w] = view.getInt32(offset + w * 4, true);
+            }
+            processBlock(state, words);
+        }
+
+        // The rest, a 0x80 byte, zeros and the bit length in one or two
+        // final blocks
+        var tailLength = length - whole;
+        var tail = new Uint8Array(tailLength < 56 ? 64 : 128);
+        tail.set(bytes.subarray(whole));
+        tail[tailLength] = 0x80;
+        var tailView = new DataView(tail.buffer);
+        var bits = length * 8;
+        tailView.setUint32(tail.length - 8, bits >>> 0, true);
+        tailView.setUint32(tail.length - 4,
+                           Math.floor(bits / 4294967296), true);
+        for (var block = 0; block < tail.length; block += 64) {
+            for (var t = 0; t < 16; t++) {
+                words[t] = tailView.getInt32(block + t * 4, true);
+            }
+            processBlock(state, words);
+        }
+
+        var hex = '';
+        var out = new DataView(state.buffer);
+        for (var j = 0; j < 16; j++) {
+            hex += ('0' + out.getUint8(j).toString(16)).slice(-2);
+        }
+        return hex;
+    }
+
+    global.md5 = md5;
+})(typeof window !== 'undefined' ? window : globalThis);
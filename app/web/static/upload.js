@@ -0,0 +1,166 @@
+// Bulk upload straight to S3.
+// 1. Hash every file in the browser (md5.js).
+// 2. Ask /api/uploads/batch for presigned POSTs. Files that are
+//    already stored come back as duplicates and are never sent.
+// 3. POST the rest directly to sources/<md5>.<ext> in S3.
+// 4. Report the finished uploads with /api/uploads/complete. They are
+//    'pending' until make_numpy has checked them and written their rows.
+(function () {
+    'use strict';
+
+    var config = window.UPLOAD_CONFIG;
+    // Concurrent POSTs to S3
+    var PARALLEL_UPLOADS = 4;
+
+    function extensionOf(name) {
+        return name.split('.').pop().toLowerCase();
+    }
+
+    function addRow(name) {
+        var row = document.getElementById('upload-results').insertRow(-1);
+        row.insertCell(0).textContent = name;
+        var status = row.insertCell(1);
+        status.textContent = 'hashing';
+        return status;
+    }
+
+    function postJson(url, body) {
+        return fetch(url, {
+            method: 'POST',
+            headers: {'Content-Type': 'application/json'},
+            body: JSON.stringify(body)
+        }).then(function (response) {
+            return response.json().then(function (data) {
+                if (!response.ok) {
+                    throw new Error(data.error || response.statusText);
+                }
+                return data;
+            });
+        });
+    }
+
+    function hashFile(entry) {
+        return entry.file.arrayBuffer().then(function (buffer) {
+            entry.md5 = md5(buffer);
+            entry.status.textContent = 'checking';
+        });
+    }
+
+    function uploadToS3(entry) {
+        var form = new FormData();
+        Object.keys(entry.plan.fields).forEach(function (name) {
+            form.append(name, entry.plan.fields[name]);
+        });
+        // S3 requires the file to be the last field
+        form.append('file', entry.file);
+        entry.status.textContent = 'uploading';
+        return fetch(entry.plan.url, {method: 'POST', body: form})
+            .then(function (response) {
+                if (!response.ok) {
+                    throw new Error('S3 returned ' + response.status);
+                }
+                entry.uploaded = true;
+            })
+            .catch(function (error) {
+                entry.status.textContent = 'failed: ' + error.message;
+            });
+    }
+
+    function uploadAll(entries) {
+        var queue = entries.slice();
+        function next() {
+            var entry = queue.shift();
+            return entry ? uploadToS3(entry).then(next) : Promise.resolve();
+        }
+        var workers = [];
+        for (var i = 0; i < PARALLEL_UPLOADS; i++) {
+            workers.push(next());
+        }
+        return Promise.all(workers);
+    }
+
+    function describe(entry) {
+        return {md5: entry.md5, extension: extensionOf(entry.file.name),
+                size: entry.file.size};
+    }
+
+    function runBatch(entries) {
+        // Hash one file at a time so only one is held in memory
+        return entries.reduce(function (done, entry) {
+            return done.then(function () { return hashFile(entry); });
+        }, Promise.resolve())
+            .then(function () {
+                return postJson(config.planUrl,
+                                {files: entries.map(describe)});
+            })
+            .then(function (data) {
+                var toUpload = [];
+                data.files.forEach(function (plan, index) {
+                    var entry = entries[index];
+                    entry.plan = plan;
+                    if (plan.status === 'upload') {
+                        toUpload.push(entry);
+                    } else {
+                        entry.status.textContent = 'already stored';
+                    }
+                });
+                return uploadAll(toUpload).then(function () {
+                    return toUpload.filter(function (e) {
+                        return e.uploaded;
+                    });
+                });
+            })
+            .then(function (uploaded) {
+                if (!uploaded.length) {
+                    return;
+                }
+                return postJson(config.completeUrl,
+                                {files: uploaded.map(describe)})
+                    .then(function (data) {
+                        data.files.forEach(function (result, index) {
+                            uploaded[index].status.textContent =
+                                result.status;
+                        });
+                    });
+            })
+            .catch(function (error) {
+                entries.forEach(function (entry) {
+                    if (!entry.uploaded) {
+                        entry.status.textContent = 'failed: ' + error.message;
+                    }
+                });
+            });
+    }
+
+    function start() {
+        var files = Array.prototype.slice.call(
+            document.getElementById('upload-files').files);
+        var entries = [];
+        files.forEach(function (file) {
+            var status = addRow(file.name);
+            if (['jpg', 'jpeg', 'png'].indexOf(extensionOf(file.name)) < 0) {
+                status.textContent = 'skipped: not a JPEG or PNG';
+            } else if (file.size > config.maxBytes || file.size === 0) {
+                status.textContent = 'skipped: bad size';
+            } else {
+                entries.push({file: file, status: status});
+            }
+        });
+
+        // One planning request per batch, one batch at a time
+        var batches = [];
+        for (var i = 0; i < entries.length; i += config.batchMax) {
+            batches.push(entries.slice(i, i + config.batchMax));
+        }
+        batches.reduce(function (done, batch) {
+            return done.then(function () { return runBatch(batch); });
+        }, Promise.resolve()).then(function () {
+            var summary = document.getElementById('upload-summary');
+            document.getElementById('upload-summary-text').textContent =
+                'Finished ' + entries.length + ' file(s)';
+            summary.style.display = 'block';
+        });
+    }
+
+    document.getElementById('upload-start').addEventListener('click', start);
+})();
@@ -32,6 +32,30 @@ resource "aws_cloudfront_cache_policy" "sources_cache_policy" {
   }
 }
 
+# Display derivatives are content addressed (display/<md5>.<format>)
+# and never change in place, so they are cached for as long as allowed
+resource "aws_cloudfront_cache_policy" "display_cache_policy" {
+  name        = "${local.prefix}-display-cache-policy"
+  comment     = "Cache policy for display derivatives"
+  default_ttl = 31536000 # 1 year
+  max_ttl     = 31536000
+  min_ttl     = 86400
+
+  parameters_in_cache_key_and_forwarded_to_origin {
+    cookies_config {
+      cookie_behavior = "none"
+    }
+    headers_config {
+      header_behavior = "none"
+    }
+    query_strings_config {
+      query_string_behavior = "none"
+    }
+    enable_accept_encoding_gzip   = false
+    enable_accept_encoding_brotli = false
+  }
+}
+
 # Origin Request Policy for CloudFront
 resource "aws_cloudfront_origin_request_policy" "sources_request_policy" {
   name    = "${local.prefix}-sources-request-policy"
@@ -71,6 +95,13 @@ resource "aws_cloudfront_distribution" "sources_cdn" {
     origin_path              = "/sources"
   }
 
+  # Bucket root, for display/ derivatives written by the numpy Lambda
+  origin {
+    domain_name              = data.aws_s3_bucket.existing.bucket_regional_domain_name
+    origin_access_control_id = aws_cloudfront_origin_access_control.s3_oac.id
+    origin_id                = "s3-bucket"
+  }
+
   default_cache_behavior {
     allowed_methods  = ["GET", "HEAD", "OPTIONS"]
     cached_methods   = ["GET", "HEAD"]
@@ -83,6 +114,20 @@ resource "aws_cloudfront_distribution" "sources_cdn" {
     compress               = true
   }
 
+  ordered_cache_behavior {
+    path_pattern     = "display/*"
+    allowed_methods  = ["GET", "HEAD"]
+    cached_methods   = ["GET", "HEAD"]
+    target_origin_id = "s3-bucket"
+
+    cache_policy_id          = aws_cloudfront_cache_policy.display_cache_policy.id
+    origin_request_policy_id = aws_cloudfront_origin_request_policy.sources_request_policy.id
+
+    viewer_protocol_policy = "redirect-to-https"
+    # WebP and AVIF are already compressed
+    compress = false
+  }
+
   custom_error_response {
     error_code         = 404
     response_code      = "200"
@@ -118,7 +163,8 @@ data "aws_iam_policy_document" "s3_cloudfront_access" {
     }
     actions = ["s3:GetObject"]
     resources = [
-      "${data.aws_s3_bucket.existing.arn}/sources/*"
+      "${data.aws_s3_bucket.existing.arn}/sources/*",
+      "${data.aws_s3_bucket.existing.arn}/display/*"
     ]
     condition {
       test     = "StringEquals"
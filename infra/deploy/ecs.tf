@@ -67,6 +67,18 @@ data "aws_iam_policy_document" "ecs_access" {
     ]
   }
 
+  # Presigned POSTs from /api/uploads are signed with this role, so it
+  # must be allowed to write what browsers upload straight to sources/
+  statement {
+    effect = "Allow"
+    actions = [
+      "s3:PutObject"
+    ]
+    resources = [
+      "${data.aws_s3_bucket.existing.arn}/sources/*"
+    ]
+  }
+
   # CloudWatch Logs permissions
   statement {
     effect = "Allow"
@@ -153,6 +165,10 @@ resource "aws_ecs_task_definition" "web" {
             name  = "DB_HOST"
             value = local.db_host
           },
+          {
+            name  = "DB_READ_HOSTS"
+            value = local.db_read_hosts
+          },
           {
             name  = "DB_NAME"
             value = local.db_name
@@ -164,6 +180,18 @@ resource "aws_ecs_task_definition" "web" {
           {
             name  = "DB_PASSWORD"
             value = local.db_password
+          },
+          {
+            name  = "SAMPLING_MODE"
+            value = var.sampling_mode
+          },
+          {
+            name  = "SERVE_DISPLAY_IMAGES"
+            value = var.display_size > 0 ? "1" : "0"
+          },
+          {
+            name  = "DISPLAY_FORMAT"
+            value = var.display_format
           }
         ]
         logConfiguration = {
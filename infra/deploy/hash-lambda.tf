@@ -37,6 +37,23 @@ data "aws_iam_policy_document" "lambda_s3_policy" {
       "${data.aws_s3_bucket.existing.arn}/sources/*"
     ]
   }
+
+  # Fused conversion writes make_numpy's outputs; GetObject covers the HEAD
+  # that checks an output is current
+  dynamic "statement" {
+    for_each = var.fused_convert ? [1] : []
+    content {
+      effect = "Allow"
+      actions = [
+        "s3:PutObject",
+        "s3:GetObject"
+      ]
+      resources = [
+        "${data.aws_s3_bucket.existing.arn}/numpys/*",
+        "${data.aws_s3_bucket.existing.arn}/display/*"
+      ]
+    }
+  }
 }
 
 resource "aws_iam_policy" "lambda_s3_policy" {
@@ -181,13 +198,19 @@ resource "aws_lambda_function" "processor" {
 
   environment {
     variables = {
-      S3_BUCKET_NAME = local.s3_bucket_name
-      ENVIRONMENT    = var.environment
-      DB_HOST        = local.db_host
-      DB_PORT        = "5432"
-      DB_NAME        = local.db_name
-      DB_USER        = local.db_username
-      DB_PASSWORD    = local.db_password
+      S3_BUCKET_NAME   = local.s3_bucket_name
+      ENVIRONMENT      = var.environment
+      DB_HOST          = local.db_host
+      DB_PORT          = "5432"
+      DB_NAME          = local.db_name
+      DB_USER          = local.db_username
+      DB_PASSWORD      = local.db_password
+      MAX_IMAGE_PIXELS = var.max_image_pixels
+      FUSED_CONVERT    = var.fused_convert ? "1" : "0"
+      # make_numpy's settings, used when FUSED_CONVERT is on
+      PIPELINE_SPEC  = var.pipeline_spec
+      DISPLAY_SIZE   = var.display_size
+      DISPLAY_FORMAT = var.display_format
     }
   }
 
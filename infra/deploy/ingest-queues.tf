@@ -0,0 +1,134 @@
+#################################################
+# SQS Queues Buffering S3 Events for the Lambdas #
+#################################################
+
+# With sqs_ingest on, S3 sends upload/ and sources/ notifications to these
+# queues instead of invoking the Lambdas. An event source mapping reads each
+# queue in batches, so an upload spike is worked off by at most
+# ingest_max_concurrency Lambdas (and as many DB connections) instead of
+# one Lambda per file. Messages that keep failing move to a dead-letter
+# queue after ingest_max_receive_count attempts.
+
+locals {
+  ingest_queues = var.sqs_ingest ? {
+    upload = {
+      function_arn  = aws_lambda_function.processor.arn
+      function_name = aws_lambda_function.processor.function_name
+      role          = aws_iam_role.lambda_role.name
+    }
+    sources = {
+      function_arn  = aws_lambda_function.numpy_convert.arn
+      function_name = aws_lambda_function.numpy_convert.function_name
+      role          = aws_iam_role.numpy_lambda_role.name
+    }
+  } : {}
+}
+
+resource "aws_sqs_queue" "ingest_dlq" {
+  for_each = local.ingest_queues
+
+  name                      = "${var.prefix}-${each.key}-dlq-${var.environment}"
+  message_retention_seconds = 1209600
+
+  tags = {
+    Name = "${var.prefix}-${each.key}-dlq-${var.environment}"
+  }
+}
+
+resource "aws_sqs_queue" "ingest" {
+  for_each = local.ingest_queues
+
+  name = "${var.prefix}-${each.key}-queue-${var.environment}"
+  # AWS recommends six times the function timeout plus the batch window
+  visibility_timeout_seconds = var.lambda_timeout * 6 + var.ingest_batch_window
+  message_retention_seconds  = 345600
+
+  redrive_policy = jsonencode({
+    deadLetterTargetArn = aws_sqs_queue.ingest_dlq[each.key].arn
+    maxReceiveCount     = var.ingest_max_receive_count
+  })
+
+  tags = {
+    Name = "${var.prefix}-${each.key}-queue-${var.environment}"
+  }
+}
+
+# Let the bucket send its notifications to the queues
+data "aws_iam_policy_document" "ingest_queue_policy" {
+  for_each = local.ingest_queues
+
+  statement {
+    effect = "Allow"
+    principals {
+      type        = "Service"
+      identifiers = ["s3.amazonaws.com"]
+    }
+    actions   = ["sqs:SendMessage"]
+    resources = [aws_sqs_queue.ingest[each.key].arn]
+    condition {
+      test     = "ArnEquals"
+      variable = "aws:SourceArn"
+      values   = [data.aws_s3_bucket.existing.arn]
+    }
+  }
+}
+
+resource "aws_sqs_queue_policy" "ingest" {
+  for_each = local.ingest_queues
+
+  queue_url = aws_sqs_queue.ingest[each.key].id
+  policy    = data.aws_iam_policy_document.ingest_queue_policy[each.key].json
+}
+
+# Let each Lambda's event source mapping read and delete its queue's messages
+data "aws_iam_policy_document" "ingest_consume_policy" {
+  for_each = local.ingest_queues
+
+  statement {
+    effect = "Allow"
+    actions = [
+      "sqs:ReceiveMessage",
+      "sqs:DeleteMessage",
+      "sqs:GetQueueAttributes"
+    ]
+    resources = [aws_sqs_queue.ingest[each.key].arn]
+  }
+}
+
+resource "aws_iam_policy" "ingest_consume" {
+  for_each = local.ingest_queues
+
+  name        = "${var.prefix}-${each.key}-queue-policy-${var.environment}"
+  description = "Policy for Lambda to consume the ${each.key} SQS queue"
+  policy      = data.aws_iam_policy_document.ingest_consume_policy[each.key].json
+
+  tags = {
+    Name = "${var.prefix}-${each.key}-queue-policy-${var.environment}"
+  }
+}
+
+resource "aws_iam_role_policy_attachment" "ingest_consume" {
+  for_each = local.ingest_queues
+
+  role       = each.value.role
+  policy_arn = aws_iam_policy.ingest_consume[each.key].arn
+}
+
+# Batches of up to ingest_batch_size messages, waiting up to
+# ingest_batch_window seconds to fill one. The handlers return
+# batchItemFailures, so only the messages that failed are retried.
+resource "aws_lambda_event_source_mapping" "ingest" {
+  for_each = local.ingest_queues
+
+  event_source_arn                   = aws_sqs_queue.ingest[each.key].arn
+  function_name                      = each.value.function_arn
+  batch_size                         = var.ingest_batch_size
+  maximum_batching_window_in_seconds = var.ingest_batch_window
+  function_response_types            = ["ReportBatchItemFailures"]
+
+  scaling_config {
+    maximum_concurrency = var.ingest_max_concurrency
+  }
+
+  depends_on = [aws_iam_role_policy_attachment.ingest_consume]
+}
@@ -35,13 +35,23 @@ data "aws_iam_policy_document" "numpy_lambda_s3_policy" {
     ]
   }
 
+  # Direct uploads that fail the size or near-duplicate check are removed
+  statement {
+    effect    = "Allow"
+    actions   = ["s3:DeleteObject"]
+    resources = ["${data.aws_s3_bucket.existing.arn}/sources/*"]
+  }
+
+  # GetObject also covers the HEAD that checks an output is current
   statement {
     effect = "Allow"
     actions = [
-      "s3:PutObject"
+      "s3:PutObject",
+      "s3:GetObject"
     ]
     resources = [
-      "${data.aws_s3_bucket.existing.arn}/numpys/*"
+      "${data.aws_s3_bucket.existing.arn}/numpys/*",
+      "${data.aws_s3_bucket.existing.arn}/display/*"
     ]
   }
 }
@@ -129,6 +139,12 @@ resource "aws_iam_role_policy_attachment" "numpy_lambda_ecr_attachment" {
   policy_arn = aws_iam_policy.numpy_lambda_ecr_policy.arn
 }
 
+# In the VPC to write the images rows of direct uploads
+resource "aws_iam_role_policy_attachment" "numpy_lambda_vpc_attachment" {
+  role       = aws_iam_role.numpy_lambda_role.name
+  policy_arn = aws_iam_policy.lambda_vpc_policy.arn
+}
+
 resource "aws_cloudwatch_log_group" "numpy_lambda_logs" {
   name              = "/aws/lambda/${local.project_name}/numpy-convert"
   retention_in_days = var.lambda_log_retention_days
@@ -150,10 +166,27 @@ resource "aws_lambda_function" "numpy_convert" {
   timeout     = var.lambda_timeout
   memory_size = var.lambda_memory_size
 
+  # Same subnets and security group as the hash Lambda, which RDS
+  # admits; S3 is reached through the VPC's gateway endpoint
+  vpc_config {
+    subnet_ids         = [aws_subnet.private_a.id, aws_subnet.private_b.id]
+    security_group_ids = [aws_security_group.hash_lambda_sg.id]
+  }
+
   environment {
     variables = {
-      S3_BUCKET_NAME = var.s3_bucket_name
-      ENVIRONMENT    = var.environment
+      S3_BUCKET_NAME   = var.s3_bucket_name
+      ENVIRONMENT      = var.environment
+      DB_HOST          = local.db_host
+      DB_PORT          = "5432"
+      DB_NAME          = local.db_name
+      DB_USER          = local.db_username
+      DB_PASSWORD      = local.db_password
+      PIPELINE_SPEC    = var.pipeline_spec
+      DISPLAY_SIZE     = var.display_size
+      DISPLAY_FORMAT   = var.display_format
+      MAX_IMAGE_PIXELS = var.max_image_pixels
+      CONVERT_WORKERS  = var.convert_workers
     }
   }
 
@@ -161,7 +194,9 @@ resource "aws_lambda_function" "numpy_convert" {
     aws_cloudwatch_log_group.numpy_lambda_logs,
     aws_iam_role_policy_attachment.numpy_lambda_s3_attachment,
     aws_iam_role_policy_attachment.numpy_lambda_logs_attachment,
-    aws_iam_role_policy_attachment.numpy_lambda_ecr_attachment
+    aws_iam_role_policy_attachment.numpy_lambda_ecr_attachment,
+    aws_iam_role_policy_attachment.numpy_lambda_vpc_attachment,
+    aws_db_instance.main
   ]
 
   tags = {
@@ -150,6 +150,38 @@ resource "aws_db_instance" "main" {
   }
 }
 
+# Read replicas for the web app's sampling and read-only API queries.
+# Add replicas to scale label throughput instead of resizing the primary.
+resource "aws_db_instance" "replica" {
+  count                      = var.db_read_replicas
+  identifier                 = "${local.prefix}-db-replica-${count.index}"
+  replicate_source_db        = aws_db_instance.main.identifier
+  instance_class             = "db.t4g.micro"
+  storage_type               = "io1"
+  iops                       = 2000
+  storage_encrypted          = true
+  auto_minor_version_upgrade = true
+
+  vpc_security_group_ids = [aws_security_group.rds.id]
+  publicly_accessible    = false
+  multi_az               = false
+  parameter_group_name   = aws_db_parameter_group.main.name
+
+  # Replicas are rebuilt from the primary, nothing to back up
+  backup_retention_period = 0
+  skip_final_snapshot     = true
+
+  performance_insights_enabled = false
+  monitoring_interval          = 0
+  deletion_protection          = false
+
+  tags = {
+    Name        = "mldatabase-replica-${count.index}"
+    Environment = var.environment
+    Project     = var.project_name
+  }
+}
+
 # Outputs
 output "db_endpoint" {
   description = "The connection endpoint for the RDS instance"
@@ -177,4 +209,9 @@ output "db_identifier" {
   value       = aws_db_instance.main.identifier
 }
 
- 
\ No newline at end of file
+ 
+
+output "db_replica_endpoints" {
+  description = "The connection endpoints of the read replicas"
+  value       = aws_db_instance.replica[*].endpoint
+}
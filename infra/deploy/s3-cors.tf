@@ -0,0 +1,15 @@
+##########################################
+# CORS for Browser Uploads Straight to S3 #
+##########################################
+
+# /upload submits the presigned POSTs from /api/uploads cross-origin
+resource "aws_s3_bucket_cors_configuration" "browser_uploads" {
+  bucket = data.aws_s3_bucket.existing.id
+
+  cors_rule {
+    allowed_methods = ["POST"]
+    allowed_origins = ["https://${var.domain_name}"]
+    allowed_headers = ["*"]
+    max_age_seconds = 3000
+  }
+}
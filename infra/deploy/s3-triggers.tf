@@ -8,17 +8,28 @@ resource "aws_s3_bucket_notification" "lambda_notification" {
   bucket = data.aws_s3_bucket.existing.id
 
   # Hash Lambda trigger - processes files uploaded to upload/ folder
-  lambda_function {
-    lambda_function_arn = aws_lambda_function.processor.arn
-    events              = ["s3:ObjectCreated:*"]
-    filter_prefix       = "upload/"
+  # Numpy Lambda trigger - processes files uploaded to sources/ folder
+  # With sqs_ingest the notifications go to the ingest queues instead
+  # (ingest-queues.tf), which the same Lambdas read in batches
+  dynamic "lambda_function" {
+    for_each = var.sqs_ingest ? {} : {
+      upload  = aws_lambda_function.processor.arn
+      sources = aws_lambda_function.numpy_convert.arn
+    }
+    content {
+      lambda_function_arn = lambda_function.value
+      events              = ["s3:ObjectCreated:*"]
+      filter_prefix       = "${lambda_function.key}/"
+    }
   }
 
-  # Numpy Lambda trigger - processes files uploaded to sources/ folder
-  lambda_function {
-    lambda_function_arn = aws_lambda_function.numpy_convert.arn
-    events              = ["s3:ObjectCreated:*"]
-    filter_prefix       = "sources/"
+  dynamic "queue" {
+    for_each = aws_sqs_queue.ingest
+    content {
+      queue_arn     = queue.value.arn
+      events        = ["s3:ObjectCreated:*"]
+      filter_prefix = "${queue.key}/"
+    }
   }
 
   # Future Lambda trigger - will also process files uploaded to sources/ folder
@@ -32,7 +43,8 @@ resource "aws_s3_bucket_notification" "lambda_notification" {
   # Dependencies on Lambda permissions to ensure they exist before creating notifications
   depends_on = [
     aws_lambda_permission.s3_permission,
-    aws_lambda_permission.numpy_s3_permission
+    aws_lambda_permission.numpy_s3_permission,
+    aws_sqs_queue_policy.ingest
     # aws_lambda_permission.future_lambda_permission  # Uncomment when ready
   ]
 } 
\ No newline at end of file
@@ -157,4 +157,82 @@ variable "snapshot_identifier" {
   description = "Snapshot identifier to restore from (only used if use_snapshot is true)"
   type        = string
   default     = ""
-}
\ No newline at end of file
+}
+
+variable "sampling_mode" {
+  description = "How the web app picks images to label: random or uncertainty"
+  type        = string
+  default     = "random"
+}
+
+variable "pipeline_spec" {
+  description = "JSON list of preprocessing variants for the numpy Lambda. Empty keeps the single legacy numpys/ output"
+  type        = string
+  default     = ""
+}
+
+variable "display_size" {
+  description = "Longer side of the display/ images the labeling UI shows. 0 stops writing them"
+  type        = number
+  default     = 512
+}
+
+variable "display_format" {
+  description = "Format of the display/ images: webp or avif. avif needs a Pillow built with AVIF, or make_numpy fails at start"
+  type        = string
+  default     = "webp"
+}
+
+variable "max_image_pixels" {
+  description = "Pixel budget of one image decode in the Lambdas; larger JPEGs are decoded at reduced scale, other formats rejected"
+  type        = number
+  default     = 16000000
+}
+
+variable "convert_workers" {
+  description = "Images of one SQS batch the numpy Lambda converts at once. Above 1 it needs lambda_memory_size of about 1769 MB per vCPU"
+  type        = number
+  default     = 1
+}
+
+variable "fused_convert" {
+  description = "Have the hash Lambda also write the numpy and display outputs, so the numpy Lambda only checks they are current"
+  type        = bool
+  default     = false
+}
+
+variable "sqs_ingest" {
+  description = "Send upload/ and sources/ notifications through SQS queues that the Lambdas read in batches. false invokes the Lambdas from S3 directly"
+  type        = bool
+  default     = true
+}
+
+variable "ingest_batch_size" {
+  description = "SQS messages (one S3 file each) per Lambda invocation"
+  type        = number
+  default     = 10
+}
+
+variable "ingest_batch_window" {
+  description = "Seconds the event source mapping waits to fill a batch"
+  type        = number
+  default     = 5
+}
+
+variable "ingest_max_concurrency" {
+  description = "Most concurrent Lambdas reading each ingest queue (at least 2)"
+  type        = number
+  default     = 5
+}
+
+variable "ingest_max_receive_count" {
+  description = "Attempts at a message before it moves to the dead-letter queue"
+  type        = number
+  default     = 5
+}
+
+variable "db_read_replicas" {
+  description = "Number of RDS read replicas the web app reads from. 0 reads everything from the primary"
+  type        = number
+  default     = 0
+}